@@ -1,42 +1,543 @@
+from contextlib import asynccontextmanager
+from datetime import datetime
 from itertools import chain
-from typing import List, Optional, Tuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
-from asyncpg import Record
+from asyncpg import PostgresError, Record
 from asyncpgsa import pg
-from sqlalchemy import sql
+from asyncpgsa.connection import get_dialect
+from sqlalchemy import Column, sql
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.elements import BinaryExpression, ClauseElement
 
+from cache import TTLCache
+from configs import CacheConfig
+from constants import INITIAL_RATING
+from games.board import CLASSIC, Geometry, to_signed
+from instrumentation import db_call
 from models import (
+    EnumSign,
+    EnumStatus,
     User,
     TicTacToeGame,
     TicTacToePlayer,
-    TicTacToeStep
+    TicTacToeStep,
+    UserStats
 )
 
+# Validates and applies a move of the player ($2 - Telegram ID) on the game ($1) cell ($3):
+# inserts the step, updates the board, passes the turn, and on a win or a draw sets the players results
+# and finishes the game. A win is checked against the winning masks through the cell ($4) only,
+# the game is marked updated at the time of the move ($5).
+# The game row is locked first, so concurrent moves of one game are serialized
+# and a repeated tap finds the turn already passed. Returns no rows if the move is rejected.
+APPLY_MOVE_QUERY = '''
+WITH game AS (
+    SELECT
+        id,
+        current_step_user_id,
+        cross_board,
+        circle_board,
+        width * height AS cells,
+        CASE WHEN width * height = 64 THEN -1 ELSE (1::bigint << width * height) - 1 END AS full_board
+    FROM "TicTacToeGame"
+    WHERE id = $1 AND status = 'in_progress'
+    FOR UPDATE
+), players AS (
+    SELECT player.id, player.user_id, player.sign, "User".tg_id
+    FROM "TicTacToePlayer" AS player
+    JOIN "User" ON "User".id = player.user_id
+    WHERE player.game_id = $1
+), mover AS (
+    SELECT players.*
+    FROM players
+    JOIN game ON game.current_step_user_id = players.user_id
+    WHERE players.tg_id = $2
+), opponent AS (
+    SELECT players.*
+    FROM players, mover
+    WHERE players.id <> mover.id
+), move AS (
+    SELECT
+        mover.id AS player_id,
+        mover.sign,
+        opponent.id AS opponent_id,
+        opponent.user_id AS opponent_user_id,
+        game.full_board,
+        game.cross_board | CASE WHEN mover.sign = 'cross' THEN 1::bigint << $3 ELSE 0 END AS cross_board,
+        game.circle_board | CASE WHEN mover.sign = 'circle' THEN 1::bigint << $3 ELSE 0 END AS circle_board
+    FROM mover, opponent, game
+    WHERE $3 >= 0 AND $3 < game.cells AND (game.cross_board | game.circle_board) & (1::bigint << $3) = 0
+), outcome AS (
+    SELECT
+        move.*,
+        EXISTS (
+            SELECT 1
+            FROM unnest($4::bigint[]) AS line
+            WHERE CASE WHEN move.sign = 'cross' THEN move.cross_board ELSE move.circle_board END & line = line
+        ) AS is_win,
+        (move.cross_board | move.circle_board) = move.full_board AS is_full
+    FROM move
+), step AS (
+    INSERT INTO "TicTacToeStep" (position, player_id)
+    SELECT $3, player_id FROM outcome
+), results AS (
+    UPDATE "TicTacToePlayer" AS player
+    SET is_winner = outcome.is_win AND player.id = outcome.player_id
+    FROM outcome
+    WHERE player.id IN (outcome.player_id, outcome.opponent_id) AND (outcome.is_win OR outcome.is_full)
+), game_update AS (
+    UPDATE "TicTacToeGame" AS game
+    SET
+        cross_board = outcome.cross_board,
+        circle_board = outcome.circle_board,
+        updated = $5,
+        status = CASE WHEN outcome.is_win OR outcome.is_full THEN 'finished' ELSE 'in_progress' END::enumstatus,
+        current_step_user_id = CASE
+            WHEN outcome.is_win OR outcome.is_full THEN game.current_step_user_id
+            ELSE outcome.opponent_user_id
+        END
+    FROM outcome
+    WHERE game.id = $1
+)
+SELECT
+    outcome.cross_board AS "TicTacToeGame_cross_board",
+    outcome.circle_board AS "TicTacToeGame_circle_board",
+    CASE WHEN outcome.is_win THEN outcome.sign::text END AS "TicTacToeGame_winner",
+    outcome.is_win OR outcome.is_full AS "TicTacToeGame_is_finished",
+    outcome.opponent_user_id AS "TicTacToeGame_next_step_user_id"
+FROM outcome
+'''
+
+# Moves ($1 - game IDs, $2 - Telegram IDs of the players, $3 - cells) with no step of the player on the cell,
+# run after the moves in their transaction to find the rejected ones. Returns their positions in the arrays from 1
+REJECTED_MOVES_QUERY = '''
+SELECT move.index
+FROM unnest($1::int[], $2::bigint[], $3::int[]) WITH ORDINALITY AS move(game_id, tg_id, position, index)
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM "TicTacToeStep" AS step
+    JOIN "TicTacToePlayer" AS player ON player.id = step.player_id
+    JOIN "User" ON "User".id = player.user_id
+    WHERE player.game_id = move.game_id AND "User".tg_id = move.tg_id AND step.position = move.position
+)
+ORDER BY move.index
+'''
+
+# Expires up to $3 games not finished and not updated since $1, marking them updated at $2.
+# Games locked by a move or by another process are skipped
+EXPIRE_QUERY = '''
+UPDATE "TicTacToeGame"
+SET status = 'expired', updated = $2
+WHERE id IN (
+    SELECT id
+    FROM "TicTacToeGame"
+    WHERE status IN ('initial', 'in_progress') AND updated < $1
+    ORDER BY updated
+    LIMIT $3
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id AS "TicTacToeGame_id", inline_message_id AS "TicTacToeGame_inline_message_id"
+'''
+
+# Moves up to $2 games finished or expired before $1 to the archive with their moves,
+# deleting their steps, players and game rows. Foreign keys are checked at the end of the statement,
+# when all of them are deleted. Returns the number of deleted rows per table
+ARCHIVE_QUERY = '''
+WITH batch AS (
+    SELECT *
+    FROM "TicTacToeGame"
+    WHERE status IN ('finished', 'expired') AND updated < $1
+    ORDER BY updated
+    LIMIT $2
+    FOR UPDATE SKIP LOCKED
+), players AS (
+    SELECT player.*
+    FROM "TicTacToePlayer" AS player
+    JOIN batch ON batch.id = player.game_id
+), sides AS (
+    SELECT
+        game_id,
+        max(user_id) FILTER (WHERE sign = 'cross') AS cross_user_id,
+        max(user_id) FILTER (WHERE sign = 'circle') AS circle_user_id,
+        max(sign) FILTER (WHERE is_winner) AS winner
+    FROM players
+    GROUP BY game_id
+), moves AS (
+    SELECT players.game_id, array_agg(step.position ORDER BY step.id) AS moves
+    FROM "TicTacToeStep" AS step
+    JOIN players ON players.id = step.player_id
+    GROUP BY players.game_id
+), archived AS (
+    INSERT INTO "TicTacToeGameArchive" (
+        id, created, finished, status, width, height, win_length, ai_difficulty,
+        cross_user_id, circle_user_id, winner, moves
+    )
+    SELECT
+        batch.id,
+        batch.created,
+        batch.updated,
+        batch.status,
+        batch.width,
+        batch.height,
+        batch.win_length,
+        batch.ai_difficulty,
+        sides.cross_user_id,
+        sides.circle_user_id,
+        sides.winner,
+        COALESCE(moves.moves, '{}')
+    FROM batch
+    LEFT JOIN sides ON sides.game_id = batch.id
+    LEFT JOIN moves ON moves.game_id = batch.id
+    RETURNING id
+), deleted_steps AS (
+    DELETE FROM "TicTacToeStep" AS step
+    USING players
+    WHERE step.player_id = players.id
+    RETURNING step.id
+), deleted_players AS (
+    DELETE FROM "TicTacToePlayer" AS player
+    USING players
+    WHERE player.id = players.id
+    RETURNING player.id
+), deleted_games AS (
+    DELETE FROM "TicTacToeGame" AS game
+    USING archived
+    WHERE game.id = archived.id
+    RETURNING game.id
+)
+SELECT
+    (SELECT count(*) FROM deleted_games) AS games,
+    (SELECT count(*) FROM deleted_players) AS players,
+    (SELECT count(*) FROM deleted_steps) AS steps
+'''
+
+# Games archived and live with both players and the moves in order, created from $1 until $2 if set,
+# with the status in $3 if set. Games ended and not archived yet finished at their last update
+EXPORT_QUERY = '''
+SELECT
+    games.id,
+    games.created,
+    games.finished,
+    games.status,
+    games.width,
+    games.height,
+    games.win_length,
+    games.ai_difficulty,
+    cross_user.tg_id AS cross_tg_id,
+    cross_user.name AS cross_name,
+    circle_user.tg_id AS circle_tg_id,
+    circle_user.name AS circle_name,
+    games.winner,
+    games.moves
+FROM (
+    SELECT
+        id, created, finished, status::text, width, height, win_length, ai_difficulty::text,
+        cross_user_id, circle_user_id, winner::text, moves
+    FROM "TicTacToeGameArchive"
+    UNION ALL
+    SELECT
+        game.id,
+        game.created,
+        CASE WHEN game.status IN ('finished', 'expired') THEN game.updated END,
+        game.status::text,
+        game.width,
+        game.height,
+        game.win_length,
+        game.ai_difficulty::text,
+        cross_player.user_id,
+        circle_player.user_id,
+        CASE WHEN cross_player.is_winner THEN 'cross' WHEN circle_player.is_winner THEN 'circle' END,
+        ARRAY(
+            SELECT step.position
+            FROM "TicTacToeStep" AS step
+            JOIN "TicTacToePlayer" AS player ON player.id = step.player_id
+            WHERE player.game_id = game.id
+            ORDER BY step.id
+        )
+    FROM "TicTacToeGame" AS game
+    LEFT JOIN "TicTacToePlayer" AS cross_player ON cross_player.game_id = game.id AND cross_player.sign = 'cross'
+    LEFT JOIN "TicTacToePlayer" AS circle_player ON circle_player.game_id = game.id AND circle_player.sign = 'circle'
+) AS games
+LEFT JOIN "User" AS cross_user ON cross_user.id = games.cross_user_id
+LEFT JOIN "User" AS circle_user ON circle_user.id = games.circle_user_id
+WHERE ($1::timestamp IS NULL OR games.created >= $1)
+    AND ($2::timestamp IS NULL OR games.created < $2)
+    AND ($3::text[] IS NULL OR games.status = ANY($3))
+ORDER BY games.id
+'''
+
+# Adds the result of the game ($1) to the stats of both players, updated at $4, if the game finished
+# between players. The Elo rating changes by $2 times the difference between the score and the expected one,
+# players start with the rating $3. The change is added to the rating locked by the upsert,
+# so results of the same player saved concurrently are all counted
+RECORD_RESULT_QUERY = '''
+WITH result AS (
+    SELECT
+        player.user_id,
+        opponent.user_id AS opponent_user_id,
+        CASE WHEN player.is_winner THEN 1 WHEN opponent.is_winner THEN 0 ELSE 0.5 END AS score
+    FROM "TicTacToeGame" AS game
+    JOIN "TicTacToePlayer" AS player ON player.game_id = game.id
+    JOIN "TicTacToePlayer" AS opponent ON opponent.game_id = game.id AND opponent.id <> player.id
+    WHERE game.id = $1 AND game.status = 'finished' AND game.ai_difficulty IS NULL
+), change AS (
+    SELECT
+        result.*,
+        $2 * (result.score - 1 / (1 + power(10, (
+            COALESCE(opponent_stats.rating, $3) - COALESCE(stats.rating, $3)
+        ) / 400))) AS rating_change
+    FROM result
+    LEFT JOIN "UserStats" AS stats ON stats.user_id = result.user_id
+    LEFT JOIN "UserStats" AS opponent_stats ON opponent_stats.user_id = result.opponent_user_id
+)
+INSERT INTO "UserStats" AS stats (user_id, wins, losses, draws, streak, rating, updated)
+SELECT
+    user_id,
+    (score = 1)::integer,
+    (score = 0)::integer,
+    (score = 0.5)::integer,
+    CASE score WHEN 1 THEN 1 WHEN 0 THEN -1 ELSE 0 END,
+    $3 + rating_change,
+    $4
+FROM change
+ON CONFLICT (user_id) DO UPDATE SET
+    wins = stats.wins + excluded.wins,
+    losses = stats.losses + excluded.losses,
+    draws = stats.draws + excluded.draws,
+    streak = CASE
+        WHEN excluded.streak > 0 THEN GREATEST(stats.streak, 0) + 1
+        WHEN excluded.streak < 0 THEN LEAST(stats.streak, 0) - 1
+        ELSE 0
+    END,
+    rating = stats.rating + excluded.rating - $3,
+    updated = excluded.updated
+'''
+
+# Finished games between players, live and archived, in the order they finished
+HISTORY_QUERY = '''
+SELECT finished, cross_user_id, circle_user_id, winner
+FROM (
+    SELECT id, finished, cross_user_id, circle_user_id, winner::text
+    FROM "TicTacToeGameArchive"
+    WHERE status = 'finished' AND ai_difficulty IS NULL
+    UNION ALL
+    SELECT
+        game.id,
+        game.updated,
+        cross_player.user_id,
+        circle_player.user_id,
+        CASE WHEN cross_player.is_winner THEN 'cross' WHEN circle_player.is_winner THEN 'circle' END
+    FROM "TicTacToeGame" AS game
+    JOIN "TicTacToePlayer" AS cross_player ON cross_player.game_id = game.id AND cross_player.sign = 'cross'
+    JOIN "TicTacToePlayer" AS circle_player ON circle_player.game_id = game.id AND circle_player.sign = 'circle'
+    WHERE game.status = 'finished' AND game.ai_difficulty IS NULL
+) AS history
+ORDER BY finished, id
+'''
+
+# Keeps the IDs of the games HISTORY_QUERY reads, in the same snapshot, for the session
+COUNTED_GAMES_QUERY = '''
+CREATE TEMPORARY TABLE counted_games AS
+SELECT id FROM "TicTacToeGameArchive" WHERE status = 'finished' AND ai_difficulty IS NULL
+UNION ALL
+SELECT id FROM "TicTacToeGame" WHERE status = 'finished' AND ai_difficulty IS NULL
+'''
+
+# Games between players finished since the snapshot of COUNTED_GAMES_QUERY, in the order they finished.
+# Games aren't archived meanwhile, see STATS_REBUILD_LOCK, so all of them are still in the live tables
+UNCOUNTED_GAMES_QUERY = '''
+SELECT id
+FROM "TicTacToeGame"
+WHERE status = 'finished' AND ai_difficulty IS NULL AND id NOT IN (SELECT id FROM counted_games)
+ORDER BY updated, id
+'''
+
+# Advisory lock a rebuild of the stats holds from the snapshot of the games until it added the results
+# of the games finished since, read from the live tables. Ended games aren't archived meanwhile
+STATS_REBUILD_LOCK = 0x7374617473
+REBUILD_LOCK_QUERY = 'SELECT pg_advisory_lock($1)'
+REBUILD_UNLOCK_QUERY = 'SELECT pg_advisory_unlock($1)'
+# Taken by the transaction archiving games, false while the stats are rebuilt
+ARCHIVE_LOCK_QUERY = 'SELECT pg_try_advisory_xact_lock_shared($1)'
+
+# Players with the highest rating ($1 - the number of players)
+LEADERBOARD_QUERY = '''
+SELECT
+    "User".tg_id AS "User_tg_id",
+    "User".name AS "User_name",
+    stats.rating AS "UserStats_rating",
+    stats.wins AS "UserStats_wins",
+    stats.losses AS "UserStats_losses",
+    stats.draws AS "UserStats_draws"
+FROM "UserStats" AS stats
+JOIN "User" ON "User".id = stats.user_id
+ORDER BY stats.rating DESC, stats.user_id
+LIMIT $1
+'''
+
+
+async def _query(operation: str, query, *args, connection=None):
+    """
+    Runs `pg.<operation>` timed as a database call of the current update
+
+    :param connection: connection of an already open transaction, timed as a part of it
+    """
+    if connection is not None:
+        return await getattr(connection, operation)(query, *args)
+    with db_call(operation):
+        return await getattr(pg, operation)(query, *args)
+
+
+@asynccontextmanager
+async def _transaction(connection=None):
+    """
+    Yields the connection of an already open transaction or opens a new one timed as a single database call
+    """
+    if connection is not None:
+        yield connection
+        return
+    with db_call('transaction'):
+        async with pg.transaction() as connection:
+            yield connection
+
+
+# Dialect of the queries compiled by asyncpgsa
+DIALECT = get_dialect()
+
+
+class CompiledQuery(NamedTuple):
+    """
+    SQL text with numbered parameters and the names of the bound values in the parameters order
+    """
+    text: str
+    params: Tuple[Tuple[str, Optional[Callable]], ...]
+
+    def bind(self, values: Dict[str, Any]) -> List:
+        """
+        :param values: values by the bound parameter name
+
+        :return: arguments of the query
+        """
+        args = []
+        for name, processor in self.params:
+            value = values[name]
+            args.append(value if processor is None else processor(value))
+        return args
+
+
+def compile_query(query: ClauseElement) -> CompiledQuery:
+    """
+    Compiles the query the way asyncpgsa does, keeping the bind processors instead of the values
+    """
+    compiled = query.compile(dialect=DIALECT)
+    names = sorted(compiled.binds)
+    text = compiled.string % {name: f'${number}' for number, name in enumerate(names, start=1)}
+    processors = compiled._bind_processors
+    return CompiledQuery(text, tuple((name, processors.get(name)) for name in names))
+
+
+# Compiled queries by the model, the kind of query and the names of filtered and set fields,
+# so SqlAlchemy compiles every shape once and asyncpg reuses the prepared statement of its text
+statements: TTLCache[CompiledQuery] = TTLCache(size=CacheConfig().query_cache_size, ttl=float('inf'))
+
+
+def _param(prefix: str, model, field_name: str) -> str:
+    return f'{prefix}_{model.__tablename__}_{field_name}'
+
+
+def _join_key(join: Tuple) -> Tuple:
+    """
+    Identifies a join without compiling it, join conditions are new objects on every call
+    """
+    *models, clause = join
+    if isinstance(clause, BinaryExpression) and isinstance(clause.left, Column) and isinstance(clause.right, Column):
+        clause = (
+            clause.left.table.name, clause.left.key, clause.operator.__name__,
+            clause.right.table.name, clause.right.key
+        )
+    else:
+        clause = str(clause)
+    return (*models, clause)
+
+
+def _type_name(column: Column) -> str:
+    return column.type.compile(dialect=DIALECT)
+
+
+def _array_processor(column: Column) -> Optional[Callable]:
+    processor = column.type.bind_processor(DIALECT)
+    if processor is None:
+        return None
+    return lambda values: [processor(value) for value in values]
+
+
+def _unnest(columns: List[Column]) -> str:
+    """
+    :return: unnest of arrays bound as $1, $2, ... with a row per element, one array per column
+    """
+    arrays = ', '.join(f'${number}::{_type_name(column)}[]' for number, column in enumerate(columns, start=1))
+    return f'unnest({arrays})'
+
+
+def _bulk_query(text: str, columns: List[Column]) -> CompiledQuery:
+    return CompiledQuery(text, tuple((column.name, _array_processor(column)) for column in columns))
+
+
+def _field_names(rows: List[Dict[str, Any]]) -> Tuple[str, ...]:
+    field_names = tuple(sorted(rows[0]))
+    if any(tuple(sorted(row)) != field_names for row in rows):
+        raise ValueError('All rows must set the same fields')
+    return field_names
+
+
+def _move_args(game_id: int, user_tg_id: int, position: int, geometry: Geometry) -> Tuple:
+    lines = geometry.lines_through[position] if 0 <= position < geometry.cells else ()
+    return game_id, user_tg_id, position, [to_signed(line) for line in lines], datetime.now()
+
+
+def _default(column: Column):
+    return column.default.arg({}) if column.default.is_callable else column.default.arg
+
+
+def _labeled_columns(model) -> List:
+    return [column.label('_'.join((model.__tablename__, column.description))) for column in model.__table__.columns]
+
 
 class BaseDAO:
-    async def _generate_select(self, joins: Optional[List[Tuple]] = (), **filters) -> sql.Select:
+    def _cached(self, key: Tuple, build: Callable[[], CompiledQuery]) -> CompiledQuery:
+        """
+        :param key: shape of the query, `build` is only called if it isn't cached
+        """
+        key = (self.model, *key)
+        statement = statements.get(key)
+        if statement is None:
+            statement = build()
+            statements.set(key, statement)
+        return statement
+
+    def _compiled(self, key: Tuple, build: Callable[[], ClauseElement]) -> CompiledQuery:
+        return self._cached(key, lambda: compile_query(build()))
+
+    def _generate_select(self, joins: Optional[List[Tuple]] = (), filters: Tuple = ()) -> sql.Select:
         """
-        :param filters: fields to filter
+        :param joins: list of joins
+        :param filters: (model, field name, is null) of fields to filter, values are bound
+            as `filter_<table>_<field>` parameters
 
         :return: SqlAlchemy Select object
         """
         to_select_models = {self.model, *chain(*[join[:-1] for join in joins])}
         to_select = []
         for model in to_select_models:
-            to_select.extend(
-                [
-                    field.label('_'.join((model.__tablename__, field.description)))
-                    for field in list(model.__table__.columns)
-                ]
-            )
+            to_select.extend(_labeled_columns(model))
 
         fields_to_filter = []
-        for field_name, field_value in filters.items():
-            if isinstance(field_value, tuple):
-                model, value = field_value
-                fields_to_filter.append(getattr(model, field_name) == value)
-            else:
-                fields_to_filter.append(getattr(self.model, field_name) == field_value)
+        for model, field_name, is_null in filters:
+            field = getattr(model, field_name)
+            fields_to_filter.append(
+                field.is_(None) if is_null else field == sql.bindparam(_param('filter', model, field_name))
+            )
         query = sql.select(to_select)
         for join_args in joins:
             join = sql.join(*join_args)
@@ -44,14 +545,64 @@ class BaseDAO:
 
         return query.where(sql.and_(*fields_to_filter))
 
-    async def create(self, **fields) -> Record:
-        query = sql.insert(self.model).returning(
-            *[
-                column.label('_'.join((self.model.__tablename__, column.description)))
+    def _select(self, joins: Optional[List[Tuple]], fields: Dict[str, Any]) -> Tuple[str, List]:
+        filters = []
+        values = {}
+        for field_name, field_value in fields.items():
+            model, value = field_value if isinstance(field_value, tuple) else (self.model, field_value)
+            filters.append((model, field_name, value is None))
+            values[_param('filter', model, field_name)] = value
+        filters = tuple(filters)
+
+        statement = self._compiled(
+            ('select', tuple(map(_join_key, joins)), filters),
+            lambda: self._generate_select(joins, filters)
+        )
+        return statement.text, statement.bind(values)
+
+    def _values(self, fields: Dict[str, Any]) -> Dict:
+        return {
+            field_name: sql.bindparam(_param('value', self.model, field_name), type_=self.model.__table__.c[field_name].type)
+            for field_name in fields
+        }
+
+    def _update(self, filter_field: str, filter_value, fields: Dict[str, Any]) -> Tuple[str, List]:
+        statement = self._compiled(
+            ('update', filter_field, tuple(sorted(fields))),
+            lambda: sql.update(self.model).returning(self.model.id).where(
+                getattr(self.model, filter_field) == sql.bindparam(_param('filter', self.model, filter_field))
+            ).values(self._values(fields))
+        )
+        values = {_param('value', self.model, field_name): value for field_name, value in fields.items()}
+        values[_param('filter', self.model, filter_field)] = filter_value
+        return statement.text, statement.bind(values)
+
+    def _with_defaults(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Python side defaults are bound like the set fields, as asyncpgsa would add them
+        """
+        return {
+            **{
+                column.name: _default(column)
                 for column in self.model.__table__.columns
-            ]
-        ).values(**fields)
-        return await pg.fetchrow(query)
+                if column.default is not None and column.name not in fields
+            },
+            **fields
+        }
+
+    def _insert(self, fields: Dict[str, Any]) -> Tuple[str, List]:
+        fields = self._with_defaults(fields)
+        statement = self._compiled(
+            ('insert', tuple(sorted(fields))),
+            lambda: sql.insert(self.model).returning(*_labeled_columns(self.model)).values(self._values(fields))
+        )
+        return statement.text, statement.bind(
+            {_param('value', self.model, field_name): value for field_name, value in fields.items()}
+        )
+
+    async def create(self, **fields) -> Record:
+        query, args = self._insert(fields)
+        return await _query('fetchrow', query, *args)
 
     async def get_or_create(self, joins: Optional[List[Tuple]] = (), **fields) -> Record:
         record = await self.get(joins, **fields)
@@ -67,8 +618,8 @@ class BaseDAO:
 
         :return: Record object
         """
-        query = await self._generate_select(joins=joins, **fields)
-        return await pg.fetchrow(query)
+        query, args = self._select(joins, fields)
+        return await _query('fetchrow', query, *args)
 
     async def get_many(self, joins: Optional[List] = (), **fields) -> List[Record]:
         """
@@ -77,8 +628,8 @@ class BaseDAO:
 
         :return List of Record objects
         """
-        query = await self._generate_select(joins=joins, **fields)
-        return await pg.fetch(query)
+        query, args = self._select(joins, fields)
+        return await _query('fetch', query, *args)
 
     async def update_by_id(self, record_id, **fields) -> Record:
         """
@@ -87,16 +638,121 @@ class BaseDAO:
 
         :return SqlAlchemy model record
         """
-
-        query = sql.update(self.model).returning(self.model.id).where(self.model.id == record_id).values(fields)
-        return await pg.fetchrow(query)
+        query, args = self._update('id', record_id, fields)
+        return await _query('fetchrow', query, *args)
 
     async def delete_by_id(self, record_id: int) -> None:
         """
         :param record_id: database record ID
         """
-        query = sql.delete(User).where(self.model.id == record_id)
-        return await pg.fetchrow(query)
+        statement = self._compiled(
+            ('delete',),
+            lambda: sql.delete(self.model).where(self.model.id == sql.bindparam(_param('filter', self.model, 'id')))
+        )
+        return await _query('fetchrow', statement.text, *statement.bind({_param('filter', self.model, 'id'): record_id}))
+
+    async def create_many(self, rows: List[Dict[str, Any]], connection=None) -> List[Record]:
+        """
+        Creates all rows in a single statement
+
+        :param rows: fields of every row, all rows set the same fields
+        :param connection: connection of an already open transaction
+
+        :return: created records
+        """
+        if not rows:
+            return []
+        rows = [self._with_defaults(row) for row in rows]
+        field_names = _field_names(rows)
+        table = self.model.__table__
+
+        def build():
+            columns = [table.c[field_name] for field_name in field_names]
+            names = ', '.join(f'"{field_name}"' for field_name in field_names)
+            returning = ', '.join(f'"{column.name}" AS "{table.name}_{column.name}"' for column in table.columns)
+            return _bulk_query(
+                f'INSERT INTO "{table.name}" ({names}) SELECT * FROM {_unnest(columns)} RETURNING {returning}',
+                columns
+            )
+
+        statement = self._cached(('insert_many', field_names), build)
+        args = statement.bind({field_name: [row[field_name] for row in rows] for field_name in field_names})
+        return await _query('fetch', statement.text, *args, connection=connection)
+
+    async def copy_many(self, rows: List[Dict[str, Any]], connection=None, table: Optional[str] = None) -> None:
+        """
+        Creates rows with COPY, for imports too large for `create_many`
+
+        :param rows: fields of every row, all rows set the same fields
+        :param connection: connection of an already open transaction
+        :param table: table with the columns of the model to copy to instead, e.g. a temporary one
+        """
+        if not rows:
+            return None
+        rows = [self._with_defaults(row) for row in rows]
+        field_names = _field_names(rows)
+        processors = [self.model.__table__.c[field_name].type.bind_processor(DIALECT) for field_name in field_names]
+        records = [
+            tuple(
+                row[field_name] if processor is None else processor(row[field_name])
+                for field_name, processor in zip(field_names, processors)
+            )
+            for row in rows
+        ]
+        table = table or self.model.__tablename__
+        if connection is not None:
+            return await connection.copy_records_to_table(table, records=records, columns=field_names)
+        with db_call('copy'):
+            async with pg.pool.acquire() as connection:
+                await connection.copy_records_to_table(table, records=records, columns=field_names)
+
+    async def update_many(self, rows: Dict[int, Dict[str, Any]], connection=None) -> None:
+        """
+        Sets per row values in a single statement for every set of updated fields
+
+        :param rows: fields to update by the database record ID
+        :param connection: connection of an already open transaction
+        """
+        shapes: Dict[Tuple[str, ...], Dict[int, Dict[str, Any]]] = {}
+        for record_id, fields in rows.items():
+            if fields:
+                shapes.setdefault(tuple(sorted(fields)), {})[record_id] = fields
+        if connection is None and len(shapes) > 1:
+            async with _transaction() as connection:
+                return await self.update_many(rows, connection=connection)
+
+        table = self.model.__table__
+        for field_names, shape_rows in shapes.items():
+            def build():
+                columns = [table.c.id, *(table.c[field_name] for field_name in field_names)]
+                assignments = ', '.join(f'"{name}" = row."{name}"' for name in field_names)
+                row_columns = ', '.join(f'"{column.name}"' for column in columns)
+                return _bulk_query(
+                    f'UPDATE "{table.name}" SET {assignments} '
+                    f'FROM {_unnest(columns)} AS row({row_columns}) WHERE "{table.name}".id = row.id',
+                    columns
+                )
+
+            statement = self._cached(('update_many', field_names), build)
+            values = {'id': list(shape_rows)}
+            values.update(
+                (field_name, [fields[field_name] for fields in shape_rows.values()]) for field_name in field_names
+            )
+            await _query('execute', statement.text, *statement.bind(values), connection=connection)
+
+    async def delete_many(self, record_ids: List[int], connection=None) -> None:
+        """
+        :param record_ids: database record IDs
+        :param connection: connection of an already open transaction
+        """
+        if not record_ids:
+            return None
+        table = self.model.__table__
+        statement = self._cached(
+            ('delete_many',),
+            lambda: _bulk_query(f'DELETE FROM "{table.name}" WHERE id = ANY($1::{_type_name(table.c.id)}[])', [table.c.id])
+        )
+        return await _query('execute', statement.text, *statement.bind({'id': record_ids}), connection=connection)
 
 
 class UserDAO(BaseDAO):
@@ -110,14 +766,137 @@ class UserDAO(BaseDAO):
 
         :return User record
         """
-        query = sql.update(User).returning(User.id).where(User.tg_id == tg_id).values(fields)
-        return await pg.fetchrow(query)
+        query, args = self._update('tg_id', tg_id, fields)
+        return await _query('fetchrow', query, *args)
+
+    def _upsert(self, tg_id: int, fields: Dict[str, Any]) -> Tuple[str, List]:
+        values = self._with_defaults({'tg_id': tg_id, **fields})
+
+        def build():
+            query = insert(User).values(self._values(values))
+            return query.on_conflict_do_update(
+                index_elements=[User.tg_id],
+                set_={field_name: query.excluded[field_name] for field_name in fields}
+            ).returning(*_labeled_columns(User))
+
+        statement = self._compiled(('upsert', tuple(sorted(fields))), build)
+        return statement.text, statement.bind(
+            {_param('value', User, field_name): value for field_name, value in values.items()}
+        )
+
+    async def upsert(self, tg_id: int, **fields) -> Record:
+        """
+        Creates the user or updates fields of the existing one in a single statement
+
+        :param tg_id: Telegram ID of the user
+        :param fields: Fields to set
+
+        :return User record
+        """
+        query, args = self._upsert(tg_id, fields)
+        return await _query('fetchrow', query, *args)
 
 
 class TicTacToeGameDAO(BaseDAO):
     def __init__(self):
         self.model = TicTacToeGame
 
+    async def apply_move(
+            self,
+            game_id: int,
+            user_tg_id: int,
+            position: int,
+            geometry: Geometry = CLASSIC
+    ) -> Optional[Record]:
+        """
+        Validates and applies a move in a single statement, see APPLY_MOVE_QUERY
+
+        :param game_id: database ID of the game
+        :param user_tg_id: Telegram ID of the moving user
+        :param position: cell of the move
+        :param geometry: board of the game
+
+        :return: Record with the new board, the winner sign and whether the game is finished,
+            None if the move was rejected
+        """
+        return await _query('fetchrow', APPLY_MOVE_QUERY, *_move_args(game_id, user_tg_id, position, geometry))
+
+    async def apply_moves(
+            self,
+            moves: List[Tuple[int, int, int, Geometry]],
+            connection=None
+    ) -> List[Tuple[int, int, int, Geometry]]:
+        """
+        Applies moves in order in a single batch, rejected moves are skipped
+
+        :param moves: (game_id, user_tg_id, position, geometry) tuples
+        :param connection: connection of an already open transaction
+
+        :return: rejected moves
+        """
+        async with _transaction(connection) as connection:
+            await connection.executemany(APPLY_MOVE_QUERY, [_move_args(*move) for move in moves])
+            rejected = await connection.fetch(
+                REJECTED_MOVES_QUERY,
+                [move[0] for move in moves],
+                [move[1] for move in moves],
+                [move[2] for move in moves]
+            )
+        return [moves[record['index'] - 1] for record in rejected]
+
+    async def expire(self, before: datetime, limit: int, connection=None) -> List[Record]:
+        """
+        Expires games nobody finished, see EXPIRE_QUERY
+
+        :param before: games not updated since are expired
+        :param limit: maximum number of games to expire
+        :param connection: connection of an already open transaction
+
+        :return: Records with the ID and the inline message ID of the expired games
+        """
+        return await _query('fetch', EXPIRE_QUERY, before, datetime.now(), limit, connection=connection)
+
+    async def archive(self, before: datetime, limit: int, connection=None) -> Optional[Record]:
+        """
+        Moves ended games to the archive in a single statement, see ARCHIVE_QUERY
+
+        :param before: games ended before are archived
+        :param limit: maximum number of games to archive
+        :param connection: connection of an already open transaction
+
+        :return: Record with the number of archived games, players and steps,
+            None if the stats are being rebuilt, see STATS_REBUILD_LOCK
+        """
+        async with _transaction(connection) as connection:
+            if not await connection.fetchval(ARCHIVE_LOCK_QUERY, STATS_REBUILD_LOCK):
+                return None
+            return await connection.fetchrow(ARCHIVE_QUERY, before, limit)
+
+    def export(
+            self,
+            connection,
+            batch_size: int,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None,
+            statuses: Optional[List[EnumStatus]] = None
+    ):
+        """
+        :param connection: connection of an open transaction
+        :param batch_size: games fetched per round trip
+        :param since: games created earlier are skipped
+        :param until: games created since are skipped
+        :param statuses: games with another status are skipped
+
+        :return: cursor over the games, archived and live, in the order they were created, see EXPORT_QUERY
+        """
+        return connection.cursor(
+            EXPORT_QUERY,
+            since,
+            until,
+            statuses and [status.name for status in statuses],
+            prefetch=batch_size
+        )
+
 
 class TicTacToePlayerDAO(BaseDAO):
     def __init__(self):
@@ -127,3 +906,111 @@ class TicTacToePlayerDAO(BaseDAO):
 class TicTacToeStepDAO(BaseDAO):
     def __init__(self):
         self.model = TicTacToeStep
+
+
+class UserStatsDAO(BaseDAO):
+    def __init__(self):
+        self.model = UserStats
+
+    async def record_results(self, game_ids: List[int], k_factor: float, connection=None) -> None:
+        """
+        Adds the results of finished games to the stats of their players in order, see RECORD_RESULT_QUERY
+
+        :param game_ids: database IDs of the games
+        :param k_factor: largest rating change per game
+        :param connection: connection of the transaction finishing the games
+        """
+        updated = datetime.now()
+        async with _transaction(connection) as connection:
+            await connection.executemany(
+                RECORD_RESULT_QUERY,
+                [(game_id, k_factor, INITIAL_RATING, updated) for game_id in game_ids]
+            )
+
+    async def top(self, limit: int) -> List[Record]:
+        """
+        :return: Records with the name, the Telegram ID and the stats of the players with the highest rating
+        """
+        return await _query('fetch', LEADERBOARD_QUERY, limit)
+
+    async def history(self, connection, batch_size: int):
+        """
+        Keeps the IDs of the games read in the temporary table counted_games
+        and holds STATS_REBUILD_LOCK for the session, see `replace_all`
+
+        :param connection: connection of an open repeatable read transaction
+        :param batch_size: games fetched per round trip
+
+        :return: cursor over the finished games between players in the order they finished
+        """
+        await connection.execute(REBUILD_LOCK_QUERY, STATS_REBUILD_LOCK)
+        await connection.execute(COUNTED_GAMES_QUERY)
+        return connection.cursor(HISTORY_QUERY, prefetch=batch_size)
+
+    async def replace_all(self, rows: List[Dict[str, Any]], k_factor: float, connection) -> int:
+        """
+        Copies the stats to a temporary table, then replaces the stats with them
+        and adds the results of the games finished since `history` was read, releasing STATS_REBUILD_LOCK.
+        Writes of the stats only wait for the replacement
+
+        :param rows: stats of every player
+        :param k_factor: largest rating change per game
+        :param connection: connection `history` was read on, with no open transaction
+
+        :return: number of games finished since
+        """
+        table = self.model.__tablename__
+        try:
+            await connection.execute(f'CREATE TEMPORARY TABLE rebuilt_stats (LIKE "{table}" INCLUDING DEFAULTS)')
+            await self.copy_many(rows, connection=connection, table='rebuilt_stats')
+            async with connection.transaction():
+                await connection.execute(f'LOCK TABLE "{table}" IN SHARE ROW EXCLUSIVE MODE')
+                await connection.execute(f'DELETE FROM "{table}"')
+                await connection.execute(f'INSERT INTO "{table}" SELECT * FROM rebuilt_stats')
+                game_ids = [record['id'] for record in await connection.fetch(UNCOUNTED_GAMES_QUERY)]
+                if game_ids:
+                    await self.record_results(game_ids, k_factor, connection=connection)
+        finally:
+            await connection.execute('DROP TABLE IF EXISTS rebuilt_stats, counted_games')
+            await connection.execute(REBUILD_UNLOCK_QUERY, STATS_REBUILD_LOCK)
+        return len(game_ids)
+
+
+async def warm_up_connection(connection) -> None:
+    """
+    Prepares the statements of the hot path on a new pooled connection, so the first updates don't wait for it.
+    They are run with placeholder values in a transaction rolled back, prepared statements outlive it
+    """
+    game_dao, player_dao, stats_dao = TicTacToeGameDAO(), TicTacToePlayerDAO(), UserStatsDAO()
+    statements = [
+        game_dao._select((), {'id': 0}),
+        player_dao._select([(TicTacToePlayer, User, TicTacToePlayer.user_id == User.id)], {'game_id': 0}),
+        stats_dao._select((), {'user_id': 0}),
+        UserDAO()._upsert(0, {'name': ''}),
+        game_dao._insert({
+            'current_step_user_id': None,
+            'width': CLASSIC.width,
+            'height': CLASSIC.height,
+            'win_length': CLASSIC.win_length,
+            'inline_message_id': ''
+        }),
+        player_dao._insert({'user_id': 0, 'game_id': 0, 'sign': EnumSign.cross}),
+    ]
+    transaction = connection.transaction()
+    await transaction.start()
+    try:
+        for query, args in statements:
+            # Inserts referencing missing rows fail after the statement is prepared
+            try:
+                async with connection.transaction():
+                    await connection.fetch(query, *args)
+            except PostgresError:
+                pass
+        await game_dao.update_many(
+            {0: {'current_step_user_id': None, 'status': EnumStatus.in_progress, 'updated': datetime.now()}},
+            connection=connection
+        )
+        await game_dao.apply_moves([(0, 0, 0, CLASSIC)], connection=connection)
+        await stats_dao.record_results([0], 0, connection=connection)
+    finally:
+        await transaction.rollback()
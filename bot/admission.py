@@ -0,0 +1,87 @@
+"""
+Admission control of callback queries: taps above the limits of the user, the game
+or the whole bot are answered right away, without touching the database
+"""
+from contextvars import ContextVar
+from typing import Hashable, Optional
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import CallbackQuery
+
+from cache import TTLCache
+from metrics import Counter
+from rate_limit import TokenBucket
+
+ADMITTED = Counter('admission_admitted_total', 'Callback queries let through to the handlers')
+REJECTED = Counter('admission_rejected_total', 'Callback queries rejected by the exceeded limit', ('limit',))
+
+# Set while catching up on the backlog, taps queued while the bot was down aren't limited
+exempt: ContextVar[bool] = ContextVar('admission_exempt', default=False)
+
+
+class _Limit:
+    """
+    Token buckets per key. A bucket is forgotten once it would be full again,
+    so a forgotten bucket is the same as a new one
+    """
+
+    def __init__(self, rate: float, burst: float, size: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: TTLCache[TokenBucket] = TTLCache(size, burst / rate)
+
+    def consume(self, key: Hashable) -> float:
+        """
+        :return: 0 if admitted, seconds until the key is admitted again otherwise
+        """
+        bucket = self._buckets.get(key) or TokenBucket(self.rate, self.burst)
+        self._buckets.set(key, bucket)
+        return bucket.consume()
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """
+    Passes the seconds to wait to handlers as `retry_after` when a callback query exceeds a limit,
+    checked in the order user, game, bot, so that a rejected tap doesn't take tokens of the next limits.
+    Limits with zero rate are off. Goes after `CallbackDataMiddleware`, the game is taken from the callback data
+    """
+
+    def __init__(
+            self,
+            user_rate: float,
+            user_burst: float,
+            game_rate: float,
+            game_burst: float,
+            rate: float,
+            burst: float,
+            size: int
+    ):
+        super().__init__()
+        self._user = user_rate and _Limit(user_rate, user_burst, size)
+        self._game = game_rate and _Limit(game_rate, game_burst, size)
+        self._global = rate and TokenBucket(rate, burst)
+
+    def _check(self, query: CallbackQuery, data: dict) -> Optional[str]:
+        """
+        :return: name of the exceeded limit, None if admitted
+        """
+        if self._user and (wait := self._user.consume(query.from_user.id)):
+            data['retry_after'] = wait
+            return 'user'
+        game = query.inline_message_id or getattr(data.get('callback_data'), 'game_id', None)
+        if self._game and game is not None and (wait := self._game.consume(game)):
+            data['retry_after'] = wait
+            return 'game'
+        if self._global and (wait := self._global.consume()):
+            data['retry_after'] = wait
+            return 'global'
+        return None
+
+    async def on_pre_process_callback_query(self, query: CallbackQuery, data: dict):
+        if exempt.get():
+            return None
+        limit = self._check(query, data)
+        if limit is None:
+            ADMITTED.inc()
+        else:
+            REJECTED.labels(limit).inc()
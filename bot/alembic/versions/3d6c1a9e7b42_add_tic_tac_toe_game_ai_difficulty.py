@@ -0,0 +1,28 @@
+"""Add TicTacToeGame ai_difficulty
+
+Revision ID: 3d6c1a9e7b42
+Revises: 5f3b9d0e8a21
+Create Date: 2026-10-18 17:48:03.512904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d6c1a9e7b42'
+down_revision = '5f3b9d0e8a21'
+branch_labels = None
+depends_on = None
+
+enum_difficulty = sa.Enum('random', 'imperfect', 'perfect', name='enumdifficulty')
+
+
+def upgrade():
+    enum_difficulty.create(op.get_bind())
+    op.add_column('TicTacToeGame', sa.Column('ai_difficulty', enum_difficulty, nullable=True))
+
+
+def downgrade():
+    op.drop_column('TicTacToeGame', 'ai_difficulty')
+    enum_difficulty.drop(op.get_bind())
@@ -0,0 +1,65 @@
+"""Add indexes and board columns
+
+Revision ID: 5f3b9d0e8a21
+Revises: c2a7e41f5d10
+Create Date: 2026-10-18 14:02:17.184306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f3b9d0e8a21'
+down_revision = 'c2a7e41f5d10'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 1000
+
+INDEXES = (
+    ('ix_TicTacToePlayer_game_id', 'TicTacToePlayer', 'game_id'),
+    ('ix_TicTacToePlayer_user_id', 'TicTacToePlayer', 'user_id'),
+    ('ix_TicTacToeStep_player_id', 'TicTacToeStep', 'player_id'),
+)
+
+# Packs the steps of games with IDs in [start, end) into the board columns
+BACKFILL_QUERY = sa.text('''
+    UPDATE "TicTacToeGame" AS game
+    SET cross_board = board.cross_board, circle_board = board.circle_board
+    FROM (
+        SELECT
+            player.game_id,
+            COALESCE(bit_or(1 << step.position) FILTER (WHERE player.sign = 'cross'), 0) AS cross_board,
+            COALESCE(bit_or(1 << step.position) FILTER (WHERE player.sign = 'circle'), 0) AS circle_board
+        FROM "TicTacToeStep" AS step
+        JOIN "TicTacToePlayer" AS player ON player.id = step.player_id
+        WHERE player.game_id >= :start AND player.game_id < :end
+        GROUP BY player.game_id
+    ) AS board
+    WHERE game.id = board.game_id
+''')
+
+
+def upgrade():
+    # Constant defaults don't rewrite the table
+    op.add_column('TicTacToeGame', sa.Column('circle_board', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('TicTacToeGame', sa.Column('cross_board', sa.Integer(), server_default='0', nullable=False))
+
+    # Indexes are built without locking writes, and every backfill batch commits on its own
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            op.create_index(name, table, [column], unique=False, postgresql_concurrently=True)
+
+        connection = op.get_bind()
+        last_id = connection.execute(sa.text('SELECT max(id) FROM "TicTacToeGame"')).scalar() or 0
+        for start in range(1, last_id + 1, BACKFILL_BATCH_SIZE):
+            connection.execute(BACKFILL_QUERY, start=start, end=start + BACKFILL_BATCH_SIZE)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    op.drop_column('TicTacToeGame', 'cross_board')
+    op.drop_column('TicTacToeGame', 'circle_board')
@@ -0,0 +1,36 @@
+"""Add TicTacToeGame geometry
+
+Revision ID: 8b1e5c3f9a07
+Revises: 3d6c1a9e7b42
+Create Date: 2026-10-18 18:21:44.093518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e5c3f9a07'
+down_revision = '3d6c1a9e7b42'
+branch_labels = None
+depends_on = None
+
+BOARD_COLUMNS = ('cross_board', 'circle_board')
+GEOMETRY_COLUMNS = ('width', 'height', 'win_length')
+
+
+def upgrade():
+    for column in GEOMETRY_COLUMNS:
+        op.add_column('TicTacToeGame', sa.Column(column, sa.Integer(), server_default='3', nullable=False))
+    for column in BOARD_COLUMNS:
+        op.alter_column('TicTacToeGame', column, type_=sa.BigInteger(), existing_type=sa.Integer(),
+                        existing_nullable=False, existing_server_default='0')
+
+
+def downgrade():
+    # Fails with integer out of range while boards over 31 cells are stored
+    for column in BOARD_COLUMNS:
+        op.alter_column('TicTacToeGame', column, type_=sa.Integer(), existing_type=sa.BigInteger(),
+                        existing_nullable=False, existing_server_default='0')
+    for column in reversed(GEOMETRY_COLUMNS):
+        op.drop_column('TicTacToeGame', column)
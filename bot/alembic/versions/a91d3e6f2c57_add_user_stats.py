@@ -0,0 +1,41 @@
+"""Add UserStats
+
+Revision ID: a91d3e6f2c57
+Revises: e4f7a2c9b318
+Create Date: 2026-10-18 20:52:31.270915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a91d3e6f2c57'
+down_revision = 'e4f7a2c9b318'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled from the games played so far with `python rebuild_stats.py`
+    op.create_table('UserStats',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created', sa.DateTime(), server_default=sa.text('NOW()'), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('wins', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('losses', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('draws', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('streak', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('rating', sa.Float(), server_default='1000', nullable=False),
+    sa.Column('updated', sa.DateTime(), server_default=sa.text('NOW()'), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['User.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_UserStats_user_id', 'UserStats', ['user_id'], unique=True)
+    op.create_index('ix_UserStats_rating', 'UserStats', ['rating'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_UserStats_rating', table_name='UserStats')
+    op.drop_index('ix_UserStats_user_id', table_name='UserStats')
+    op.drop_table('UserStats')
@@ -0,0 +1,43 @@
+"""Index TicTacToeGame update time separately for unfinished and ended games
+
+Revision ID: b5c8e2d4f716
+Revises: a91d3e6f2c57
+Create Date: 2026-10-18 21:04:51.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5c8e2d4f716'
+down_revision = 'a91d3e6f2c57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The index on the status and the time can't return games of two statuses in the order of the time,
+    # so batches to expire and to archive sorted all the matching games when many were waiting
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_TicTacToeGame_unfinished_updated', 'TicTacToeGame', ['updated'],
+            unique=False, postgresql_concurrently=True,
+            postgresql_where=sa.text("status IN ('initial', 'in_progress')")
+        )
+        op.create_index(
+            'ix_TicTacToeGame_ended_updated', 'TicTacToeGame', ['updated'],
+            unique=False, postgresql_concurrently=True,
+            postgresql_where=sa.text("status IN ('finished', 'expired')")
+        )
+        op.drop_index('ix_TicTacToeGame_status_updated', table_name='TicTacToeGame', postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_TicTacToeGame_status_updated', 'TicTacToeGame', ['status', 'updated'],
+            unique=False, postgresql_concurrently=True
+        )
+        op.drop_index('ix_TicTacToeGame_ended_updated', table_name='TicTacToeGame', postgresql_concurrently=True)
+        op.drop_index('ix_TicTacToeGame_unfinished_updated', table_name='TicTacToeGame', postgresql_concurrently=True)
@@ -0,0 +1,72 @@
+"""Add TicTacToeGame archive and expiration
+
+Revision ID: e4f7a2c9b318
+Revises: 8b1e5c3f9a07
+Create Date: 2026-10-18 19:37:12.604281
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4f7a2c9b318'
+down_revision = '8b1e5c3f9a07'
+branch_labels = None
+depends_on = None
+
+enum_status = postgresql.ENUM('initial', 'in_progress', 'finished', 'expired', name='enumstatus', create_type=False)
+enum_sign = postgresql.ENUM('cross', 'circle', name='enumsign', create_type=False)
+enum_difficulty = postgresql.ENUM('random', 'imperfect', 'perfect', name='enumdifficulty', create_type=False)
+
+
+def upgrade():
+    # A value added to an enum can't be used in the transaction adding it
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE enumstatus ADD VALUE IF NOT EXISTS 'expired'")
+
+    op.add_column('TicTacToeGame', sa.Column('inline_message_id', sa.String(), nullable=True))
+    op.add_column('TicTacToeGame', sa.Column('updated', sa.DateTime(), server_default=sa.text('NOW()'), nullable=False))
+    op.create_table('TicTacToeGameArchive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('created', sa.DateTime(), server_default=sa.text('NOW()'), nullable=True),
+    sa.Column('finished', sa.DateTime(), nullable=False),
+    sa.Column('status', enum_status, nullable=False),
+    sa.Column('width', sa.Integer(), nullable=False),
+    sa.Column('height', sa.Integer(), nullable=False),
+    sa.Column('win_length', sa.Integer(), nullable=False),
+    sa.Column('ai_difficulty', enum_difficulty, nullable=True),
+    sa.Column('cross_user_id', sa.Integer(), nullable=True),
+    sa.Column('circle_user_id', sa.Integer(), nullable=True),
+    sa.Column('winner', enum_sign, nullable=True),
+    sa.Column('moves', postgresql.ARRAY(sa.Integer()), nullable=False),
+    sa.ForeignKeyConstraint(['circle_user_id'], ['User.id'], ),
+    sa.ForeignKeyConstraint(['cross_user_id'], ['User.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_TicTacToeGameArchive_cross_user_id', 'TicTacToeGameArchive', ['cross_user_id'], unique=False)
+    op.create_index('ix_TicTacToeGameArchive_circle_user_id', 'TicTacToeGameArchive', ['circle_user_id'], unique=False)
+
+    # Finds games to expire and to archive without locking writes
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_TicTacToeGame_status_updated', 'TicTacToeGame', ['status', 'updated'],
+            unique=False, postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    # Archived games are dropped with the archive
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_TicTacToeGame_status_updated', table_name='TicTacToeGame', postgresql_concurrently=True)
+    op.drop_table('TicTacToeGameArchive')
+    op.drop_column('TicTacToeGame', 'updated')
+    op.drop_column('TicTacToeGame', 'inline_message_id')
+
+    # Enum values can't be dropped, so the type is created again without it
+    op.execute("UPDATE \"TicTacToeGame\" SET status = 'finished' WHERE status = 'expired'")
+    op.execute('ALTER TYPE enumstatus RENAME TO enumstatus_old')
+    sa.Enum('initial', 'in_progress', 'finished', name='enumstatus').create(op.get_bind())
+    op.execute('ALTER TABLE "TicTacToeGame" ALTER COLUMN status TYPE enumstatus USING status::text::enumstatus')
+    op.execute('DROP TYPE enumstatus_old')
@@ -0,0 +1,107 @@
+"""
+Per-move cost of win detection: the original list-of-lists check against the bitboard on the classic board,
+and on every board variant the incremental check of the lines through the last move against a scan
+of all winning lines
+
+    python -m benchmarks.check_win
+"""
+import random
+import timeit
+from typing import Dict, List, Optional, Tuple
+
+from games.board import CLASSIC, VARIANTS, Board, Geometry, check_win
+
+
+async def legacy_check_win(steps: Dict[int, str]) -> Optional[str]:
+    base_field = [[None for _ in range(3)] for _ in range(3)]
+    for position, sign in steps.items():
+        base_field[position // 3][position % 3] = sign
+
+    def check_row(row):
+        sign = row[0]
+        return sign if all(item == sign and item for item in row) else None
+
+    for field in (base_field, zip(*base_field)):
+        for row in field:
+            if sign := check_row(row):
+                return sign
+
+    main_diagonal = [base_field[i][i] for i in range(3)]
+    side_diagonal = [row[index] for row, index in zip(base_field, range(-1, -4, -1))]
+
+    for diagonal in (main_diagonal, side_diagonal):
+        if sign := check_row(diagonal):
+            return sign
+
+    return None
+
+
+def random_games(count: int, geometry: Geometry = CLASSIC, seed: int = 0) -> List[List[Tuple[int, str]]]:
+    generator = random.Random(seed)
+    games = []
+    for _ in range(count):
+        positions = list(range(geometry.cells))
+        generator.shuffle(positions)
+        games.append([(position, 'cross' if index % 2 == 0 else 'circle') for index, position in enumerate(positions)])
+    return games
+
+
+def run_legacy(games) -> int:
+    moves = 0
+    for game in games:
+        steps = {}
+        for position, sign in game:
+            steps[position] = sign
+            moves += 1
+            coroutine = legacy_check_win(steps)
+            try:
+                coroutine.send(None)
+            except StopIteration as result:
+                if result.value or len(steps) == 9:
+                    break
+    return moves
+
+
+def run_bitboard(games, geometry: Geometry = CLASSIC) -> int:
+    moves = 0
+    for game in games:
+        board = Board(geometry=geometry)
+        for position, sign in game:
+            board = board.place(position, sign)
+            moves += 1
+            if check_win(board, position) or board.is_full:
+                break
+    return moves
+
+
+def run_full_scan(games, geometry: Geometry = CLASSIC) -> int:
+    moves = 0
+    for game in games:
+        board = Board(geometry=geometry)
+        for position, sign in game:
+            board = board.place(position, sign)
+            moves += 1
+            if board.winner() or board.is_full:
+                break
+    return moves
+
+
+def measure(name: str, function, games, repeat: int) -> None:
+    moves = function(games)
+    best = min(timeit.repeat(lambda: function(games), number=1, repeat=repeat))
+    print(f'{name:<24} {best / moves * 1e9:8.0f} ns/move ({moves} moves)')
+
+
+def main(games_count: int = 10000, repeat: int = 5):
+    games = random_games(games_count)
+    measure('legacy 3x3', run_legacy, games, repeat)
+    for geometry in VARIANTS:
+        # Larger boards have more moves per game
+        games = random_games(games_count * 9 // geometry.cells, geometry)
+        label = f'{geometry.width}x{geometry.height}/{geometry.win_length}'
+        measure(f'full scan {label}', lambda games: run_full_scan(games, geometry), games, repeat)
+        measure(f'incremental {label}', lambda games: run_bitboard(games, geometry), games, repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Time the DAOs spend turning a call into SQL text and arguments: SqlAlchemy queries compiled
+by asyncpgsa on every call, as the DAOs did before, against the statement cache. No database is needed:
+
+    python -m benchmarks.dao_compile --calls 20000
+"""
+import argparse
+import time
+from typing import Callable, Dict
+
+from asyncpgsa.connection import compile_query
+from sqlalchemy import sql
+from sqlalchemy.dialects.postgresql import insert
+
+from DAO import TicTacToeGameDAO, TicTacToePlayerDAO, UserDAO, _labeled_columns, statements
+from models import EnumSign, TicTacToeGame, TicTacToePlayer, User
+
+
+def compiled_every_call() -> Dict[str, Callable]:
+    def get_game():
+        query = sql.select(_labeled_columns(TicTacToeGame))
+        return compile_query(query.where(sql.and_(TicTacToeGame.id == 1)))
+
+    def get_players():
+        query = sql.select(_labeled_columns(TicTacToePlayer) + _labeled_columns(User))
+        query = query.select_from(sql.join(TicTacToePlayer, User, TicTacToePlayer.user_id == User.id))
+        return compile_query(query.where(sql.and_(TicTacToePlayer.game_id == 1)))
+
+    def create_player():
+        query = sql.insert(TicTacToePlayer).returning(*_labeled_columns(TicTacToePlayer))
+        return compile_query(query.values(user_id=1, game_id=1, sign=EnumSign.cross))
+
+    def update_game():
+        query = sql.update(TicTacToeGame).returning(TicTacToeGame.id).where(TicTacToeGame.id == 1)
+        return compile_query(query.values(current_step_user_id=1))
+
+    def upsert_user():
+        query = insert(User).values(tg_id=1, name='Player')
+        query = query.on_conflict_do_update(index_elements=[User.tg_id], set_={'name': query.excluded['name']})
+        return compile_query(query.returning(*_labeled_columns(User)))
+
+    return {
+        'get game': get_game,
+        'get players': get_players,
+        'create player': create_player,
+        'update game': update_game,
+        'upsert user': upsert_user,
+    }
+
+
+def cached() -> Dict[str, Callable]:
+    game_dao, player_dao, user_dao = TicTacToeGameDAO(), TicTacToePlayerDAO(), UserDAO()
+    return {
+        'get game': lambda: game_dao._select((), {'id': 1}),
+        'get players': lambda: player_dao._select(
+            [(TicTacToePlayer, User, TicTacToePlayer.user_id == User.id)],
+            {'game_id': 1}
+        ),
+        'create player': lambda: player_dao._insert({'user_id': 1, 'game_id': 1, 'sign': EnumSign.cross}),
+        'update game': lambda: game_dao._update('id', 1, {'current_step_user_id': 1}),
+        'upsert user': lambda: user_dao._upsert(1, {'name': 'Player'}),
+    }
+
+
+def measure(function: Callable, calls: int) -> float:
+    """
+    :return: microseconds per call
+    """
+    function()
+    started = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=5000)
+    arguments = parser.parse_args()
+
+    before, after = compiled_every_call(), cached()
+    print(f'{"query":<16} {"compiled, us":>14} {"cached, us":>12} {"speedup":>9}')
+    for name in before:
+        compiled_time = measure(before[name], arguments.calls)
+        cached_time = measure(after[name], arguments.calls)
+        print(f'{name:<16} {compiled_time:14.1f} {cached_time:12.1f} {compiled_time / cached_time:8.1f}x')
+    print(f'statement cache: {statements.stats()}')
+
+
+if __name__ == '__main__':
+    main()
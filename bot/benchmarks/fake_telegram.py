@@ -0,0 +1,259 @@
+"""
+Load test of the webhook mode against a local fake Telegram.
+
+The fake Bot API server records outgoing calls of the bot, the sender plays games
+by posting synthetic updates to the webhook once the bot is up:
+
+    python -m benchmarks.fake_telegram --webhook-url http://127.0.0.1:3001/webhook --games 1000
+    TELEGRAM_API_URL=http://127.0.0.1:8081 RUN_MODE=prod python main.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, web
+
+from rate_limit import TokenBucket
+
+EMPTY_CELL = '⬜️'
+
+
+class FakeTelegramAPI:
+    """
+    Bot API stand-in answering every method successfully and keeping the last keyboard per message.
+    Updates put in `backlog` are served to getUpdates until confirmed by the offset.
+    With `flood_rate` set, calls above that rate per second are answered with 429 and retry_after
+    """
+
+    def __init__(self, flood_rate: Optional[float] = None, retry_after: int = 1):
+        self.calls = Counter()
+        self.markups: Dict[str, Optional[dict]] = {}
+        self.texts: Dict[str, str] = {}
+        self.versions = Counter()
+        self.flood_bucket = flood_rate and TokenBucket(flood_rate, flood_rate)
+        self.retry_after = retry_after
+        self._edited: Dict[str, asyncio.Event] = {}
+        self.backlog: List[dict] = []
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('POST', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        data = dict(await request.post()) if request.can_read_body else {}
+        status, body = self.respond(method, data)
+        return web.json_response(body, status=status)
+
+    def respond(self, method: str, data: dict) -> Tuple[int, dict]:
+        """
+        :return: HTTP status and body of the response
+        """
+        if self.flood_bucket and self.flood_bucket.consume():
+            self.calls['429'] += 1
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }
+        return 200, {'ok': True, 'result': self.process(method, data)}
+
+    def process(self, method: str, data: dict):
+        self.calls[method] += 1
+        inline_message_id = data.get('inline_message_id')
+        if method in ('editMessageText', 'editMessageReplyMarkup') and inline_message_id:
+            markup = data.get('reply_markup')
+            self.markups[inline_message_id] = json.loads(markup) if markup else None
+            if 'text' in data:
+                self.texts[inline_message_id] = data['text']
+            self.versions[inline_message_id] += 1
+            if event := self._edited.pop(inline_message_id, None):
+                event.set()
+        if method == 'getMe':
+            return {'id': 999999999, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if method == 'getUpdates':
+            offset = int(data.get('offset') or 0)
+            self.backlog = [update for update in self.backlog if update['update_id'] >= offset]
+            return self.backlog[:int(data.get('limit') or 100)]
+        return True
+
+    async def wait_for_edit(self, inline_message_id: str, version: int, timeout: float = 60):
+        """
+        Waits until the message is edited after it had `version` edits, edits are sent in the background
+        """
+        while self.versions[inline_message_id] == version:
+            event = self._edited.setdefault(inline_message_id, asyncio.Event())
+            await asyncio.wait_for(event.wait(), timeout)
+
+
+def buttons(markup: Optional[dict]) -> List[dict]:
+    if not markup:
+        return []
+    return list(itertools.chain.from_iterable(markup['inline_keyboard']))
+
+
+class UpdateSender:
+    """
+    Posts updates to the webhook, keeping per update latency
+    """
+
+    def __init__(self, session: ClientSession, webhook_url: str):
+        self.session = session
+        self.webhook_url = webhook_url
+        self.update_ids = itertools.count(1)
+        self.latencies: List[float] = []
+
+    async def send(self, **update) -> dict:
+        update_id = next(self.update_ids)
+        started = time.perf_counter()
+        async with self.session.post(self.webhook_url, json={'update_id': update_id, **update}) as response:
+            response.raise_for_status()
+            body = await response.text()
+        self.latencies.append(time.perf_counter() - started)
+        return json.loads(body) if body.startswith('{') else {}
+
+    async def inline_query(self, user_id: int) -> dict:
+        return await self.send(inline_query={
+            'id': str(next(self.update_ids)),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Player {user_id}'},
+            'query': '',
+            'offset': ''
+        })
+
+    async def callback_query(self, user_id: int, inline_message_id: str, data: str) -> dict:
+        return await self.send(callback_query={
+            'id': str(next(self.update_ids)),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Player {user_id}'},
+            'inline_message_id': inline_message_id,
+            'chat_instance': '0',
+            'data': data
+        })
+
+
+async def play_game(sender: UpdateSender, api: FakeTelegramAPI, game_number: int) -> int:
+    """
+    :return: number of moves made
+    """
+    creator, joiner = 2 * game_number + 1, 2 * game_number + 2
+    inline_message_id = f'fake-{game_number}'
+
+    async def tap(user_id: int, data: str):
+        version = api.versions[inline_message_id]
+        await sender.callback_query(user_id, inline_message_id, data)
+        await api.wait_for_edit(inline_message_id, version)
+
+    response = await sender.inline_query(creator)
+    results = response['results']
+    article = (json.loads(results) if isinstance(results, str) else results)[0]
+    await tap(creator, buttons(article['reply_markup'])[0]['callback_data'])
+    await tap(joiner, buttons(api.markups[inline_message_id])[0]['callback_data'])
+
+    moves = 0
+    while empty := [button for button in buttons(api.markups[inline_message_id]) if button['text'] == EMPTY_CELL]:
+        player = creator if moves % 2 == 0 else joiner
+        await tap(player, random.choice(empty)['callback_data'])
+        moves += 1
+    return moves
+
+
+async def wait_for_webhook(session: ClientSession, webhook_url: str, api: FakeTelegramAPI):
+    """
+    Waits until the bot answers on the webhook url and has set the webhook
+    """
+    while True:
+        try:
+            async with session.get(webhook_url) as response:
+                if response.status == 200 and api.calls['setWebhook']:
+                    return None
+        except OSError:
+            pass
+        await asyncio.sleep(0.5)
+
+
+def percentile(values: List[float], rank: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * rank))]
+
+
+async def run(
+        webhook_url: str,
+        api_host: str,
+        api_port: int,
+        games: int,
+        concurrency: int,
+        flood_rate: Optional[float] = None
+) -> dict:
+    """
+    :return: throughput and latency of the run
+    """
+    api = FakeTelegramAPI(flood_rate)
+    runner = web.AppRunner(api.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, api_host, api_port).start()
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(sender, game_number):
+        async with semaphore:
+            return await play_game(sender, api, game_number)
+
+    try:
+        async with ClientSession() as session:
+            await wait_for_webhook(session, webhook_url, api)
+            sender = UpdateSender(session, webhook_url)
+            started = time.perf_counter()
+            moves = sum(await asyncio.gather(*(limited(sender, number) for number in range(games))))
+            elapsed = time.perf_counter() - started
+    finally:
+        await runner.cleanup()
+
+    latencies = sender.latencies
+    print(f'games: {games}, moves: {moves}, updates: {len(latencies)}, elapsed: {elapsed:.2f}s')
+    print(f'updates/s: {len(latencies) / elapsed:.0f}, moves/s: {moves / elapsed:.0f}')
+    print(
+        'latency ms: '
+        + ', '.join(f'p{int(rank * 100)} {percentile(latencies, rank) * 1000:.1f}' for rank in (0.5, 0.95, 0.99))
+    )
+    print(f'outgoing api calls per move: {sum(api.calls.values()) / max(moves, 1):.2f} {dict(api.calls)}')
+    return {
+        'moves': moves,
+        'updates': len(latencies),
+        'elapsed': elapsed,
+        'updates_per_second': len(latencies) / elapsed,
+        'moves_per_second': moves / elapsed,
+        **{f'latency_p{int(rank * 100)}_ms': percentile(latencies, rank) * 1000 for rank in (0.5, 0.95, 0.99)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--webhook-url', default='http://127.0.0.1:3001/webhook')
+    parser.add_argument('--api-host', default='127.0.0.1')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--flood-rate', type=float, help='answer calls above this rate per second with 429')
+    arguments = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(
+        run(
+            arguments.webhook_url,
+            arguments.api_host,
+            arguments.api_port,
+            arguments.games,
+            arguments.concurrency,
+            arguments.flood_rate
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
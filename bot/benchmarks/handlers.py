@@ -0,0 +1,227 @@
+"""
+Throughput of the update handlers, driven in process with a fake Bot against the configured database.
+
+Plays simulated games through the dispatcher, so middlewares and the callback router are included,
+and reports moves/s, handler latency percentiles, DB queries and Telegram API calls per move:
+
+    python -m benchmarks.handlers --games 2000 --concurrency 500 --output results.json
+    python -m benchmarks.handlers --games 2000 --concurrency 500 --baseline results.json
+
+Edits are rate limited as configured, raise OUTGOING_RATE and MESSAGE_EDIT_RATE to measure the handlers alone.
+Taps are limited as configured too, a rejected tap is repeated when the answer allows it,
+set USER_CALLBACK_RATE, GAME_CALLBACK_RATE and CALLBACK_RATE to 0 to turn the limits off.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import check_result
+from aiogram.dispatcher.webhook import AnswerCallbackQuery, BaseResponse
+from asyncpgsa.connection import SAConnection
+
+from benchmarks.fake_telegram import EMPTY_CELL, FakeTelegramAPI, buttons, percentile
+from callbacks import THROTTLED_TEXT
+from main import init_connection, on_shutdown, on_startup
+from misc import bot, dp
+
+QUERY_METHODS = ('execute', 'executemany', 'fetch', 'fetchrow', 'fetchval', 'copy_records_to_table')
+# Compared metrics by the name suffix, with whether a lower value is better
+COMPARED_METRICS = {'_ms': True, '_per_move': True, '_per_second': False}
+
+
+class QueryCounter:
+    """
+    Counts statements sent over database connections, transaction control included
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._originals = {}
+
+    def install(self) -> None:
+        for name in QUERY_METHODS:
+            original = self._originals[name] = getattr(SAConnection, name)
+            setattr(SAConnection, name, self._wrap(original))
+
+    def uninstall(self) -> None:
+        for name, original in self._originals.items():
+            setattr(SAConnection, name, original)
+
+    def _wrap(self, method):
+        async def counted(connection, *args, **kwargs):
+            self.count += 1
+            return await method(connection, *args, **kwargs)
+
+        return counted
+
+
+class Simulation:
+    def __init__(self, flood_rate: Optional[float] = None):
+        self.api = FakeTelegramAPI(flood_rate)
+        self.update_ids = itertools.count(1)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.throttled = 0
+
+    async def request(self, method: str, data: Optional[dict] = None, files=None, **kwargs):
+        status, body = self.api.respond(method, data or {})
+        return check_result(method, 'application/json', status, json.dumps(body))
+
+    async def feed(self, kind: str, **update) -> List[BaseResponse]:
+        """
+        Processes the update like the webhook does, the returned responses go in the webhook reply
+        and aren't subject to flood control
+
+        :return: responses of the handlers
+        """
+        started = time.perf_counter()
+        results = await dp.updates_handler.notify(types.Update(update_id=next(self.update_ids), **update))
+        responses = [
+            response for response in itertools.chain.from_iterable(results or [])
+            if isinstance(response, BaseResponse)
+        ]
+        for response in responses:
+            self.api.process(response.method, response.prepare())
+        self.latencies[kind].append(time.perf_counter() - started)
+        return responses
+
+    def user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'Player {user_id}'}
+
+    async def callback_query(self, kind: str, user_id: int, inline_message_id: str, data: str):
+        """
+        Taps the button, again while the tap is rejected, and waits for the message edit sent in the background
+        """
+        version = self.api.versions[inline_message_id]
+        while throttled := [
+            response for response in await self.feed(kind, callback_query={
+                'id': str(next(self.update_ids)),
+                'from': self.user(user_id),
+                'inline_message_id': inline_message_id,
+                'chat_instance': '0',
+                'data': data
+            })
+            if isinstance(response, AnswerCallbackQuery) and response.text == THROTTLED_TEXT
+        ]:
+            self.throttled += 1
+            await asyncio.sleep(throttled[0].cache_time)
+        await self.api.wait_for_edit(inline_message_id, version)
+
+    async def play_game(self, game_number: int) -> int:
+        """
+        :return: number of moves made
+        """
+        creator, joiner = 2 * game_number + 1, 2 * game_number + 2
+        inline_message_id = f'benchmark-{game_number}'
+
+        responses = await self.feed('inline', inline_query={
+            'id': str(next(self.update_ids)),
+            'from': self.user(creator),
+            'query': '',
+            'offset': ''
+        })
+        results = responses[0].results
+        article = (json.loads(results) if isinstance(results, str) else results)[0]
+        await self.callback_query('sign', creator, inline_message_id, buttons(article['reply_markup'])[0]['callback_data'])
+        markup = self.api.markups[inline_message_id]
+        await self.callback_query('sign', joiner, inline_message_id, buttons(markup)[0]['callback_data'])
+
+        moves = 0
+        while empty := [button for button in buttons(self.api.markups[inline_message_id]) if button['text'] == EMPTY_CELL]:
+            player = creator if moves % 2 == 0 else joiner
+            await self.callback_query('move', player, inline_message_id, random.choice(empty)['callback_data'])
+            moves += 1
+        return moves
+
+
+async def run(games: int, concurrency: int, first_game: int, flood_rate: Optional[float] = None) -> dict:
+    simulation = Simulation(flood_rate)
+    bot.request = simulation.request
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await init_connection()
+    await on_startup(dp)
+
+    queries = QueryCounter()
+    queries.install()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(game_number):
+        async with semaphore:
+            return await simulation.play_game(game_number)
+
+    try:
+        started = time.perf_counter()
+        moves = sum(await asyncio.gather(*(limited(number) for number in range(first_game, first_game + games))))
+        # Moves are persisted behind, so their writes belong to the measured run
+        await on_shutdown(dp)
+        elapsed = time.perf_counter() - started
+    finally:
+        queries.uninstall()
+
+    api_calls = sum(simulation.api.calls.values())
+    results = {
+        'games': games,
+        'concurrency': concurrency,
+        'moves': moves,
+        'elapsed': elapsed,
+        'moves_per_second': moves / elapsed,
+        'updates_per_second': sum(map(len, simulation.latencies.values())) / elapsed,
+        'db_queries_per_move': queries.count / max(moves, 1),
+        'api_calls_per_move': api_calls / max(moves, 1),
+        'throttled_taps': simulation.throttled,
+        'api_calls': dict(simulation.api.calls),
+    }
+    for kind, latencies in simulation.latencies.items():
+        for rank in (0.5, 0.95, 0.99):
+            results[f'{kind}_latency_p{int(rank * 100)}_ms'] = percentile(latencies, rank) * 1000
+    return results
+
+
+def compare(results: dict, baseline: dict) -> List[str]:
+    """
+    :return: lines with the change of every compared metric, `+` marks an improvement
+    """
+    lines = []
+    for name, value in results.items():
+        previous = baseline.get(name)
+        suffix = next((suffix for suffix in COMPARED_METRICS if name.endswith(suffix)), None)
+        if suffix is None or not previous:
+            continue
+        change = (value - previous) / previous * 100
+        improved = change < 0 if COMPARED_METRICS[suffix] else change > 0
+        lines.append(f'{name:<28} {previous:12.2f} -> {value:12.2f} {change:+7.1f}% {"+" if improved else "-"}')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--first-game', type=int, default=0, help='offset of simulated user ids between runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--flood-rate', type=float, help='answer Telegram calls above this rate per second with 429')
+    parser.add_argument('--output', help='file to write JSON results to')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    arguments = parser.parse_args()
+
+    random.seed(arguments.seed)
+    results = asyncio.get_event_loop().run_until_complete(
+        run(arguments.games, arguments.concurrency, arguments.first_game, arguments.flood_rate)
+    )
+    print(json.dumps(results, indent=2))
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            print('\n'.join(compare(results, json.load(baseline_file))))
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
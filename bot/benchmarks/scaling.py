@@ -0,0 +1,82 @@
+"""
+Throughput of the multi-process mode by the number of workers.
+
+Starts the bot with WORKERS=N against the fake Telegram for every N and plays the same load:
+
+    python -m benchmarks.scaling --workers 1 2 4 8 --games 2000
+
+Edits are rate limited as configured, raise OUTGOING_RATE and MESSAGE_EDIT_RATE to measure the handlers alone.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+from typing import List
+
+from benchmarks import fake_telegram
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+
+async def run_workers(workers: int, port: int, api_port: int, games: int, concurrency: int) -> dict:
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, MAIN_SCRIPT,
+        env={
+            **os.environ,
+            'RUN_MODE': 'prod',
+            'WORKERS': str(workers),
+            'WEBAPP_HOST': '127.0.0.1',
+            'WEBAPP_PORT': str(port),
+            'TELEGRAM_API_URL': f'http://127.0.0.1:{api_port}',
+        }
+    )
+    try:
+        return await fake_telegram.run(
+            f'http://127.0.0.1:{port}{os.environ.get("WEBHOOK_PATH", "/webhook")}',
+            '127.0.0.1',
+            api_port,
+            games,
+            concurrency
+        )
+    finally:
+        bot.send_signal(signal.SIGINT)
+        await bot.wait()
+
+
+async def run(workers_counts: List[int], port: int, api_port: int, games: int, concurrency: int) -> List[dict]:
+    results = []
+    for workers in workers_counts:
+        result = await run_workers(workers, port, api_port, games, concurrency)
+        results.append({'workers': workers, **result})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--port', type=int, default=3001)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--output', help='file to write JSON results to')
+    arguments = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(
+        run(arguments.workers, arguments.port, arguments.api_port, arguments.games, arguments.concurrency)
+    )
+    base = results[0]['updates_per_second'] / results[0]['workers']
+    print(f'{"workers":>8} {"updates/s":>10} {"moves/s":>10} {"p99 ms":>8} {"scaling":>8}')
+    for result in results:
+        print(
+            f'{result["workers"]:>8} {result["updates_per_second"]:>10.0f} {result["moves_per_second"]:>10.0f} '
+            f'{result["latency_p99_ms"]:>8.1f} {result["updates_per_second"] / base / result["workers"]:>8.0%}'
+        )
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+import json
+import logging
+from math import ceil
+from enum import Enum
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Union
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import AnswerCallbackQuery
+from aiogram.types import CallbackQuery
+
+from idempotency import CallbackDeduplicator
+from scheduler import KeyedScheduler, Overloaded
+
+
+log = logging.getLogger(__name__)
+
+VERSION = '1'
+SEPARATOR = '.'
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+SIGNS = ('cross', 'circle')
+DIFFICULTIES = ('random', 'imperfect', 'perfect')
+
+
+class CallbackKind(str, Enum):
+    sign = 's'
+    field = 'f'
+    ai = 'a'
+
+
+class SignCallback(NamedTuple):
+    game_starter_id: int
+    sign: str
+    game_id: Optional[int] = None
+    # Index of the board in games.board.VARIANTS
+    variant: int = 0
+
+    kind = CallbackKind.sign
+
+
+class FieldCallback(NamedTuple):
+    game_id: int
+    position: int
+
+    kind = CallbackKind.field
+
+
+class AICallback(NamedTuple):
+    """
+    Starts the game of the starter against the bot, the game the starter created if set
+    """
+    game_starter_id: int
+    difficulty: str
+    game_id: Optional[int] = None
+
+    kind = CallbackKind.ai
+
+
+Callback = Union[SignCallback, FieldCallback, AICallback]
+
+
+def encode_int(value: int) -> str:
+    """
+    :return: base 36 representation of a non negative integer
+    """
+    if value == 0:
+        return '0'
+    digits = []
+    while value:
+        value, digit = divmod(value, 36)
+        digits.append(DIGITS[digit])
+    return ''.join(reversed(digits))
+
+
+def _encode_field(value: Union[int, str, None]) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    return encode_int(value)
+
+
+def encode(callback: Callback) -> str:
+    """
+    Callback data is the codec version, the kind prefix and base 36 fields separated by dots.
+    String fields are taken as already encoded, so templates can put markers there
+    """
+    if callback.kind == CallbackKind.sign:
+        fields = (callback.game_starter_id, SIGNS.index(callback.sign), callback.game_id, callback.variant)
+    elif callback.kind == CallbackKind.ai:
+        fields = (callback.game_starter_id, DIFFICULTIES.index(callback.difficulty), callback.game_id)
+    else:
+        fields = (callback.game_id, callback.position)
+    return f'{VERSION}{callback.kind.value}{SEPARATOR.join(map(_encode_field, fields))}'
+
+
+def _decode_v1(kind: str, fields: str) -> Callback:
+    values = fields.split(SEPARATOR)
+    if kind == CallbackKind.field:
+        game_id, position = values
+        return FieldCallback(int(game_id, 36), int(position, 36))
+    if kind == CallbackKind.sign:
+        # Keyboards sent before board variants have no variant
+        game_starter_id, sign, game_id, *variant = values
+        return SignCallback(
+            int(game_starter_id, 36),
+            SIGNS[int(sign, 36)],
+            int(game_id, 36) if game_id else None,
+            int(variant[0], 36) if variant else 0
+        )
+    if kind == CallbackKind.ai:
+        game_starter_id, difficulty, game_id = values
+        return AICallback(
+            int(game_starter_id, 36),
+            DIFFICULTIES[int(difficulty, 36)],
+            int(game_id, 36) if game_id else None
+        )
+    raise ValueError(f'Unknown callback kind {kind!r}')
+
+
+def _decode_json(raw: str) -> Callback:
+    """
+    Callback data of keyboards sent before the compact codec
+    """
+    data = json.loads(raw)
+    if data['name'] == 'xo_field':
+        return FieldCallback(data['game_id'], data['pos'])
+    if data['name'] == 'xo_sign':
+        return SignCallback(data['id'], 'cross' if data['sign'] == 'x' else 'circle', data['game'])
+    raise ValueError(f'Unknown callback name {data["name"]!r}')
+
+
+_DECODERS = {
+    VERSION: _decode_v1,
+}
+
+
+def decode(raw: Optional[str]) -> Optional[Callback]:
+    """
+    :param raw: callback data of the pressed button
+
+    :return: parsed callback or None if it can't be parsed
+    """
+    if not raw:
+        return None
+    try:
+        if raw[0] == '{':
+            return _decode_json(raw)
+        return _DECODERS[raw[0]](raw[1], raw[2:])
+    except (KeyError, IndexError, ValueError, TypeError):
+        log.warning('Unparsable callback data %r', raw)
+        return None
+
+
+class CallbackDataMiddleware(BaseMiddleware):
+    """
+    Parses callback data once per update and passes it to handlers as `callback_data`
+    """
+
+    async def on_pre_process_callback_query(self, query: CallbackQuery, data: dict):
+        data['callback_data'] = decode(query.data)
+
+
+OVERLOADED_TEXT = 'Слишком много ходов, попробуйте ещё раз'
+THROTTLED_TEXT = 'Слишком много нажатий, подождите немного'
+
+
+class CallbackRouter:
+    """
+    Single callback query handler picking the game handler by the callback kind.
+    With a scheduler, callbacks of one game message are handled one by one in arrival order,
+    with a deduplicator, repeated callbacks are answered without handling them.
+    Callbacks rejected by `AdmissionMiddleware` are answered at once
+    """
+
+    def __init__(
+            self,
+            scheduler: Optional[KeyedScheduler] = None,
+            deduplicator: Optional[CallbackDeduplicator] = None
+    ):
+        self.handlers: Dict[CallbackKind, Callable[..., Awaitable]] = {}
+        self.scheduler = scheduler
+        self.deduplicator = deduplicator
+
+    def handler(self, kind: CallbackKind):
+        def decorator(callback):
+            self.handlers[kind] = callback
+            return callback
+
+        return decorator
+
+    async def dispatch(
+            self,
+            query: CallbackQuery,
+            callback_data: Optional[Callback] = None,
+            retry_after: Optional[float] = None
+    ):
+        if retry_after:
+            # Clients don't send the same tap again while the answer is cached
+            return AnswerCallbackQuery(query.id, text=THROTTLED_TEXT, cache_time=ceil(retry_after))
+        if callback_data is None or callback_data.kind not in self.handlers:
+            return AnswerCallbackQuery(query.id)
+        if self.deduplicator is None:
+            return await self._run(query, callback_data)
+        return await self.deduplicator.run(query, lambda: self._run(query, callback_data))
+
+    async def _run(self, query: CallbackQuery, callback_data: Callback):
+        handler = self.handlers[callback_data.kind]
+        if self.scheduler is None:
+            return await handler(query, callback_data)
+
+        key = query.inline_message_id or getattr(callback_data, 'game_id', None) or query.from_user.id
+        try:
+            return await self.scheduler.run(key, lambda: handler(query, callback_data))
+        except Overloaded:
+            return AnswerCallbackQuery(query.id, text=OVERLOADED_TEXT)
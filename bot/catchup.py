@@ -0,0 +1,124 @@
+"""
+Catch-up of the updates Telegram queued while the bot was down, instead of skipping them:
+moves made meanwhile are played, updates of one game in order and games in parallel.
+A page of updates is confirmed once it's handled, so updates aren't lost if the bot stops meanwhile.
+Callback queries carry no time, and answers are only accepted for a few seconds after the tap,
+so backlog callbacks aren't answered and backlog inline queries are dropped without handling them
+"""
+import asyncio
+import logging
+from itertools import chain
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.webhook import AnswerCallbackQuery, BaseResponse
+
+from admission import exempt
+from metrics import Counter, Gauge
+from sharding import shard_key
+
+log = logging.getLogger(__name__)
+
+CATCH_UP_UPDATES = Counter('catch_up_updates_total', 'Backlog updates on startup by outcome', ('outcome',))
+CATCH_UP_SECONDS = Gauge('catch_up_seconds', 'Duration of the last catch-up')
+CATCH_UP_RATE = Gauge('catch_up_updates_per_second', 'Backlog updates handled per second in the last catch-up')
+
+# Updates only useful while the user waits for the answer
+STALE_UPDATES = ('inline_query', 'chosen_inline_result')
+
+
+def _tap_key(update: dict) -> Optional[Hashable]:
+    query = update.get('callback_query')
+    if query is None:
+        return None
+    message = query.get('inline_message_id') or query.get('message', {}).get('message_id')
+    return query['from']['id'], message, query.get('data')
+
+
+def plan(updates: List[dict], taps: Optional[Set[Hashable]] = None) -> Tuple[Dict[str, List[dict]], Dict[str, int]]:
+    """
+    Drops stale updates and taps repeating an earlier tap of the user on the same button,
+    and groups the rest by game in arrival order
+
+    :param taps: taps of the earlier pages, the taps of these updates are added
+    :return: updates by the shard key of their game, and the number of updates by outcome
+    """
+    groups: Dict[str, List[dict]] = {}
+    counts = dict.fromkeys(('handled', 'stale', 'repeated'), 0)
+    taps = set() if taps is None else taps
+    for update in sorted(updates, key=lambda item: item['update_id']):
+        if any(kind in update for kind in STALE_UPDATES):
+            counts['stale'] += 1
+            continue
+        if (tap := _tap_key(update)) is not None:
+            if tap in taps:
+                counts['repeated'] += 1
+                continue
+            taps.add(tap)
+        groups.setdefault(shard_key(update), []).append(update)
+        counts['handled'] += 1
+    return groups, counts
+
+
+async def catch_up(
+        bot: Bot,
+        process: Callable[[dict], Awaitable],
+        concurrency: int,
+        limit: int = 100
+) -> Dict[str, int]:
+    """
+    Replays the backlog a page of `limit` updates at a time, a game at a time on each of `concurrency` tasks.
+    Reading the next page confirms the handled ones, so they aren't delivered again
+
+    :param process: handles an update
+    :return: the number of updates by outcome
+    """
+    started = perf_counter()
+    await bot.delete_webhook()
+    counts = dict.fromkeys(('handled', 'stale', 'repeated'), 0)
+    games: Set[str] = set()
+    taps: Set[Hashable] = set()
+    offset: Optional[int] = None
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def replay(group: List[dict]) -> None:
+        async with semaphore:
+            for update in group:
+                try:
+                    await process(update)
+                except Exception:
+                    log.exception('Failed to catch up update %s', update['update_id'])
+
+    while page := await bot.get_updates(offset=offset, limit=limit, timeout=0):
+        groups, page_counts = plan([update.to_python() for update in page], taps)
+        await asyncio.gather(*(replay(group) for group in groups.values()))
+        for outcome, count in page_counts.items():
+            counts[outcome] += count
+        games.update(groups)
+        offset = page[-1].update_id + 1
+    elapsed = perf_counter() - started
+    for outcome, count in counts.items():
+        CATCH_UP_UPDATES.labels(outcome).inc(count)
+    CATCH_UP_SECONDS.set(elapsed)
+    CATCH_UP_RATE.set(counts['handled'] / elapsed)
+    log.info(
+        'Caught up %s updates of %s games in %.2f s, %.0f per second, dropped %s stale and %s repeated',
+        counts['handled'], len(games), elapsed, counts['handled'] / elapsed, counts['stale'], counts['repeated']
+    )
+    return counts
+
+
+def handler(dp: Dispatcher) -> Callable[[dict], Awaitable]:
+    """
+    :return: update processing by the dispatcher of this process, sending the responses
+        meant for the webhook reply except the answers to callback queries
+    """
+    async def process(update: dict) -> None:
+        exempt.set(True)
+        results = await dp.updates_handler.notify(types.Update(**update))
+        for response in chain.from_iterable(result for result in results or [] if isinstance(result, list)):
+            if isinstance(response, BaseResponse) and not isinstance(response, AnswerCallbackQuery):
+                await response.execute_response(dp.bot)
+
+    return process
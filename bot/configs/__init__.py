@@ -1,2 +1,5 @@
 from .bot import BotConfig
+from .cache import CacheConfig
 from .database import DataBaseConfig
+from .game import GameConfig
+from .monitoring import MonitoringConfig
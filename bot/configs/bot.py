@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import Optional
 
 from pydantic import BaseSettings, Field, SecretStr
 
@@ -6,6 +7,7 @@ from pydantic import BaseSettings, Field, SecretStr
 class RunMode(str, Enum):
     dev = 'dev'
     prod = 'prod'
+    worker = 'worker'
 
 
 class BotConfig(BaseSettings):
@@ -14,6 +16,32 @@ class BotConfig(BaseSettings):
     webhook_url: SecretStr = Field(..., env='WEBHOOK_URL')
     webapp_host: str = Field(..., env='WEBAPP_HOST')
     webapp_port: str = Field(..., env='WEBAPP_PORT')
+    webhook_path: str = Field('/webhook', env='WEBHOOK_PATH')
+    webhook_max_connections: int = Field(40, env='WEBHOOK_MAX_CONNECTIONS')
+    max_concurrent_updates: int = Field(100, env='MAX_CONCURRENT_UPDATES')
+    handler_concurrency: int = Field(20, env='HANDLER_CONCURRENCY')
+    game_queue_size: int = Field(5, env='GAME_QUEUE_SIZE')
+    max_pending_updates: int = Field(1000, env='MAX_PENDING_UPDATES')
+    api_url: Optional[str] = Field(None, env='TELEGRAM_API_URL')
+    outgoing_rate: float = Field(30, env='OUTGOING_RATE')
+    outgoing_burst: float = Field(30, env='OUTGOING_BURST')
+    message_edit_rate: float = Field(1, env='MESSAGE_EDIT_RATE')
+    message_edit_burst: float = Field(5, env='MESSAGE_EDIT_BURST')
+    outgoing_concurrency: int = Field(10, env='OUTGOING_CONCURRENCY')
+    # Seconds pending message edits get to be sent on shutdown
+    outgoing_stop_timeout: float = Field(10, env='OUTGOING_STOP_TIMEOUT')
+    # Callback queries per second and bursts admitted per user, per game and in total, 0 rate turns a limit off
+    user_callback_rate: float = Field(5, env='USER_CALLBACK_RATE')
+    user_callback_burst: float = Field(10, env='USER_CALLBACK_BURST')
+    game_callback_rate: float = Field(10, env='GAME_CALLBACK_RATE')
+    game_callback_burst: float = Field(20, env='GAME_CALLBACK_BURST')
+    callback_rate: float = Field(500, env='CALLBACK_RATE')
+    callback_burst: float = Field(1000, env='CALLBACK_BURST')
+    workers: int = Field(0, env='WORKERS')
+    worker_base_port: int = Field(3100, env='WORKER_BASE_PORT')
+    health_check_interval: float = Field(1, env='HEALTH_CHECK_INTERVAL')
+    # Games replayed at once from the updates queued while the bot was down
+    catch_up_concurrency: int = Field(50, env='CATCH_UP_CONCURRENCY')
 
     @property
     def is_prod(self):
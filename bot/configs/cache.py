@@ -0,0 +1,13 @@
+from pydantic import BaseSettings, Field
+
+
+class CacheConfig(BaseSettings):
+    user_cache_size: int = Field(100000, env='USER_CACHE_SIZE')
+    user_cache_ttl: float = Field(3600, env='USER_CACHE_TTL')
+    # Updates and callback queries remembered to answer them again when delivered again
+    update_cache_size: int = Field(100000, env='UPDATE_CACHE_SIZE')
+    update_cache_ttl: float = Field(3600, env='UPDATE_CACHE_TTL')
+    # Seconds a repeated tap of the same button gets the answer to the first tap
+    repeat_tap_ttl: float = Field(2, env='REPEAT_TAP_TTL')
+    # SQL compiled by the DAOs, one entry per query shape
+    query_cache_size: int = Field(512, env='DB_QUERY_CACHE_SIZE')
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseSettings, Field, SecretStr
 
 
@@ -8,6 +10,12 @@ class DataBaseConfig(BaseSettings):
     password: SecretStr = Field(..., env='DB_PASS')
     port: str = Field(..., env='DB_PORT')
     driver: str = Field(..., env='DB_DRIVER')
+    # Prepared statements kept by every pooled connection
+    statement_cache_size: int = Field(1024, env='DB_STATEMENT_CACHE_SIZE')
+    # Connections kept open, derived from the handler concurrency if not set
+    pool_size: Optional[int] = Field(None, env='DB_POOL_SIZE')
+    # Seconds to wait for the database to accept connections on startup
+    connect_timeout: float = Field(60, env='DB_CONNECT_TIMEOUT')
 
     @property
     def connection_url(self):
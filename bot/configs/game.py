@@ -0,0 +1,19 @@
+from pydantic import BaseSettings, Field
+
+
+class GameConfig(BaseSettings):
+    store_size: int = Field(10000, env='GAME_STORE_SIZE')
+    flush_interval: float = Field(0.05, env='GAME_FLUSH_INTERVAL')
+    flush_batch_size: int = Field(500, env='GAME_FLUSH_BATCH_SIZE')
+    # Probability of the best move of the bot on the imperfect difficulty
+    ai_imperfect_accuracy: float = Field(0.7, env='AI_IMPERFECT_ACCURACY')
+    # Games nobody played for this many seconds expire
+    stale_timeout: float = Field(86400, env='GAME_STALE_TIMEOUT')
+    # Finished and expired games move to the archive after this many seconds
+    archive_after: float = Field(3600, env='GAME_ARCHIVE_AFTER')
+    reaper_interval: float = Field(60, env='REAPER_INTERVAL')
+    reaper_batch_size: int = Field(500, env='REAPER_BATCH_SIZE')
+    # Largest change of the Elo rating per game
+    rating_k_factor: float = Field(32, env='RATING_K_FACTOR')
+    leaderboard_size: int = Field(10, env='LEADERBOARD_SIZE')
+    leaderboard_refresh_interval: float = Field(60, env='LEADERBOARD_REFRESH_INTERVAL')
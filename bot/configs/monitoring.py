@@ -0,0 +1,9 @@
+from pydantic import BaseSettings, Field
+
+
+class MonitoringConfig(BaseSettings):
+    metrics_host: str = Field('127.0.0.1', env='METRICS_HOST')
+    # 0 disables the metrics endpoint
+    metrics_port: int = Field(9100, env='METRICS_PORT')
+    log_level: str = Field('INFO', env='LOG_LEVEL')
+    log_sample_rate: float = Field(0.01, env='LOG_SAMPLE_RATE')
@@ -1 +1,4 @@
 CACHE_TIME = 1
+
+# Elo rating of a player before the first game
+INITIAL_RATING = 1000
@@ -0,0 +1,202 @@
+"""
+Streams games, archived and live, with their players and moves in order to a file,
+reading them with a server-side cursor, so memory doesn't grow with the number of games.
+Prints summary aggregates computed along the way:
+
+    python export.py --output games.ndjson --since 2020-09-01 --until 2020-10-01 --status finished
+    python export.py --format columns --output games.columns.gz
+
+NDJSON has a game per line. The columnar format has the column names on the first line
+and then a line per group of games with a list of values per column. Files ending with .gz are compressed
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import IO, Any, Dict, List, Optional
+
+from asyncpgsa import pg
+
+from DAO import TicTacToeGameDAO
+from models import EnumStatus
+from startup import SCRIPT_CONNECTIONS, init_connection
+
+COLUMNS = (
+    'id', 'created', 'finished', 'status', 'width', 'height', 'win_length', 'ai_difficulty',
+    'cross_tg_id', 'cross_name', 'circle_tg_id', 'circle_name', 'winner', 'moves'
+)
+
+
+def _value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class NDJSONWriter:
+    def __init__(self, file: IO[str]):
+        self.file = file
+
+    def write(self, game: Dict[str, Any]) -> None:
+        self.file.write(json.dumps(game, ensure_ascii=False))
+        self.file.write('\n')
+
+    def close(self) -> None:
+        pass
+
+
+class ColumnsWriter:
+    """
+    Writes games in groups of `group_size`, a list of values per column, so column names aren't repeated
+    """
+
+    def __init__(self, file: IO[str], group_size: int):
+        self.file = file
+        self.group_size = group_size
+        self._group: Dict[str, List[Any]] = {column: [] for column in COLUMNS}
+        self._size = 0
+        self.file.write(json.dumps(COLUMNS))
+        self.file.write('\n')
+
+    def write(self, game: Dict[str, Any]) -> None:
+        for column in COLUMNS:
+            self._group[column].append(game[column])
+        self._size += 1
+        if self._size == self.group_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        self.file.write(json.dumps([self._group[column] for column in COLUMNS], ensure_ascii=False))
+        self.file.write('\n')
+        for values in self._group.values():
+            values.clear()
+        self._size = 0
+
+    def close(self) -> None:
+        if self._size:
+            self._flush()
+
+
+class Summary:
+    """
+    Aggregates of the exported games by board and opponent, the bot difficulty or players.
+    Crosses move first, so first move win rates are the share of finished games crosses won
+    """
+
+    def __init__(self):
+        self.statuses: Counter = Counter()
+        self.finished: Counter = Counter()
+        self.first_mover_wins: Counter = Counter()
+        self.draws: Counter = Counter()
+        self.moves: Counter = Counter()
+        # Finished games and first mover wins by the first cell taken
+        self.openings: Dict[str, Counter] = defaultdict(Counter)
+        self.opening_wins: Dict[str, Counter] = defaultdict(Counter)
+
+    def add(self, game: Dict[str, Any]) -> None:
+        self.statuses[game['status']] += 1
+        if game['status'] != EnumStatus.finished.name:
+            return None
+        group = f'{game["width"]}x{game["height"]}/{game["win_length"]} {game["ai_difficulty"] or "players"}'
+        self.finished[group] += 1
+        self.moves[group] += len(game['moves'])
+        if game['winner'] == 'cross':
+            self.first_mover_wins[group] += 1
+        elif game['winner'] is None:
+            self.draws[group] += 1
+        if game['moves']:
+            opening = game['moves'][0]
+            self.openings[group][opening] += 1
+            self.opening_wins[group][opening] += game['winner'] == 'cross'
+
+    def report(self) -> Dict[str, Any]:
+        groups = {}
+        for group, finished in sorted(self.finished.items()):
+            groups[group] = {
+                'finished': finished,
+                'first_move_win_rate': self.first_mover_wins[group] / finished,
+                'second_move_win_rate': (finished - self.first_mover_wins[group] - self.draws[group]) / finished,
+                'draw_rate': self.draws[group] / finished,
+                'average_moves': self.moves[group] / finished,
+                'first_move_win_rate_by_opening': {
+                    cell: self.opening_wins[group][cell] / games
+                    for cell, games in sorted(self.openings[group].items())
+                },
+            }
+        return {'games': sum(self.statuses.values()), 'statuses': dict(self.statuses), 'finished': groups}
+
+
+def _open(path: str) -> IO[str]:
+    if path == '-':
+        return sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+
+async def export(
+        file: IO[str],
+        columnar: bool,
+        batch_size: int,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        statuses: Optional[List[EnumStatus]] = None
+) -> Dict[str, Any]:
+    """
+    :param columnar: write the columnar format instead of NDJSON
+    :param batch_size: games fetched per round trip, and per group of the columnar format
+
+    :return: summary of the exported games
+    """
+    writer = ColumnsWriter(file, batch_size) if columnar else NDJSONWriter(file)
+    summary = Summary()
+    async with pg.transaction(readonly=True) as connection:
+        async for record in TicTacToeGameDAO().export(connection, batch_size, since, until, statuses):
+            game = {column: _value(record[column]) for column in COLUMNS}
+            writer.write(game)
+            summary.add(game)
+    writer.close()
+    return summary.report()
+
+
+async def run(arguments: argparse.Namespace) -> None:
+    await init_connection(SCRIPT_CONNECTIONS)
+    started = time.perf_counter()
+    file = _open(arguments.output)
+    try:
+        summary = await export(
+            file,
+            arguments.format == 'columns',
+            arguments.batch_size,
+            arguments.since,
+            arguments.until,
+            arguments.status and [EnumStatus[status] for status in arguments.status]
+        )
+    finally:
+        if file is not sys.stdout:
+            file.close()
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+    print(f'Exported {summary["games"]} games in {time.perf_counter() - started:.2f} s', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='-', help='file to write the games to, standard output by default')
+    parser.add_argument('--format', choices=('ndjson', 'columns'), default='ndjson')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='skip games created earlier')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='skip games created since')
+    parser.add_argument(
+        '--status',
+        action='append',
+        choices=[status.name for status in EnumStatus],
+        help='export games with the status only, can be repeated'
+    )
+    parser.add_argument('--batch-size', type=int, default=1000, help='games read per round trip')
+    arguments = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(arguments))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Tic tac toe opponent playing from a table of the best moves of every reachable classic board,
+built once on startup, so choosing a move is a lookup
+"""
+import random
+from typing import Dict, Tuple
+
+from games.board import Board
+from models import EnumDifficulty
+
+_best_moves: Dict[Board, Tuple[int, ...]] = {}
+
+
+def _sign_to_move(board: Board) -> str:
+    return 'cross' if bin(board.cross).count('1') == bin(board.circle).count('1') else 'circle'
+
+
+def _free_positions(board: Board) -> Tuple[int, ...]:
+    return tuple(position for position in range(board.geometry.cells) if board.is_free(position))
+
+
+def _solve(board: Board, scores: Dict[Board, int]) -> int:
+    """
+    :return: score of the board for the side to move, positive for a win,
+        the sooner the game ends the larger the score
+    """
+    if board in scores:
+        return scores[board]
+    if board.winner():
+        # The last move won
+        score = -(board.geometry.cells + 1 - bin(board.occupied).count('1'))
+    elif board.is_full:
+        score = 0
+    else:
+        sign = _sign_to_move(board)
+        children = {position: -_solve(board.place(position, sign), scores) for position in _free_positions(board)}
+        score = max(children.values())
+        _best_moves[board] = tuple(position for position, child in children.items() if child == score)
+    scores[board] = score
+    return score
+
+
+def warm_up() -> None:
+    """
+    Builds the table of the best moves
+    """
+    if not _best_moves:
+        _solve(Board(), {})
+
+
+def choose_move(board: Board, difficulty: EnumDifficulty, accuracy: float) -> int:
+    """
+    :param board: board of an unfinished game
+    :param accuracy: probability of the best move on the imperfect difficulty
+
+    :return: cell to play
+    """
+    if difficulty == EnumDifficulty.random or difficulty == EnumDifficulty.imperfect and random.random() > accuracy:
+        return random.choice(_free_positions(board))
+    if not _best_moves:
+        warm_up()
+    return random.choice(_best_moves[board])
@@ -0,0 +1,175 @@
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+# Boards are stored in signed 64-bit database columns
+MAX_CELLS = 64
+_UNSIGNED = 1 << MAX_CELLS
+_SIGN_BIT = 1 << (MAX_CELLS - 1)
+
+# Row and column steps of the lines through a cell: horizontal, vertical and both diagonals
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+def _line_mask(positions) -> int:
+    mask = 0
+    for position in positions:
+        mask |= 1 << position
+    return mask
+
+
+class Geometry:
+    """
+    Board of `width` columns and `height` rows won by `win_length` signs in a row, with its winning lines.
+    Instances are shared, so the lines are computed once per board size
+    """
+    __slots__ = ('width', 'height', 'win_length', 'cells', 'full_mask', 'win_masks', 'lines_through')
+
+    _instances: Dict[Tuple[int, int, int], 'Geometry'] = {}
+
+    def __new__(cls, width: int = 3, height: int = 3, win_length: int = 3) -> 'Geometry':
+        geometry = cls._instances.get((width, height, win_length))
+        if geometry is not None:
+            return geometry
+        if not 0 < width * height <= MAX_CELLS or not 0 < win_length <= max(width, height):
+            raise ValueError(f'Unsupported board {width}x{height} with {win_length} in a row')
+
+        geometry = super().__new__(cls)
+        geometry.width = width
+        geometry.height = height
+        geometry.win_length = win_length
+        geometry.cells = width * height
+        geometry.full_mask = (1 << geometry.cells) - 1
+        geometry.win_masks = _win_masks(width, height, win_length)
+        # Winning masks going through every cell, so a move only checks its own lines
+        geometry.lines_through = tuple(
+            tuple(mask for mask in geometry.win_masks if mask & (1 << position))
+            for position in range(geometry.cells)
+        )
+        cls._instances[(width, height, win_length)] = geometry
+        return geometry
+
+    def __repr__(self) -> str:
+        return f'Geometry({self.width}, {self.height}, {self.win_length})'
+
+
+def _win_masks(width: int, height: int, length: int) -> Tuple[int, ...]:
+    masks = []
+    for row in range(height):
+        for column in range(width):
+            for row_step, column_step in DIRECTIONS:
+                last_row, last_column = row + row_step * (length - 1), column + column_step * (length - 1)
+                if 0 <= last_row < height and 0 <= last_column < width:
+                    masks.append(_line_mask(
+                        (row + row_step * index) * width + column + column_step * index for index in range(length)
+                    ))
+    return tuple(masks)
+
+
+CLASSIC = Geometry()
+
+# Boards offered to players, the index is sent in callbacks.
+# At most 8 columns, the buttons of an inline keyboard row, so every board fits a keyboard
+VARIANTS: Tuple[Geometry, ...] = (
+    CLASSIC,
+    Geometry(5, 5, 4),
+    Geometry(8, 8, 5),
+)
+
+
+def to_signed(mask: int) -> int:
+    """
+    :return: mask as stored in a signed 64-bit column
+    """
+    return mask - _UNSIGNED if mask & _SIGN_BIT else mask
+
+
+def to_unsigned(value: int) -> int:
+    return value % _UNSIGNED
+
+
+class Board(NamedTuple):
+    """
+    Board packed into two bitsets, bit N is the cell N counting by rows
+    """
+    cross: int = 0
+    circle: int = 0
+    geometry: Geometry = CLASSIC
+
+    @classmethod
+    def from_positions(cls, positions: Dict[int, str], geometry: Geometry = CLASSIC) -> 'Board':
+        cross = circle = 0
+        for position, sign in positions.items():
+            if sign == 'cross':
+                cross |= 1 << position
+            else:
+                circle |= 1 << position
+        return cls(cross, circle, geometry)
+
+    @property
+    def occupied(self) -> int:
+        return self.cross | self.circle
+
+    @property
+    def is_full(self) -> bool:
+        return self.cross | self.circle == self.geometry.full_mask
+
+    def get(self, position: int) -> Optional[str]:
+        bit = 1 << position
+        if self.cross & bit:
+            return 'cross'
+        if self.circle & bit:
+            return 'circle'
+        return None
+
+    def is_free(self, position: int) -> bool:
+        return not self.occupied & (1 << position)
+
+    def place(self, position: int, sign: str) -> 'Board':
+        bit = 1 << position
+        if sign == 'cross':
+            return Board(self.cross | bit, self.circle, self.geometry)
+        return Board(self.cross, self.circle | bit, self.geometry)
+
+    def winner(self) -> Optional[str]:
+        for sign, mask in (('cross', self.cross), ('circle', self.circle)):
+            for line in self.geometry.win_masks:
+                if mask & line == line:
+                    return sign
+        return None
+
+
+def check_win(board: Board, position: int) -> Optional[str]:
+    """
+    Checks only the lines through the last move, at most `4 * win_length` masks
+
+    :param board: board with the last move already placed
+    :param position: cell of the last move
+
+    :return: sign of the winner if the last move completed a line
+    """
+    sign = board.get(position)
+    mask = board.cross if sign == 'cross' else board.circle
+    for line in board.geometry.lines_through[position]:
+        if mask & line == line:
+            return sign
+    return None
+
+
+def reachable_boards(geometry: Geometry = CLASSIC) -> Iterator[Board]:
+    """
+    Every board reachable in a game where cross moves first, including finished ones.
+    Only practical for the classic board
+    """
+    seen = {Board(geometry=geometry)}
+    stack = [Board(geometry=geometry)]
+    while stack:
+        board = stack.pop()
+        yield board
+        if board.winner() or board.is_full:
+            continue
+        sign = 'cross' if bin(board.cross).count('1') == bin(board.circle).count('1') else 'circle'
+        for position in range(geometry.cells):
+            if board.is_free(position):
+                child = board.place(position, sign)
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
@@ -0,0 +1,120 @@
+"""
+Background cleanup of the game tables: games nobody plays expire, and ended games
+move to a compact archive, so the tables joined on every move only hold recent games
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Optional
+
+from DAO import TicTacToeGameDAO
+from configs import GameConfig
+from games.store import GameStore, game_store
+from metrics import Counter, Histogram
+from misc import outgoing
+
+log = logging.getLogger(__name__)
+
+EXPIRED = Counter('reaper_expired_games_total', 'Games expired after no moves for too long')
+ARCHIVED = Counter('reaper_archived_rows_total', 'Rows moved to the archive by table', ('table',))
+ARCHIVE_SECONDS = Histogram('reaper_archive_seconds', 'Duration of archiving all ended games')
+
+EXPIRED_TEXT = '⌛ Игра отменена: слишком долго не было ходов'
+
+
+class Reaper:
+    """
+    Periodically expires stale games and archives ended ones in batches of `batch_size` games,
+    every batch is a transaction of its own. Processes running it concurrently take different games
+    """
+
+    def __init__(self, store: GameStore, interval: float, stale_timeout: float, archive_after: float, batch_size: int):
+        self.store = store
+        self.interval = interval
+        self.stale_timeout = stale_timeout
+        self.archive_after = archive_after
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    async def expire(self) -> int:
+        """
+        Expires games not updated for `stale_timeout` and edits their messages
+
+        :return: number of expired games
+        """
+        # Moves made in this process count as updates
+        await self.store.writer.flush()
+        before = datetime.now() - timedelta(seconds=self.stale_timeout)
+        expired = 0
+        while True:
+            games = await TicTacToeGameDAO().expire(before, self.batch_size)
+            for game in games:
+                self.store.discard(game['TicTacToeGame_id'])
+                if inline_message_id := game['TicTacToeGame_inline_message_id']:
+                    outgoing.edit_text(inline_message_id, text=EXPIRED_TEXT)
+            expired += len(games)
+            EXPIRED.inc(len(games))
+            if len(games) < self.batch_size:
+                return expired
+
+    async def archive(self) -> int:
+        """
+        Archives games ended `archive_after` ago
+
+        :return: number of archived games
+        """
+        before = datetime.now() - timedelta(seconds=self.archive_after)
+        started = perf_counter()
+        totals = dict.fromkeys(('games', 'players', 'steps'), 0)
+        while True:
+            result = await TicTacToeGameDAO().archive(before, self.batch_size)
+            if result is None:
+                log.info('Archiving is paused while the player stats are rebuilt')
+                break
+            for table in totals:
+                totals[table] += result[table]
+                ARCHIVED.labels(table).inc(result[table])
+            if result['games'] < self.batch_size:
+                break
+        elapsed = perf_counter() - started
+        ARCHIVE_SECONDS.observe(elapsed)
+        if totals['games']:
+            log.info(
+                'Archived %s games with %s players and %s steps in %.2f s',
+                totals['games'], totals['players'], totals['steps'], elapsed
+            )
+        return totals['games']
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if expired := await self.expire():
+                    log.info('Expired %s stale games', expired)
+                await self.archive()
+            except Exception:
+                log.exception('Failed to clean up games')
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+game_config = GameConfig()
+reaper = Reaper(
+    game_store,
+    interval=game_config.reaper_interval,
+    stale_timeout=game_config.stale_timeout,
+    archive_after=game_config.archive_after,
+    batch_size=game_config.reaper_batch_size
+)
@@ -0,0 +1,108 @@
+"""
+Player statistics: kept up to date as games finish, see `UserStatsDAO.record_results`,
+served to /stats with a single row read and to the inline leaderboard from memory
+"""
+import asyncio
+import json
+import logging
+from typing import Dict, List, Optional
+
+from aiogram.dispatcher.webhook import SendMessage
+from aiogram.types import InputTextMessageContent, Message
+from asyncpg import Record
+
+from DAO import UserStatsDAO
+from configs import GameConfig
+from misc import dp
+from users import resolve_user_id
+
+log = logging.getLogger(__name__)
+
+
+def _leaderboard_text(records: List[Record]) -> str:
+    if not records:
+        return '🏆 Рейтинг игроков\n\nПока никто не доиграл ни одной игры'
+    places = '\n'.join(
+        f'{place}. {record["User_name"]} — {record["UserStats_rating"]:.0f} '
+        f'({record["UserStats_wins"]}/{record["UserStats_draws"]}/{record["UserStats_losses"]})'
+        for place, record in enumerate(records, start=1)
+    )
+    return f'🏆 Рейтинг игроков\n\n{places}'
+
+
+class Leaderboard:
+    """
+    Players with the highest rating, read from the database every `refresh_interval` seconds
+    """
+
+    def __init__(self, size: int, refresh_interval: float):
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self.places: Dict[int, int] = {}
+        self.message_content = ''
+        self._set([])
+        self._task: Optional[asyncio.Task] = None
+
+    def _set(self, records: List[Record]) -> None:
+        self.places = {record['User_tg_id']: place for place, record in enumerate(records, start=1)}
+        # Serialized once, inline query results splice it in as is
+        self.message_content = json.dumps(
+            InputTextMessageContent(_leaderboard_text(records)).to_python(),
+            ensure_ascii=False
+        )
+
+    async def refresh(self) -> None:
+        self._set(await UserStatsDAO().top(self.size))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                log.exception('Failed to refresh the leaderboard')
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+game_config = GameConfig()
+leaderboard = Leaderboard(game_config.leaderboard_size, game_config.leaderboard_refresh_interval)
+
+
+def _streak_text(streak: int) -> str:
+    if streak > 0:
+        return f'🔥 Побед подряд: {streak}'
+    if streak < 0:
+        return f'Поражений подряд: {-streak}'
+    return ''
+
+
+@dp.message_handler(commands=['stats'])
+async def stats(message: Message):
+    user = message.from_user
+    user_stats = await UserStatsDAO().get(user_id=await resolve_user_id(user.id, user.full_name))
+    if user_stats is None:
+        return SendMessage(message.chat.id, 'Вы ещё не доиграли ни одной игры с другим игроком')
+
+    lines = [
+        f'📊 {user.full_name}',
+        f'Рейтинг: {user_stats["UserStats_rating"]:.0f}',
+        f'Победы: {user_stats["UserStats_wins"]}, ничьи: {user_stats["UserStats_draws"]}, '
+        f'поражения: {user_stats["UserStats_losses"]}',
+    ]
+    if streak := _streak_text(user_stats['UserStats_streak']):
+        lines.append(streak)
+    if place := leaderboard.places.get(user.id):
+        lines.append(f'🏆 Место в рейтинге: {place}')
+    return SendMessage(message.chat.id, '\n'.join(lines))
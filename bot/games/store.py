@@ -0,0 +1,291 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from time import monotonic
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from asyncpgsa import pg
+
+from DAO import (
+    TicTacToeGameDAO,
+    TicTacToePlayerDAO,
+    UserStatsDAO
+)
+from configs import GameConfig
+from games.board import CLASSIC, Board, Geometry, to_unsigned
+from instrumentation import db_call
+from metrics import Counter
+from models import (
+    EnumDifficulty,
+    EnumStatus,
+    TicTacToePlayer,
+    User
+)
+
+
+log = logging.getLogger(__name__)
+
+REJECTED_MOVES = Counter('game_writer_rejected_moves_total', 'Moves played in memory the database refused')
+
+
+class Player(NamedTuple):
+    id: int
+    user_id: int
+    tg_id: int
+    name: str
+    sign: str
+
+
+class GameState:
+    """
+    Authoritative in-process state of a single tic tac toe game
+    """
+    __slots__ = ('id', 'status', 'current_step_user_id', 'players', 'board', 'ai_difficulty', 'touched')
+
+    def __init__(
+            self,
+            game_id: int,
+            status: EnumStatus = EnumStatus.initial,
+            current_step_user_id: Optional[int] = None,
+            players: Optional[Dict[str, Player]] = None,
+            board: Board = Board(),
+            ai_difficulty: Optional[EnumDifficulty] = None
+    ):
+        self.id = game_id
+        self.status = status
+        self.current_step_user_id = current_step_user_id
+        self.players = players or {}
+        self.board = board
+        self.ai_difficulty = ai_difficulty
+        self.touched = monotonic()
+
+    def player_by_tg_id(self, tg_id: int) -> Optional[Player]:
+        for player in self.players.values():
+            if player.tg_id == tg_id:
+                return player
+        return None
+
+    def opponent(self, player: Player) -> Player:
+        return next(item for item in self.players.values() if item.id != player.id)
+
+    @property
+    def player_names(self) -> Dict[str, str]:
+        return {sign: player.name for sign, player in self.players.items()}
+
+
+class GameWriter:
+    """
+    Write-behind queue persisting game changes in batches
+    """
+
+    def __init__(self, flush_interval: float, batch_size: int, rating_k_factor: float):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.rating_k_factor = rating_k_factor
+        self._games: Dict[int, dict] = {}
+        self._moves: List[Tuple[int, int, int, Geometry]] = []
+        self._finished: List[int] = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Called with the ID of a game the database refused a move of, its state in memory is ahead of the database
+        self.on_rejected: Optional[Callable[[int], None]] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._games) + len(self._moves) + len(self._finished)
+
+    def update_game(self, game_id: int, **fields) -> None:
+        self._games.setdefault(game_id, {}).update(fields, updated=datetime.now())
+        self._notify()
+
+    def add_move(self, game_id: int, user_tg_id: int, position: int, geometry: Geometry = CLASSIC) -> None:
+        """
+        Queues a move, applied with `TicTacToeGameDAO.apply_move` which also passes the turn
+        and records the results when the move ends the game
+        """
+        self._moves.append((game_id, user_tg_id, position, geometry))
+        self._notify()
+
+    def finish_game(self, game_id: int) -> None:
+        """
+        Queues the results of a game finished by its last queued move, saved to the stats of the players
+        in the same transaction as the move
+        """
+        self._finished.append(game_id)
+        self._notify()
+
+    def _notify(self) -> None:
+        if self.pending >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        """
+        Persist everything queued so far in a single transaction
+        """
+        async with self._lock:
+            games, moves, finished = self._games, self._moves, self._finished
+            if not (games or moves or finished):
+                return None
+            self._games, self._moves, self._finished = {}, [], []
+            try:
+                with db_call('flush'):
+                    async with pg.transaction() as connection:
+                        await TicTacToeGameDAO().update_many(games, connection=connection)
+                        rejected = moves and await TicTacToeGameDAO().apply_moves(moves, connection=connection)
+                        if finished:
+                            await UserStatsDAO().record_results(
+                                finished,
+                                self.rating_k_factor,
+                                connection=connection
+                            )
+            except Exception:
+                for game_id, fields in self._games.items():
+                    games.setdefault(game_id, {}).update(fields)
+                self._games, self._moves = games, moves + self._moves
+                self._finished = finished + self._finished
+                raise
+        if rejected:
+            self._reject(rejected)
+
+    def _reject(self, moves: List[Tuple[int, int, int, Geometry]]) -> None:
+        """
+        Moves are refused when the game expired meanwhile or was played by another process
+        """
+        REJECTED_MOVES.inc(len(moves))
+        for game_id, user_tg_id, position, _ in moves:
+            log.warning('Move of user %s to cell %s of game %s was rejected', user_tg_id, position, game_id)
+        if self.on_rejected:
+            for game_id in {move[0] for move in moves}:
+                self.on_rejected(game_id)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Failed to flush %s pending game writes', self.pending)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class GameStore:
+    """
+    In-memory game states keyed by game id, loaded from the database on a miss.
+    A state not used for `max_idle` seconds is loaded again, as the game may have expired meanwhile
+    """
+
+    def __init__(self, writer: GameWriter, size: int, max_idle: float):
+        self.writer = writer
+        self.size = size
+        self.max_idle = max_idle
+        self._games: 'OrderedDict[int, GameState]' = OrderedDict()
+        self._loading: Dict[int, asyncio.Future] = {}
+        # Games the database refused a move of are loaded again
+        writer.on_rejected = self.discard
+
+    def add(self, state: GameState) -> GameState:
+        self._games[state.id] = state
+        self._games.move_to_end(state.id)
+        while len(self._games) > self.size:
+            self._games.popitem(last=False)
+        return state
+
+    def discard(self, game_id: int) -> None:
+        self._games.pop(game_id, None)
+
+    async def reset(self) -> None:
+        """
+        Persists pending changes and forgets all games, e.g. when other processes may have changed them
+        """
+        await self.writer.flush()
+        self._games.clear()
+
+    async def get(self, game_id: int) -> Optional[GameState]:
+        if state := self._games.get(game_id):
+            now = monotonic()
+            if now - state.touched < self.max_idle:
+                state.touched = now
+                self._games.move_to_end(game_id)
+                return state
+            del self._games[game_id]
+
+        if future := self._loading.get(game_id):
+            return await asyncio.shield(future)
+
+        future = self._loading[game_id] = asyncio.get_event_loop().create_future()
+        try:
+            state = await self._load(game_id)
+        except Exception as error:
+            future.set_exception(error)
+            future.exception()
+            raise
+        else:
+            future.set_result(state)
+        finally:
+            del self._loading[game_id]
+
+        return self.add(state) if state else None
+
+    async def _load(self, game_id: int) -> Optional[GameState]:
+        if self.writer.pending:
+            await self.writer.flush()
+
+        game = await TicTacToeGameDAO().get(id=game_id)
+        if not game:
+            return None
+        players = await TicTacToePlayerDAO().get_many(
+            joins=[(TicTacToePlayer, User, TicTacToePlayer.user_id == User.id)],
+            game_id=game_id
+        )
+        return GameState(
+            game_id,
+            status=EnumStatus[game['TicTacToeGame_status']],
+            current_step_user_id=game['TicTacToeGame_current_step_user_id'],
+            players={
+                player['TicTacToePlayer_sign']: Player(
+                    id=player['TicTacToePlayer_id'],
+                    user_id=player['User_id'],
+                    tg_id=player['User_tg_id'],
+                    name=player['User_name'],
+                    sign=player['TicTacToePlayer_sign']
+                )
+                for player in players
+            },
+            board=Board(
+                to_unsigned(game['TicTacToeGame_cross_board']),
+                to_unsigned(game['TicTacToeGame_circle_board']),
+                Geometry(game['TicTacToeGame_width'], game['TicTacToeGame_height'], game['TicTacToeGame_win_length'])
+            ),
+            ai_difficulty=game['TicTacToeGame_ai_difficulty'] and EnumDifficulty[game['TicTacToeGame_ai_difficulty']]
+        )
+
+
+game_config = GameConfig()
+game_store = GameStore(
+    GameWriter(
+        flush_interval=game_config.flush_interval,
+        batch_size=game_config.flush_batch_size,
+        rating_k_factor=game_config.rating_k_factor
+    ),
+    size=game_config.store_size,
+    max_idle=game_config.stale_timeout
+)
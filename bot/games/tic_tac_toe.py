@@ -1,231 +1,330 @@
-import json
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Optional
 
+from aiogram.dispatcher.webhook import AnswerCallbackQuery
 from aiogram.types import CallbackQuery
 
 from DAO import (
-    UserDAO,
     TicTacToeGameDAO,
-    TicTacToePlayerDAO,
-    TicTacToeStepDAO
+    TicTacToePlayerDAO
 )
+from callbacks import SIGNS, AICallback, CallbackKind, FieldCallback, SignCallback
+from configs import GameConfig
 from constants import CACHE_TIME
-from keyboards.tic_tac_toe import create_filed, create_sign_selection
-from misc import dp
-from models import (
-    EnumSign,
-    EnumStatus,
-    TicTacToePlayer,
-    TicTacToeStep,
-    User
-)
+from games import ai
+from games.board import CLASSIC, VARIANTS, Board, check_win, reachable_boards
+from games.store import GameState, Player, game_store
+from keyboards.tic_tac_toe import FIELD_CACHE_SIZE, create_filed, create_sign_selection
+from misc import bot, outgoing, router
+from models import EnumDifficulty, EnumSign, EnumStatus
+from users import resolve_user_id
 
+ai_accuracy = GameConfig().ai_imperfect_accuracy
 
-async def check_win(steps: Dict[int, str]) -> Optional[str]:
-    base_field = [[None for _ in range(3)] for _ in range(3)]
-    for position, sign in steps.items():
-        base_field[position // 3][position % 3] = sign
 
-    def check_row(row):
-        sign = row[0]
-        return sign if all(item == sign and item for item in row) else None
+_PLAYERS_CAPTION = '❌ {cross}\n⭕️ {circle}'.format
+_END_GAME_CAPTIONS = {
+    None: '❌ {cross}️ 🤝\n⭕{circle} 🤝'.format,
+    'cross': '❌ {cross}️ 🎉\n⭕{circle} 💩'.format,
+    'circle': '❌ {cross}️ 💩\n⭕{circle} 🎉'.format,
+}
 
-    for field in (base_field, zip(*base_field)):
-        for row in field:
-            if sign := check_row(row):
-                return sign
 
-    main_diagonal = [base_field[i][i] for i in range(3)]
-    side_diagonal = [row[index] for row, index in zip(base_field, range(-1, -4, -1))]
+@lru_cache(maxsize=FIELD_CACHE_SIZE)
+def create_end_game_field(board: Board) -> str:
+    signs = {'cross': '❌', 'circle': '⭕️', None: '⬜️'}
+    width = board.geometry.width
 
-    for diagonal in (main_diagonal, side_diagonal):
-        if sign := check_row(diagonal):
-            return sign
+    return '\n'.join(
+        ''.join(signs[board.get(row * width + column)] for column in range(width))
+        for row in range(board.geometry.height)
+    )
 
-    return None
 
+def create_players_caption_template(cross: str = '❓', circle: str = '❓') -> str:
+    return _PLAYERS_CAPTION(cross=cross, circle=circle)
 
-async def create_end_game_field(steps: Dict[int, str]) -> str:
-    signs = {'cross': '❌', 'circle': '⭕️', None: '⬜️'}
 
-    field = [[None for _ in range(3)] for _ in range(3)]
-    for row_index, row in enumerate(field):
-        for column_index, _ in enumerate(row):
-            row[column_index] = signs[steps.get(row_index * 3 + column_index)]
+def create_players_end_game_template(cross: str, circle: str, winner: Optional[str] = None) -> str:
+    """
+    :param winner: sign of the winner, a draw if not set
+    """
+    return _END_GAME_CAPTIONS[winner](cross=cross, circle=circle)
 
-    return '\n'.join([''.join(row) for row in field])
 
+def warm_up() -> None:
+    for board in reachable_boards():
+        create_end_game_field(board)
+    ai.warm_up()
 
-async def create_players_caption_template(cross: str = '❓', circle: str = '❓') -> str:
-    return f'❌ {cross}\n⭕️ {circle}'
 
+def _play(state: GameState, player: Player, position: int) -> Optional[str]:
+    """
+    Places the move of the player on a free cell and queues it to be persisted
 
-async def create_players_end_game_template(cross: str, circle: str, winner: Optional[str] = None) -> str:
-    if not winner:
-        cross_status = circle_status = '🤝'
-    else:
-        cross_status = '🎉' if winner == cross else '💩'
-        circle_status = '🎉' if winner == circle else '💩'
-    return f'❌ {cross}️ {cross_status}\n⭕{circle} {circle_status}'
+    :return: end game caption if the move finished the game
+    """
+    state.board = state.board.place(position, player.sign)
+    game_store.writer.add_move(state.id, player.tg_id, position, state.board.geometry)
+    if sign := check_win(state.board, position):
+        return create_players_end_game_template(**state.player_names, winner=sign)
+    if state.board.is_full:
+        return create_players_end_game_template(**state.player_names)
+    state.current_step_user_id = state.opponent(player).user_id
+    return None
+
+
+async def _play_ai(state: GameState) -> Optional[str]:
+    """
+    Plays the move of the bot if it's its turn in a game against it
 
+    :return: end game caption if the move finished the game
+    """
+    if state.ai_difficulty is None:
+        return None
+    ai_player = state.player_by_tg_id((await bot.me).id)
+    if ai_player is None or ai_player.user_id != state.current_step_user_id:
+        return None
+    return _play(state, ai_player, ai.choose_move(state.board, state.ai_difficulty, ai_accuracy))
 
-def callback_filter_by_name(query: CallbackQuery, name: str) -> bool:
-    query_data = json.loads(query.data)
-    return query_data['name'] == name
 
+async def _finish(state: GameState, inline_message_id: str, end_game_template: str) -> None:
+    state.status = EnumStatus.finished
+    if state.ai_difficulty is None:
+        game_store.writer.finish_game(state.id)
+    await game_store.writer.flush()
+    game_store.discard(state.id)
+    field = create_end_game_field(state.board)
+    outgoing.edit_text(inline_message_id, text=f'{end_game_template}\n\n{field}')
 
-@dp.callback_query_handler(lambda query: callback_filter_by_name(query, 'xo_sign'))
-async def sign_creation(query: CallbackQuery):
+
+@router.handler(CallbackKind.sign)
+async def sign_creation(query: CallbackQuery, button_data: SignCallback):
     user_id = query.from_user.id
     user_name = query.from_user.full_name
-    button_data = json.loads(query.data)
-    sign_value = 'cross' if button_data['sign'] == 'x' else 'circle'
+    sign_value = button_data.sign
     sign = EnumSign[sign_value]
-    user = await UserDAO().get_or_create(name=user_name, tg_id=user_id)
+    db_user_id = await resolve_user_id(user_id, user_name)
 
-    if button_data['id'] == user_id:
-        if button_data['game']:
-            await query.answer(
+    if button_data.game_starter_id == user_id:
+        if button_data.game_id:
+            return AnswerCallbackQuery(
+                query.id,
                 text='Вы уже выбрали сторону. Ждите 🕘🕥',
                 show_alert=True,
                 cache_time=CACHE_TIME
             )
         else:
+            variant = button_data.variant if button_data.variant < len(VARIANTS) else 0
+            geometry = VARIANTS[variant]
             game = await TicTacToeGameDAO().create(
-                current_step_user_id=user['User_id'] if sign == EnumSign.cross else None
+                current_step_user_id=db_user_id if sign == EnumSign.cross else None,
+                width=geometry.width,
+                height=geometry.height,
+                win_length=geometry.win_length,
+                inline_message_id=query.inline_message_id
             )
-            await TicTacToePlayerDAO().create(
-                user_id=user['User_id'],
+            player = await TicTacToePlayerDAO().create(
+                user_id=db_user_id,
                 game_id=game['TicTacToeGame_id'],
                 sign=sign
             )
-            await query.bot.edit_message_text(
-                text=await create_players_caption_template(**{sign_value: user_name}),
-                inline_message_id=query.inline_message_id,
-                reply_markup=await create_sign_selection(
-                    button_data['id'],
+            game_store.add(
+                GameState(
+                    game['TicTacToeGame_id'],
+                    current_step_user_id=game['TicTacToeGame_current_step_user_id'],
+                    players={
+                        sign_value: Player(
+                            id=player['TicTacToePlayer_id'],
+                            user_id=db_user_id,
+                            tg_id=user_id,
+                            name=user_name,
+                            sign=sign_value
+                        )
+                    },
+                    board=Board(geometry=geometry)
+                )
+            )
+            outgoing.edit_text(
+                query.inline_message_id,
+                text=create_players_caption_template(**{sign_value: user_name}),
+                reply_markup=create_sign_selection(
+                    button_data.game_starter_id,
                     game['TicTacToeGame_id'],
-                    selected_sign=sign_value
+                    selected_sign=sign_value,
+                    variant=variant
                 )
             )
-            await query.answer()
+            return AnswerCallbackQuery(query.id)
     else:
-        if game_id := button_data['game']:
-            game = await TicTacToeGameDAO().get(id=game_id)
-            current_step_user_id = game['TicTacToeGame_current_step_user_id'] or user['User_id']
-            await TicTacToePlayerDAO().create(
-                user_id=user['User_id'],
-                game_id=game['TicTacToeGame_id'],
+        if game_id := button_data.game_id:
+            state = await game_store.get(game_id)
+            if state is None or state.status != EnumStatus.initial:
+                return AnswerCallbackQuery(query.id)
+            current_step_user_id = state.current_step_user_id or db_user_id
+            player = await TicTacToePlayerDAO().create(
+                user_id=db_user_id,
+                game_id=game_id,
                 sign=sign
             )
-            await TicTacToeGameDAO().update_by_id(
+            state.players[sign_value] = Player(
+                id=player['TicTacToePlayer_id'],
+                user_id=db_user_id,
+                tg_id=user_id,
+                name=user_name,
+                sign=sign_value
+            )
+            state.current_step_user_id = current_step_user_id
+            state.status = EnumStatus.in_progress
+            game_store.writer.update_game(
                 game_id,
                 current_step_user_id=current_step_user_id,
                 status=EnumStatus.in_progress
             )
-            players = await TicTacToePlayerDAO().get_many(
-                joins=[(TicTacToePlayer, User, TicTacToePlayer.user_id == User.id)],
-                game_id=game_id
-            )
-            player_signs = {player['TicTacToePlayer_sign']: player['User_name'] for player in players}
-            await query.bot.edit_message_text(
-                text=await create_players_caption_template(**player_signs),
-                inline_message_id=query.inline_message_id,
-                reply_markup=await create_filed(game['TicTacToeGame_id'])
+            outgoing.edit_text(
+                query.inline_message_id,
+                text=create_players_caption_template(**state.player_names),
+                reply_markup=create_filed(game_id, state.board)
             )
-            await query.answer()
+            return AnswerCallbackQuery(query.id)
         else:
-            await query.answer(
+            return AnswerCallbackQuery(
+                query.id,
                 text='Первым выбирает сторону создатель игры. Ждите 🕘🕥',
                 show_alert=True,
                 cache_time=CACHE_TIME
             )
 
 
-@dp.callback_query_handler(lambda query: callback_filter_by_name(query, 'xo_field'))
-async def game(query: CallbackQuery):
+@router.handler(CallbackKind.field)
+async def game(query: CallbackQuery, button_data: FieldCallback):
     user_id = query.from_user.id
-    user_name = query.from_user.full_name
-    button_data = json.loads(query.data)
-    game = await TicTacToeGameDAO().get(id=button_data['game_id'])
-    user = await UserDAO().get_or_create(name=user_name, tg_id=user_id)
-    players = await TicTacToePlayerDAO().get_many(
-        joins=[(TicTacToePlayer, User, TicTacToePlayer.user_id == User.id)],
-        game_id=button_data['game_id']
-    )
+    state = await game_store.get(button_data.game_id)
+    # Callback data comes from the client, a cell off the board is no button of the game
+    if state is None or not 0 <= button_data.position < state.board.geometry.cells:
+        return AnswerCallbackQuery(query.id)
+    player = state.player_by_tg_id(user_id)
 
-    players_tg_ids = [player['User_tg_id'] for player in players]
-    if user_id not in players_tg_ids:
-        await query.answer(
+    if not player:
+        return AnswerCallbackQuery(
+            query.id,
             text='Вы не принимаете участия в этой игре',
             show_alert=True,
             cache_time=CACHE_TIME
         )
 
-    if user['User_id'] == game['TicTacToeGame_current_step_user_id']:
-        step = await TicTacToeStepDAO().get(
-            joins=[(TicTacToeStep, TicTacToePlayer, TicTacToeStep.player_id == TicTacToePlayer.id)],
-            game_id=(TicTacToePlayer, game['TicTacToeGame_id']),
-            position=button_data['pos']
-        )
-        if step:
-            await query.answer(
+    if state.status == EnumStatus.in_progress and player.user_id == state.current_step_user_id:
+        position = button_data.position
+        if not state.board.is_free(position):
+            return AnswerCallbackQuery(
+                query.id,
                 text='Клетка занята. Выберите другую',
                 show_alert=True,
                 cache_time=CACHE_TIME
             )
         else:
-            current_player = next(filter(lambda player: player['User_tg_id'] == user_id, players))
-            next_player = next(filter(lambda player: player['User_tg_id'] != user_id, players))
-            await TicTacToeStepDAO().create(
-                position=button_data['pos'],
-                player_id=current_player['TicTacToePlayer_id']
-            )
-
-            steps = await TicTacToeStepDAO().get_many(
-                joins=[(TicTacToeStep, TicTacToePlayer, TicTacToeStep.player_id == TicTacToePlayer.id)],
-                game_id=(TicTacToePlayer, game['TicTacToeGame_id'])
-            )
-            positions = {step['TicTacToeStep_position']: step['TicTacToePlayer_sign'] for step in steps}
-            players_signs = {player['TicTacToePlayer_sign']: player['User_name'] for player in players}
-
-            end_game_template = None
-            if sign := await check_win(positions):
-                if current_player['TicTacToePlayer_sign'] == sign:
-                    winner, looser = current_player, next_player
-                else:
-                    winner, looser = next_player, current_player
-                await TicTacToePlayerDAO().update_by_id(winner['TicTacToePlayer_id'], is_winner=True)
-                await TicTacToePlayerDAO().update_by_id(looser['TicTacToePlayer_id'], is_winner=False)
-                end_game_template = await create_players_end_game_template(**players_signs, winner=winner['User_name'])
-            elif len(positions) == 9:
-                await TicTacToePlayerDAO().update_by_id(current_player['TicTacToePlayer_id'], is_winner=False)
-                await TicTacToePlayerDAO().update_by_id(next_player['TicTacToePlayer_id'], is_winner=False)
-                end_game_template = await create_players_end_game_template(**players_signs)
-
-            if end_game_template:
-                await TicTacToeGameDAO().update_by_id(game['TicTacToeGame_id'], status=EnumStatus.finished)
-                field = await create_end_game_field(positions)
-                await query.bot.edit_message_text(
-                    text=f'{end_game_template}\n\n{field}',
-                    inline_message_id=query.inline_message_id,
-                )
-                await query.answer()
-                return None
-
-            await query.bot.edit_message_reply_markup(
-                inline_message_id=query.inline_message_id,
-                reply_markup=await create_filed(game['TicTacToeGame_id'], positions)
-            )
+            if end_game_template := _play(state, player, position) or await _play_ai(state):
+                await _finish(state, query.inline_message_id, end_game_template)
+                return AnswerCallbackQuery(query.id)
 
-            await TicTacToeGameDAO().update_by_id(
-                game['TicTacToeGame_id'],
-                current_step_user_id=next_player['User_id']
+            outgoing.edit_reply_markup(
+                query.inline_message_id,
+                reply_markup=create_filed(state.id, state.board)
             )
-            await query.answer()
+            return AnswerCallbackQuery(query.id)
     else:
-        await query.answer(
+        return AnswerCallbackQuery(
+            query.id,
             text='Сейчас не ваш ход. Ждите 🕘🕥',
             show_alert=True,
             cache_time=CACHE_TIME
         )
+
+
+@router.handler(CallbackKind.ai)
+async def ai_creation(query: CallbackQuery, button_data: AICallback):
+    user_id = query.from_user.id
+    if button_data.game_starter_id != user_id:
+        return AnswerCallbackQuery(
+            query.id,
+            text='Играть с ботом может только создатель игры',
+            show_alert=True,
+            cache_time=CACHE_TIME
+        )
+
+    user_name = query.from_user.full_name
+    db_user_id = await resolve_user_id(user_id, user_name)
+    me = await bot.me
+    ai_user_id = await resolve_user_id(me.id, me.full_name)
+    difficulty = EnumDifficulty[button_data.difficulty]
+
+    if game_id := button_data.game_id:
+        # The bot joins the game the starter created, taking the sign left
+        state = await game_store.get(game_id)
+        if state is None or state.status != EnumStatus.initial or state.board.geometry != CLASSIC:
+            return AnswerCallbackQuery(query.id)
+        ai_sign = next(sign for sign in SIGNS if sign not in state.players)
+        ai_player = await TicTacToePlayerDAO().create(
+            user_id=ai_user_id,
+            game_id=game_id,
+            sign=EnumSign[ai_sign]
+        )
+        state.current_step_user_id = state.current_step_user_id or ai_user_id
+        state.status = EnumStatus.in_progress
+        state.ai_difficulty = difficulty
+        game_store.writer.update_game(
+            game_id,
+            current_step_user_id=state.current_step_user_id,
+            status=EnumStatus.in_progress,
+            ai_difficulty=difficulty
+        )
+    else:
+        ai_sign = 'circle'
+        game = await TicTacToeGameDAO().create(
+            current_step_user_id=db_user_id,
+            status=EnumStatus.in_progress,
+            ai_difficulty=difficulty,
+            inline_message_id=query.inline_message_id
+        )
+        game_id = game['TicTacToeGame_id']
+        players = {
+            player['TicTacToePlayer_sign']: player
+            for player in await TicTacToePlayerDAO().create_many([
+                {'user_id': db_user_id, 'game_id': game_id, 'sign': EnumSign.cross},
+                {'user_id': ai_user_id, 'game_id': game_id, 'sign': EnumSign.circle},
+            ])
+        }
+        ai_player = players[ai_sign]
+        state = game_store.add(
+            GameState(
+                game_id,
+                status=EnumStatus.in_progress,
+                current_step_user_id=db_user_id,
+                players={
+                    'cross': Player(
+                        id=players['cross']['TicTacToePlayer_id'],
+                        user_id=db_user_id,
+                        tg_id=user_id,
+                        name=user_name,
+                        sign='cross'
+                    )
+                },
+                ai_difficulty=difficulty
+            )
+        )
+    state.players[ai_sign] = Player(
+        id=ai_player['TicTacToePlayer_id'],
+        user_id=ai_user_id,
+        tg_id=me.id,
+        name=me.full_name,
+        sign=ai_sign
+    )
+
+    # The bot opens the game if it plays cross, the first move can't end it
+    await _play_ai(state)
+    outgoing.edit_text(
+        query.inline_message_id,
+        text=create_players_caption_template(**state.player_names),
+        reply_markup=create_filed(game_id, state.board)
+    )
+    return AnswerCallbackQuery(query.id)
@@ -0,0 +1,94 @@
+"""
+Handling of repeated updates: Telegram delivers an update again when the webhook reply failed,
+and users tap a button again before the message changes
+"""
+import asyncio
+from typing import Awaitable, Callable, Hashable, Tuple
+
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import AnswerCallbackQuery, BaseResponse
+from aiogram.types import CallbackQuery, Update
+
+from cache import TTLCache
+from metrics import Counter
+
+DUPLICATES = Counter('duplicate_updates_total', 'Repeated updates answered without handling them', ('reason',))
+
+
+def _tap_key(query: CallbackQuery) -> Tuple[int, Hashable, str]:
+    message = query.inline_message_id or (query.message and (query.message.chat.id, query.message.message_id))
+    return query.from_user.id, message, query.data
+
+
+def _for_query(answer: BaseResponse, query_id: str) -> BaseResponse:
+    """
+    :return: the answer addressed to another callback query
+    """
+    if isinstance(answer, AnswerCallbackQuery) and answer.callback_query_id != query_id:
+        return AnswerCallbackQuery(query_id, answer.text, answer.show_alert, answer.url, answer.cache_time)
+    return answer
+
+
+class CallbackDeduplicator:
+    """
+    Answers a callback query delivered again, or a tap of a user repeating their previous tap
+    of the same button within `repeat_ttl` seconds, with the answer to the first one,
+    waiting for it if it's still being handled. Taps answered with a notification,
+    e.g. when it's not the turn of the user, are handled again, as the game may have changed meanwhile
+    """
+
+    def __init__(self, size: int, ttl: float, repeat_ttl: float):
+        self._queries: TTLCache[asyncio.Future] = TTLCache(size, ttl)
+        self._taps: TTLCache[asyncio.Future] = TTLCache(size, repeat_ttl)
+
+    async def run(self, query: CallbackQuery, handle: Callable[[], Awaitable[BaseResponse]]) -> BaseResponse:
+        tap = _tap_key(query)
+        for reason, cache, key in (('callback_query', self._queries, query.id), ('tap', self._taps, tap)):
+            if first := cache.get(key):
+                DUPLICATES.labels(reason).inc()
+                try:
+                    return _for_query(await asyncio.shield(first), query.id)
+                except asyncio.CancelledError:
+                    if not first.cancelled():
+                        raise
+                # Handling of the first one was cancelled, this one is handled instead
+                return await self.run(query, handle)
+
+        future = asyncio.get_event_loop().create_future()
+        self._queries.set(query.id, future)
+        self._taps.set(tap, future)
+        try:
+            answer = await handle()
+        except BaseException as error:
+            # Cancelled too, e.g. when the webhook request is dropped, Telegram delivers the query again
+            self._queries.pop(query.id)
+            self._taps.pop(tap)
+            if isinstance(error, Exception):
+                future.set_exception(error)
+                future.exception()
+            else:
+                future.cancel()
+            raise
+        future.set_result(answer)
+        if not isinstance(answer, AnswerCallbackQuery) or answer.text:
+            self._taps.pop(tap)
+        return answer
+
+
+class UpdateDeduplicationMiddleware(BaseMiddleware):
+    """
+    Skips updates delivered again. Callback queries pass, `CallbackDeduplicator` answers them again
+    """
+
+    def __init__(self, size: int, ttl: float):
+        super().__init__()
+        self._seen: TTLCache[bool] = TTLCache(size, ttl)
+
+    async def on_pre_process_update(self, update: Update, data: dict):
+        if update.callback_query:
+            return None
+        if self._seen.get(update.update_id):
+            DUPLICATES.labels('update').inc()
+            raise CancelHandler()
+        self._seen.set(update.update_id, True)
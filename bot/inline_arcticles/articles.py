@@ -1,18 +1,47 @@
+from functools import lru_cache
+
 from aiogram.types import (
     InlineQueryResultArticle,
     InputTextMessageContent
 )
 
+from games.board import VARIANTS
+from games.stats import leaderboard
 from games.tic_tac_toe import create_players_caption_template
+from keyboards.template import JsonTemplate, marker
 from keyboards.tic_tac_toe import create_sign_selection
 
 
-async def create_tic_tac_toe_inline_article(game_starter_id: int):
+@lru_cache(maxsize=None)
+def _tic_tac_toe_inline_results_template() -> JsonTemplate:
+    articles = []
+    for variant, geometry in enumerate(VARIANTS):
+        article = InlineQueryResultArticle(
+            id=str(variant + 1),
+            title='Tic Tac Toe' if variant == 0 else f'Tic Tac Toe {geometry.width}×{geometry.height}',
+            description=f'Tic Tac Toe Game, {geometry.width}×{geometry.height}, {geometry.win_length} в ряд',
+            input_message_content=InputTextMessageContent(create_players_caption_template())
+        )
+        articles.append({**article.to_python(), 'reply_markup': marker(f'reply_markup_{variant}')})
     article = InlineQueryResultArticle(
-        id='1',
-        title='Tic Tac Toe',
-        description='Tic Tac Toe Game',
-        input_message_content=InputTextMessageContent(await create_players_caption_template()),
-        reply_markup=await create_sign_selection(game_starter_id)
+        id='leaderboard',
+        title='🏆 Рейтинг игроков',
+        description='Лучшие игроки по рейтингу Эло',
+        input_message_content=InputTextMessageContent('')
+    )
+    articles.append({**article.to_python(), 'input_message_content': marker('leaderboard')})
+    return JsonTemplate(articles)
+
+
+async def create_tic_tac_toe_inline_article(game_starter_id: int) -> str:
+    """
+    :return: serialized inline query results, an article per board variant and the leaderboard,
+        sent to Telegram as is
+    """
+    return _tic_tac_toe_inline_results_template().render(
+        leaderboard=leaderboard.message_content,
+        **{
+            f'reply_markup_{variant}': create_sign_selection(game_starter_id, variant=variant)
+            for variant in range(len(VARIANTS))
+        }
     )
-    return article
@@ -0,0 +1,122 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import chain
+from time import perf_counter
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import BaseResponse
+from aiogram.types import CallbackQuery, InlineQuery, Update
+from aiohttp import web
+
+import metrics
+from metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+HANDLER_SECONDS = Histogram('handler_seconds', 'Time to process an update by handler', ('handler',))
+UPDATE_DB_CALLS = Histogram('update_db_calls', 'Database round trips per update', buckets=COUNT_BUCKETS)
+UPDATE_DB_SECONDS = Histogram('update_db_seconds', 'Time spent in the database per update')
+DB_CALL_SECONDS = Histogram('db_call_seconds', 'Duration of database calls', ('operation',))
+TELEGRAM_CALL_SECONDS = Histogram('telegram_call_seconds', 'Duration of Telegram API calls', ('method',))
+TELEGRAM_CALL_ERRORS = Counter('telegram_call_errors_total', 'Failed Telegram API calls', ('method',))
+WEBHOOK_REPLIES = Counter('telegram_webhook_replies_total', 'Telegram methods answered in the webhook reply', ('method',))
+
+
+class UpdateStats:
+    __slots__ = ('handler', 'started', 'db_calls', 'db_seconds')
+
+    def __init__(self):
+        self.handler = 'unhandled'
+        self.started = perf_counter()
+        self.db_calls = 0
+        self.db_seconds = 0.0
+
+
+_update_stats: ContextVar[Optional[UpdateStats]] = ContextVar('update_stats', default=None)
+
+
+@contextmanager
+def db_call(operation: str):
+    """
+    Times a database call, adding it to the stats of the update being processed
+    """
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - started
+        DB_CALL_SECONDS.labels(operation).observe(elapsed)
+        if stats := _update_stats.get():
+            stats.db_calls += 1
+            stats.db_seconds += elapsed
+
+
+class InstrumentedBot(Bot):
+    """
+    Bot timing every API call
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception:
+            TELEGRAM_CALL_ERRORS.labels(method).inc()
+            raise
+        finally:
+            TELEGRAM_CALL_SECONDS.labels(method).observe(perf_counter() - started)
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    """
+    Records the handler latency and the database usage of every update
+    """
+
+    async def on_pre_process_update(self, update: Update, data: dict):
+        _update_stats.set(UpdateStats())
+
+    async def on_pre_process_inline_query(self, query: InlineQuery, data: dict):
+        if stats := _update_stats.get():
+            stats.handler = 'inline_query'
+
+    async def on_post_process_callback_query(self, query: CallbackQuery, results: list, data: dict):
+        if stats := _update_stats.get():
+            callback_data = data.get('callback_data')
+            stats.handler = f'callback_{callback_data.kind.name}' if callback_data else 'callback_unknown'
+
+    async def on_post_process_update(self, update: Update, results: list, data: dict):
+        stats = _update_stats.get()
+        if stats is None:
+            return None
+        elapsed = perf_counter() - stats.started
+        HANDLER_SECONDS.labels(stats.handler).observe(elapsed)
+        UPDATE_DB_CALLS.observe(stats.db_calls)
+        UPDATE_DB_SECONDS.observe(stats.db_seconds)
+        for response in chain.from_iterable(result for result in results if isinstance(result, list)):
+            if isinstance(response, BaseResponse):
+                WEBHOOK_REPLIES.labels(response.method).inc()
+        log.info(
+            'Update %s handled by %s in %.1f ms, %s database calls',
+            update.update_id, stats.handler, elapsed * 1000, stats.db_calls
+        )
+
+
+async def metrics_handler(_: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    Serves the metrics in the Prometheus text format on /metrics
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,40 @@
+import json
+import re
+from typing import Any, Tuple
+
+_MARKER = re.compile(r'@(\w+)@')
+_QUOTED_MARKER = re.compile(r'"(@\w+@)"')
+
+
+def marker(name: str) -> str:
+    """
+    :param name: name of the value spliced in on render
+
+    :return: placeholder surviving JSON serialization unchanged
+    """
+    return f'@{name}@'
+
+
+class JsonTemplate:
+    """
+    Pre-serialized Telegram payload with per-message values spliced in on render.
+    A marker standing for a whole JSON value is rendered bare, so it takes serialized JSON
+    """
+    __slots__ = ('_parts', '_names')
+
+    def __init__(self, payload: Any):
+        if hasattr(payload, 'to_python'):
+            payload = payload.to_python()
+        if isinstance(payload, list):
+            payload = [item.to_python() if hasattr(item, 'to_python') else item for item in payload]
+        chunks = _MARKER.split(_QUOTED_MARKER.sub(r'\1', json.dumps(payload, ensure_ascii=False)))
+        self._parts: Tuple[str, ...] = tuple(chunks[::2])
+        self._names: Tuple[str, ...] = tuple(chunks[1::2])
+
+    def render(self, **values) -> str:
+        parts = self._parts
+        result = [parts[0]]
+        for index, name in enumerate(self._names, start=1):
+            result.append(str(values[name]))
+            result.append(parts[index])
+        return ''.join(result)
@@ -1,51 +1,93 @@
-import json
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Optional
 
 from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
 
+from callbacks import AICallback, FieldCallback, SignCallback, encode, encode_int
+from games.board import VARIANTS, Board, reachable_boards
+from keyboards.template import JsonTemplate, marker
 
-async def create_filed(game_id: int, positions: Optional[Dict[int, str]] = None) -> InlineKeyboardMarkup:
-    if not positions:
-        positions = {}
-    signs = {'cross': '❌', 'circle': '⭕️', 'empty': '⬜️'}
+# Field keyboards kept rendered, every reachable classic board fits
+FIELD_CACHE_SIZE = 20000
+
+
+@lru_cache(maxsize=FIELD_CACHE_SIZE)
+def _field_template(board: Board) -> JsonTemplate:
+    signs = {'cross': '❌', 'circle': '⭕️', None: '⬜️'}
     buttons = (
         InlineKeyboardButton(
-            signs[positions.get(position, 'empty')],
-            callback_data=json.dumps({
-                'name': 'xo_field',
-                'game_id': game_id,
-                'pos': position
-            }).replace(' ', '')
+            signs[board.get(position)],
+            callback_data=encode(FieldCallback(marker('game_id'), position))
         )
-        for position in range(9)
+        for position in range(board.geometry.cells)
     )
 
-    return InlineKeyboardMarkup().add(*buttons)
+    return JsonTemplate(InlineKeyboardMarkup(row_width=board.geometry.width).add(*buttons))
 
 
-async def create_sign_selection(
-        game_starter_id: int,
-        game_id: Optional[int] = None,
-        selected_sign: Optional[str] = None
-) -> InlineKeyboardMarkup:
-    signs = {'cross': ('❌', 'x'), 'circle': ('⭕️', 'o')}
+@lru_cache(maxsize=None)
+def _sign_selection_template(with_game: bool, selected_sign: Optional[str], variant: int) -> JsonTemplate:
+    signs = {'cross': '❌', 'circle': '⭕️'}
     signs.pop(selected_sign, None)
+    # The bot only plays the classic board
+    difficulties = {} if variant else {'random': '🤖 Легко', 'imperfect': '🤖 Средне', 'perfect': '🤖 Сложно'}
+    game = marker('game_id') if with_game else None
     buttons = (
         InlineKeyboardButton(
             sign,
-            callback_data=json.dumps(
-                {
-                    'name': 'xo_sign',
-                    'id': game_starter_id,
-                    'sign': sign_name,
-                    'game': game_id
-                }
-            ).replace(' ', '')
+            callback_data=encode(SignCallback(marker('game_starter_id'), sign_name, game, variant))
         )
-        for sign, sign_name in signs.values()
+        for sign_name, sign in signs.items()
+    )
+    ai_buttons = (
+        InlineKeyboardButton(
+            difficulty,
+            callback_data=encode(AICallback(marker('game_starter_id'), difficulty_name, game))
+        )
+        for difficulty_name, difficulty in difficulties.items()
+    )
+
+    keyboard = InlineKeyboardMarkup().add(*buttons)
+    if difficulties:
+        keyboard.row(*ai_buttons)
+
+    return JsonTemplate(keyboard)
+
+
+def create_filed(game_id: int, board: Board = Board()) -> str:
+    """
+    :return: serialized reply_markup, sent to Telegram as is
+    """
+    return _field_template(board).render(game_id=encode_int(game_id))
+
+
+def create_sign_selection(
+        game_starter_id: int,
+        game_id: Optional[int] = None,
+        selected_sign: Optional[str] = None,
+        variant: int = 0
+) -> str:
+    """
+    :param variant: index of the board in `games.board.VARIANTS`
+
+    :return: serialized reply_markup, sent to Telegram as is
+    """
+    return _sign_selection_template(game_id is not None, selected_sign, variant).render(
+        game_starter_id=encode_int(game_starter_id),
+        game_id=None if game_id is None else encode_int(game_id)
     )
 
-    return InlineKeyboardMarkup().add(*buttons)
+
+def warm_up() -> None:
+    """
+    Render keyboards of every reachable board ahead of the first request
+    """
+    for board in reachable_boards():
+        _field_template(board)
+    for selected_sign in (None, 'cross', 'circle'):
+        for with_game in (False, True):
+            for variant in range(len(VARIANTS)):
+                _sign_selection_template(with_game, selected_sign, variant)
@@ -0,0 +1,57 @@
+import logging
+import random
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from typing import Sequence
+
+LOG_FORMAT = '%(asctime)s %(levelname)s:%(name)s:%(message)s'
+# Loggers writing a record per update
+SAMPLED_LOGGERS = ('instrumentation', 'aiohttp.access')
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes a `rate` share of info and debug records of the given loggers, and everything else
+    """
+
+    def __init__(self, rate: float, loggers: Sequence[str]):
+        super().__init__()
+        self.rate = rate
+        self.loggers = frozenset(loggers)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or record.name not in self.loggers or random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Never blocks the event loop: records are written by a listener thread and dropped if it falls behind
+    """
+
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def setup_logging(level: str, sample_rate: float, queue_size: int = 10000) -> QueueListener:
+    """
+    :return: started listener writing records to stderr, stop it to flush them on exit
+    """
+    queue = Queue(queue_size)
+    handler = DroppingQueueHandler(queue)
+    handler.addFilter(SamplingFilter(sample_rate, SAMPLED_LOGGERS))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [handler]
+    listener = QueueListener(queue, stream_handler)
+    listener.start()
+    return listener
@@ -1,40 +1,142 @@
 import logging
 from asyncio import get_event_loop
+from functools import partial
 
-from aiogram import executor
+from aiogram.dispatcher.webhook import AnswerInlineQuery
 from aiogram.types import InlineQuery
-from asyncpgsa import pg
+from aiogram.utils.executor import Executor
 
+import catchup
 import games.tic_tac_toe
-from configs import DataBaseConfig
+import keyboards.tic_tac_toe
+from DAO import statements
+from configs import BotConfig, MonitoringConfig
+from configs.bot import RunMode
 from constants import CACHE_TIME
+from games.reaper import reaper
+from games.stats import leaderboard
+from games.store import game_store
 from inline_arcticles.articles import create_tic_tac_toe_inline_article
-from misc import dp
-
-
-logging.basicConfig(level=logging.INFO)
+from instrumentation import start_metrics_server
+from logs import setup_logging
+from misc import dp, outgoing
+from sharding import Front, Worker
+from startup import init_connection, phase
+from webhook import BoundedWebhookRequestHandler, create_web_app, run_web_app, set_webhook
 
 
 @dp.inline_handler()
 async def main_inline(query: InlineQuery):
-    item = await create_tic_tac_toe_inline_article(game_starter_id=query.from_user.id)
-    await query.answer(results=[item], cache_time=CACHE_TIME, is_personal=True)
-
-
-async def init_connection():
-    db_config = DataBaseConfig()
-    await pg.init(
-        host=db_config.host,
-        port=db_config.port,
-        database=db_config.name,
-        user=db_config.user,
-        password=db_config.password.get_secret_value(),
-        min_size=5,
-        max_size=10
+    results = await create_tic_tac_toe_inline_article(game_starter_id=query.from_user.id)
+    return AnswerInlineQuery(query.id, results=results, cache_time=CACHE_TIME, is_personal=True)
+
+
+async def on_startup(_):
+    with phase('game tables'):
+        games.tic_tac_toe.warm_up()
+    with phase('keyboards'):
+        keyboards.tic_tac_toe.warm_up()
+    game_store.writer.start()
+    outgoing.start()
+    reaper.start()
+    leaderboard.start()
+
+
+async def catch_up_backlog(_):
+    await catchup.catch_up(dp.bot, catchup.handler(dp), BotConfig().catch_up_concurrency)
+
+
+async def start_metrics(_):
+    config = MonitoringConfig()
+    if config.metrics_port:
+        await start_metrics_server(config.metrics_host, config.metrics_port)
+
+
+async def on_shutdown(_):
+    await reaper.stop()
+    await leaderboard.stop()
+    await game_store.writer.stop()
+    await outgoing.stop()
+    logging.info('Statement cache: %s', statements.stats())
+
+
+def run_front(bot_config: BotConfig, event_loop):
+    """
+    Receive updates in this process and handle them in `bot_config.workers` worker processes
+    """
+    metrics_port = MonitoringConfig().metrics_port
+    # Telegram limits the bot as a whole, so each worker gets its share of the global limits
+    limits = {
+        'OUTGOING_RATE': bot_config.outgoing_rate / bot_config.workers,
+        'OUTGOING_BURST': max(bot_config.outgoing_burst / bot_config.workers, 1),
+        'CALLBACK_RATE': bot_config.callback_rate / bot_config.workers,
+        'CALLBACK_BURST': max(bot_config.callback_burst / bot_config.workers, 1),
+    }
+    front = Front(
+        [
+            Worker(
+                number,
+                '127.0.0.1',
+                bot_config.worker_base_port + number,
+                bot_config.webhook_path,
+                metrics_port=metrics_port and metrics_port + 1 + number,
+                env={name: str(value) for name, value in limits.items()}
+            )
+            for number in range(bot_config.workers)
+        ],
+        health_check_interval=bot_config.health_check_interval
+    )
+
+    async def start_webhook(_):
+        await front.wait_for_workers()
+        await catchup.catch_up(dp.bot, partial(front.catch_up_update, dp.bot), bot_config.catch_up_concurrency)
+        await set_webhook(dp)
+
+    async def close_bot(_):
+        await dp.bot.close()
+
+    web_app = front.create_web_app(bot_config.webhook_path)
+    web_app.on_startup.append(start_metrics)
+    web_app.on_startup.append(start_webhook)
+    web_app.on_shutdown.append(close_bot)
+    run_web_app(web_app, bot_config.webapp_host, int(bot_config.webapp_port), event_loop)
+
+
+def run_webhook(bot_config: BotConfig, event_loop, executor: Executor):
+    is_worker = bot_config.run_mode == RunMode.worker
+    web_app = create_web_app(bot_config.max_concurrent_updates, on_rebalance=game_store.reset if is_worker else None)
+    executor.set_webhook(
+        webhook_path=bot_config.webhook_path,
+        request_handler=BoundedWebhookRequestHandler,
+        web_app=web_app
     )
+    run_web_app(web_app, bot_config.webapp_host, int(bot_config.webapp_port), event_loop)
 
 
 if __name__ == '__main__':
+    bot_config = BotConfig()
+    monitoring_config = MonitoringConfig()
+    log_listener = setup_logging(monitoring_config.log_level, monitoring_config.log_sample_rate)
     event_loop = get_event_loop()
-    event_loop.run_until_complete(init_connection())
-    executor.start_polling(dp, loop=event_loop, skip_updates=True)
+    try:
+        if bot_config.is_prod and bot_config.workers:
+            run_front(bot_config, event_loop)
+        else:
+            event_loop.run_until_complete(init_connection())
+            # Workers get updates from the front process, which sets the webhook
+            is_worker = bot_config.run_mode == RunMode.worker
+            executor = Executor(dp, loop=event_loop)
+            executor.on_startup(on_startup)
+            executor.on_startup(start_metrics)
+            if not is_worker:
+                executor.on_startup(catch_up_backlog)
+            executor.on_shutdown(on_shutdown)
+            if bot_config.is_prod:
+                executor.on_startup(set_webhook, polling=False)
+                run_webhook(bot_config, event_loop, executor)
+            elif is_worker:
+                run_webhook(bot_config, event_loop, executor)
+            else:
+                executor.start_polling()
+    finally:
+        log_listener.stop()
@@ -0,0 +1,121 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: Dict[str, 'Metric'] = {}
+
+
+class Metric(ABC):
+    """
+    Base of in-process metrics, a metric with label names keeps a child per label values
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], 'Metric'] = {}
+        if not self.labelnames:
+            self._reset()
+        REGISTRY[name] = self
+
+    @abstractmethod
+    def _reset(self) -> None:
+        pass
+
+    def _child(self) -> 'Metric':
+        child = object.__new__(type(self))
+        child.__dict__.update(self.__dict__)
+        child.labelnames = ()
+        child._children = {}
+        child._reset()
+        return child
+
+    def labels(self, *values) -> 'Metric':
+        key = tuple(map(str, values))
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._child()
+        return child
+
+    def _samples(self, labels: str) -> Iterator[str]:
+        yield f'{self.name}{labels} {self.value}'
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        if not self.labelnames:
+            yield from self._samples('')
+        for values, child in self._children.items():
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.labelnames, values))
+            yield from child._samples(f'{{{labels}}}')
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _reset(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _reset(self) -> None:
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _reset(self) -> None:
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _samples(self, labels: str) -> Iterator[str]:
+        labels = labels[1:-1] + ',' if labels else ''
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}'
+        labels = f'{{{labels[:-1]}}}' if labels else ''
+        yield f'{self.name}_sum{labels} {self.sum}'
+        yield f'{self.name}_count{labels} {self.count}'
+
+
+def render() -> str:
+    """
+    :return: all metrics in the Prometheus text format
+    """
+    return '\n'.join(line for metric in REGISTRY.values() for line in metric.render()) + '\n'
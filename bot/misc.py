@@ -1,9 +1,54 @@
-from aiogram import Bot, Dispatcher
-from aiogram.contrib.middlewares.logging import LoggingMiddleware
+from aiogram import Dispatcher
+from aiogram.bot import api
 
+from admission import AdmissionMiddleware
+from callbacks import CallbackDataMiddleware, CallbackRouter
 from configs.bot import BotConfig
+from configs.cache import CacheConfig
+from idempotency import CallbackDeduplicator, UpdateDeduplicationMiddleware
+from instrumentation import InstrumentationMiddleware, InstrumentedBot
+from outgoing import OutgoingScheduler
+from scheduler import KeyedScheduler
 
 
-bot = Bot(token=BotConfig().api_token.get_secret_value())
+bot_config = BotConfig()
+if bot_config.api_url:
+    api.API_URL = f'{bot_config.api_url}/bot{{token}}/{{method}}'
+
+bot = InstrumentedBot(token=bot_config.api_token.get_secret_value())
 dp = Dispatcher(bot)
-dp.middleware.setup(LoggingMiddleware())
+outgoing = OutgoingScheduler(
+    bot,
+    rate=bot_config.outgoing_rate,
+    burst=bot_config.outgoing_burst,
+    message_rate=bot_config.message_edit_rate,
+    message_burst=bot_config.message_edit_burst,
+    concurrency=bot_config.outgoing_concurrency,
+    stop_timeout=bot_config.outgoing_stop_timeout
+)
+cache_config = CacheConfig()
+dp.middleware.setup(InstrumentationMiddleware())
+dp.middleware.setup(UpdateDeduplicationMiddleware(cache_config.update_cache_size, cache_config.update_cache_ttl))
+dp.middleware.setup(CallbackDataMiddleware())
+dp.middleware.setup(AdmissionMiddleware(
+    user_rate=bot_config.user_callback_rate,
+    user_burst=bot_config.user_callback_burst,
+    game_rate=bot_config.game_callback_rate,
+    game_burst=bot_config.game_callback_burst,
+    rate=bot_config.callback_rate,
+    burst=bot_config.callback_burst,
+    size=cache_config.update_cache_size
+))
+router = CallbackRouter(
+    KeyedScheduler(
+        concurrency=bot_config.handler_concurrency,
+        max_queue_per_key=bot_config.game_queue_size,
+        max_pending=bot_config.max_pending_updates
+    ),
+    CallbackDeduplicator(
+        size=cache_config.update_cache_size,
+        ttl=cache_config.update_cache_ttl,
+        repeat_ttl=cache_config.repeat_tap_ttl
+    )
+)
+dp.register_callback_query_handler(router.dispatch)
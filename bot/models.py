@@ -2,16 +2,23 @@ import enum
 from datetime import datetime
 
 from sqlalchemy import (
+    BigInteger,
     Column,
     Integer,
     String,
     Enum,
+    Float,
     ForeignKey,
     Boolean,
-    DateTime
+    DateTime,
+    Index,
+    text
 )
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
 
+from constants import INITIAL_RATING
+
 
 class EnumSign(enum.Enum):
     cross = enum.auto()
@@ -22,6 +29,14 @@ class EnumStatus(enum.Enum):
     initial = enum.auto()
     in_progress = enum.auto()
     finished = enum.auto()
+    # Nobody played for too long
+    expired = enum.auto()
+
+
+class EnumDifficulty(enum.Enum):
+    random = enum.auto()
+    imperfect = enum.auto()
+    perfect = enum.auto()
 
 
 @as_declarative()
@@ -35,22 +50,79 @@ class Base:
 
 
 class User(Base):
-    tg_id = Column(Integer, nullable=False)
+    tg_id = Column(Integer, nullable=False, unique=True, index=True)
     name = Column(String, nullable=False)
 
 
 class TicTacToeGame(Base):
     status = Column(Enum(EnumStatus), nullable=False, default=EnumStatus.initial)
     current_step_user_id = Column(Integer, ForeignKey('User.id'))
+    width = Column(Integer, nullable=False, default=3, server_default='3')
+    height = Column(Integer, nullable=False, default=3, server_default='3')
+    win_length = Column(Integer, nullable=False, default=3, server_default='3')
+    # Bitsets of the cells, bit N is the cell N counting by rows, see games.board
+    cross_board = Column(BigInteger, nullable=False, default=0, server_default='0')
+    circle_board = Column(BigInteger, nullable=False, default=0, server_default='0')
+    # Set for games against the bot
+    ai_difficulty = Column(Enum(EnumDifficulty))
+    # Message of the game, edited when the game expires
+    inline_message_id = Column(String)
+    # Time of the last change, games not changed for long expire
+    updated = Column(DateTime, nullable=False, default=datetime.now, server_default='NOW()')
+
+    __table_args__ = (
+        # Find games to expire and to archive in the order of the time
+        Index(
+            'ix_TicTacToeGame_unfinished_updated', 'updated',
+            postgresql_where=text("status IN ('initial', 'in_progress')")
+        ),
+        Index(
+            'ix_TicTacToeGame_ended_updated', 'updated',
+            postgresql_where=text("status IN ('finished', 'expired')")
+        ),
+    )
 
 
 class TicTacToePlayer(Base):
-    user_id = Column(Integer, ForeignKey('User.id'), nullable=False)
-    game_id = Column(Integer, ForeignKey('TicTacToeGame.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('User.id'), nullable=False, index=True)
+    game_id = Column(Integer, ForeignKey('TicTacToeGame.id'), nullable=False, index=True)
     sign = Column(Enum(EnumSign))
     is_winner = Column(Boolean)
 
 
 class TicTacToeStep(Base):
     position = Column(Integer, nullable=False)
-    player_id = Column(Integer, ForeignKey('TicTacToePlayer.id'), nullable=False)
+    player_id = Column(Integer, ForeignKey('TicTacToePlayer.id'), nullable=False, index=True)
+
+
+class TicTacToeGameArchive(Base):
+    """
+    Finished and expired games moved out of the game tables, one row per game
+    """
+    # ID the game had
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    finished = Column(DateTime, nullable=False)
+    status = Column(Enum(EnumStatus), nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    win_length = Column(Integer, nullable=False)
+    ai_difficulty = Column(Enum(EnumDifficulty))
+    cross_user_id = Column(Integer, ForeignKey('User.id'), index=True)
+    circle_user_id = Column(Integer, ForeignKey('User.id'), index=True)
+    winner = Column(Enum(EnumSign))
+    # Cells in the order they were played, cross moves first
+    moves = Column(ARRAY(Integer), nullable=False)
+
+
+class UserStats(Base):
+    """
+    Results of the games between players, updated in the transaction finishing a game
+    """
+    user_id = Column(Integer, ForeignKey('User.id'), nullable=False, unique=True, index=True)
+    wins = Column(Integer, nullable=False, default=0, server_default='0')
+    losses = Column(Integer, nullable=False, default=0, server_default='0')
+    draws = Column(Integer, nullable=False, default=0, server_default='0')
+    # Wins in a row if positive, losses in a row if negative
+    streak = Column(Integer, nullable=False, default=0, server_default='0')
+    rating = Column(Float, nullable=False, default=INITIAL_RATING, server_default=str(INITIAL_RATING), index=True)
+    updated = Column(DateTime, nullable=False, default=datetime.now, server_default='NOW()')
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from time import monotonic
+from typing import List, NamedTuple, Optional, Set
+
+from aiogram import Bot
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+from cache import TTLCache
+from metrics import Counter, Gauge, Histogram
+from rate_limit import TokenBucket
+
+
+log = logging.getLogger(__name__)
+
+QUEUE_DEPTH = Gauge('outgoing_queue_depth', 'Inline messages with a pending edit')
+EDIT_DELAY = Histogram('outgoing_edit_delay_seconds', 'Time from queuing an edit to Telegram accepting it')
+REQUEST_LATENCY = Histogram('outgoing_request_seconds', 'Duration of edit requests to Telegram')
+COALESCED = Counter('outgoing_coalesced_total', 'Edits replaced by a newer edit of the same message')
+RETRIES = Counter('outgoing_retries_total', 'Edits postponed by Telegram flood control')
+FAILURES = Counter('outgoing_failures_total', 'Edits dropped after an error')
+
+# Leaves the message text as is
+KEEP_TEXT = None
+
+
+class Edit(NamedTuple):
+    text: Optional[str]
+    reply_markup: Optional[str]
+    queued: float
+
+    def merge(self, newer: 'Edit') -> 'Edit':
+        """
+        The newer edit describes the latest keyboard, the text is kept unless the newer edit sets it
+        """
+        text = self.text if newer.text is KEEP_TEXT else newer.text
+        return Edit(text, newer.reply_markup, self.queued)
+
+
+class OutgoingScheduler:
+    """
+    Sends message edits to Telegram in the background within global and per message rate limits.
+    Only the latest state of a message is sent: a pending edit is replaced by a newer one,
+    and edits of one message are never sent concurrently
+    """
+
+    def __init__(
+            self,
+            bot: Bot,
+            rate: float,
+            burst: float,
+            message_rate: float,
+            message_burst: float,
+            concurrency: int,
+            stop_timeout: float = 10
+    ):
+        """
+        :param stop_timeout: seconds given to pending edits on shutdown, edits still pending then are dropped
+        """
+        self.bot = bot
+        self.bucket = TokenBucket(rate, burst)
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.concurrency = concurrency
+        self.stop_timeout = stop_timeout
+        self._message_buckets: TTLCache[TokenBucket] = TTLCache(size=100000, ttl=message_burst / message_rate)
+        self._pending: 'OrderedDict[str, Edit]' = OrderedDict()
+        self._in_flight: Set[str] = set()
+        self._ready = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+
+    def edit_text(self, inline_message_id: str, text: str, reply_markup: Optional[str] = None) -> None:
+        """
+        Queues an edit of the message text, a message without `reply_markup` loses its keyboard
+        """
+        self._queue(inline_message_id, Edit(text, reply_markup, monotonic()))
+
+    def edit_reply_markup(self, inline_message_id: str, reply_markup: Optional[str]) -> None:
+        self._queue(inline_message_id, Edit(KEEP_TEXT, reply_markup, monotonic()))
+
+    def _queue(self, inline_message_id: str, edit: Edit) -> None:
+        pending = self._pending.get(inline_message_id)
+        if pending is not None:
+            self._pending[inline_message_id] = pending.merge(edit)
+            COALESCED.inc()
+            return None
+        self._pending[inline_message_id] = edit
+        QUEUE_DEPTH.set(len(self._pending))
+        if inline_message_id not in self._in_flight:
+            self._ready.put_nowait(inline_message_id)
+
+    def _message_bucket(self, inline_message_id: str) -> TokenBucket:
+        bucket = self._message_buckets.get(inline_message_id)
+        if bucket is None:
+            bucket = TokenBucket(self.message_rate, self.message_burst)
+            self._message_buckets.set(inline_message_id, bucket)
+        return bucket
+
+    async def _send(self, inline_message_id: str, edit: Edit) -> None:
+        if edit.text is KEEP_TEXT:
+            await self.bot.edit_message_reply_markup(
+                inline_message_id=inline_message_id,
+                reply_markup=edit.reply_markup
+            )
+        else:
+            await self.bot.edit_message_text(
+                text=edit.text,
+                inline_message_id=inline_message_id,
+                reply_markup=edit.reply_markup
+            )
+
+    async def _work(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            inline_message_id = await self._ready.get()
+            if delay := self._message_bucket(inline_message_id).consume():
+                loop.call_later(delay, self._ready.put_nowait, inline_message_id)
+                continue
+            await self.bucket.acquire()
+
+            edit = self._pending.pop(inline_message_id)
+            QUEUE_DEPTH.set(len(self._pending))
+            self._in_flight.add(inline_message_id)
+            started = monotonic()
+            try:
+                await self._send(inline_message_id, edit)
+            except RetryAfter as error:
+                RETRIES.inc()
+                log.warning('Flood control, pausing edits for %s seconds', error.timeout)
+                self.bucket.pause(error.timeout)
+                newer = self._pending.get(inline_message_id)
+                self._pending[inline_message_id] = edit.merge(newer) if newer else edit
+            except MessageNotModified:
+                pass
+            except Exception:
+                FAILURES.inc()
+                log.exception('Failed to edit message %s', inline_message_id)
+            else:
+                finished = monotonic()
+                REQUEST_LATENCY.observe(finished - started)
+                EDIT_DELAY.observe(finished - edit.queued)
+            finally:
+                self._in_flight.discard(inline_message_id)
+                if inline_message_id in self._pending:
+                    self._ready.put_nowait(inline_message_id)
+
+    def start(self) -> None:
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        """
+        Sends pending edits for up to `stop_timeout` seconds and stops workers
+        """
+        deadline = monotonic() + self.stop_timeout
+        while self._workers and (self._pending or self._in_flight) and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        dropped = len(self._pending.keys() | self._in_flight)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if dropped:
+            log.warning('Dropped edits of %s messages on shutdown', dropped)
+        self._pending.clear()
+        self._in_flight.clear()
+        while not self._ready.empty():
+            self._ready.get_nowait()
+        QUEUE_DEPTH.set(0)
@@ -0,0 +1,43 @@
+import asyncio
+from time import monotonic
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average with bursts of up to `capacity` events
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+
+    def consume(self, tokens: float = 1) -> float:
+        """
+        Takes tokens if there are enough of them
+
+        :return: 0 if tokens were taken, seconds to wait for them otherwise
+        """
+        now = monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1) -> None:
+        while delay := self.consume(tokens):
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Gives no tokens for `seconds`, e.g. after being told to retry later
+        """
+        self.paused_until = self.updated = max(self.paused_until, monotonic() + seconds)
+        self.tokens = 0
@@ -0,0 +1,104 @@
+"""
+Recomputes the player statistics from all finished games, e.g. after changing how they are counted:
+
+    python rebuild_stats.py --batch-size 1000
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict
+
+from asyncpg import Record
+from asyncpgsa import pg
+
+from DAO import UserStatsDAO
+from configs import GameConfig
+from constants import INITIAL_RATING
+from startup import SCRIPT_CONNECTIONS, init_connection
+
+
+def rating_change(rating: float, opponent_rating: float, score: float, k_factor: float) -> float:
+    """
+    :param score: 1 for a win, 0.5 for a draw and 0 for a loss
+
+    :return: change of the Elo rating after a game, the same as RECORD_RESULT_QUERY applies
+    """
+    return k_factor * (score - 1 / (1 + 10 ** ((opponent_rating - rating) / 400)))
+
+
+def _new_stats(user_id: int, updated: datetime) -> Dict:
+    return {
+        'user_id': user_id,
+        'wins': 0,
+        'losses': 0,
+        'draws': 0,
+        'streak': 0,
+        'rating': float(INITIAL_RATING),
+        'updated': updated
+    }
+
+
+def _add_result(stats: Dict, score: float, change: float, updated: datetime) -> None:
+    if score == 1:
+        stats['wins'] += 1
+        stats['streak'] = max(stats['streak'], 0) + 1
+    elif score == 0:
+        stats['losses'] += 1
+        stats['streak'] = min(stats['streak'], 0) - 1
+    else:
+        stats['draws'] += 1
+        stats['streak'] = 0
+    stats['rating'] += change
+    stats['updated'] = updated
+
+
+def _count(players: Dict[int, Dict], game: Record, k_factor: float) -> None:
+    cross = players.setdefault(game['cross_user_id'], _new_stats(game['cross_user_id'], game['finished']))
+    circle = players.setdefault(game['circle_user_id'], _new_stats(game['circle_user_id'], game['finished']))
+    cross_score = {'cross': 1, 'circle': 0, None: 0.5}[game['winner']]
+    cross_change = rating_change(cross['rating'], circle['rating'], cross_score, k_factor)
+    circle_change = rating_change(circle['rating'], cross['rating'], 1 - cross_score, k_factor)
+    _add_result(cross, cross_score, cross_change, game['finished'])
+    _add_result(circle, 1 - cross_score, circle_change, game['finished'])
+
+
+async def rebuild(batch_size: int, k_factor: float) -> int:
+    """
+    Recomputes the stats of every player from the finished games, live and archived.
+    Games are read from a snapshot, and the new stats replace the old ones at the end
+    with the results of the games finished meanwhile added. Writes of the stats only wait for the replacement,
+    ended games aren't archived until then
+
+    :param batch_size: games read per round trip
+    :param k_factor: largest rating change per game
+
+    :return: number of games counted
+    """
+    players: Dict[int, Dict] = {}
+    games = 0
+    async with pg.pool.acquire() as connection:
+        async with connection.transaction(isolation='repeatable_read'):
+            async for game in await UserStatsDAO().history(connection, batch_size):
+                _count(players, game, k_factor)
+                games += 1
+        games += await UserStatsDAO().replace_all(list(players.values()), k_factor, connection)
+    return games
+
+
+async def run(batch_size: int) -> None:
+    await init_connection(SCRIPT_CONNECTIONS)
+    started = time.perf_counter()
+    games = await rebuild(batch_size, GameConfig().rating_k_factor)
+    print(f'Counted {games} games in {time.perf_counter() - started:.2f} s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=1000, help='games read per round trip')
+    arguments = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(arguments.batch_size))
+
+
+if __name__ == '__main__':
+    main()
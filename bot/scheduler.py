@@ -0,0 +1,69 @@
+import asyncio
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+from metrics import Counter, Gauge, Histogram
+
+T = TypeVar('T')
+
+PENDING = Gauge('scheduler_pending_updates', 'Updates running or waiting for their turn')
+WAIT_TIME = Histogram('scheduler_wait_seconds', 'Time updates wait for their key and a free slot')
+SHED = Counter('scheduler_shed_total', 'Updates rejected because the queues were full')
+
+
+class Overloaded(Exception):
+    pass
+
+
+class _KeyQueue:
+    __slots__ = ('lock', 'size')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.size = 0
+
+
+class KeyedScheduler:
+    """
+    Runs jobs of one key one at a time in arrival order, and jobs of different keys
+    in parallel up to `concurrency` at once
+    """
+
+    def __init__(self, concurrency: int, max_queue_per_key: int, max_pending: int):
+        self.concurrency = concurrency
+        self.max_queue_per_key = max_queue_per_key
+        self.max_pending = max_pending
+        self.pending = 0
+        self._keys: Dict[Hashable, _KeyQueue] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def run(self, key: Hashable, job: Callable[[], Awaitable[T]]) -> T:
+        """
+        :raise Overloaded: if the key or the scheduler has too many jobs waiting
+        """
+        queue = self._keys.get(key)
+        if queue is None:
+            queue = self._keys[key] = _KeyQueue()
+        if queue.size >= self.max_queue_per_key or self.pending >= self.max_pending:
+            SHED.inc()
+            if not queue.size:
+                del self._keys[key]
+            raise Overloaded(key)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        queue.size += 1
+        self.pending += 1
+        PENDING.set(self.pending)
+        queued = monotonic()
+        try:
+            async with queue.lock:
+                async with self._semaphore:
+                    WAIT_TIME.observe(monotonic() - queued)
+                    return await job()
+        finally:
+            queue.size -= 1
+            self.pending -= 1
+            PENDING.set(self.pending)
+            if not queue.size:
+                del self._keys[key]
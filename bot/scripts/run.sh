@@ -1,3 +1,3 @@
-sleep 2
-alembic upgrade head
+# Waits for the database and migrates it if the schema is behind
+python startup.py || exit 1
 python main.py
@@ -0,0 +1,330 @@
+"""
+Multi-process mode: the front process receives webhook updates and forwards every update
+to a worker process picked by a consistent hash of its game, so updates of one game
+are handled in order by one worker while games spread across cores.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+from bisect import bisect
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from aiogram import Bot
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+
+from callbacks import decode
+from metrics import Counter, Gauge
+from webhook import CATCH_UP_HEADER, REBALANCE_PATH, SHARD_EPOCH_HEADER
+
+log = logging.getLogger(__name__)
+
+FORWARDED = Counter('front_forwarded_total', 'Updates forwarded to workers', ('worker',))
+REROUTED = Counter('front_rerouted_total', 'Updates sent to another worker after a failure')
+HEALTHY_WORKERS = Gauge('front_healthy_workers', 'Workers receiving updates')
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring, removing a node only moves the keys that node owned
+    """
+
+    def __init__(self, replicas: int = 100):
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._nodes: Dict[int, int] = {}
+
+    def __contains__(self, node: int) -> bool:
+        return _hash(f'{node}:0') in self._nodes
+
+    def __len__(self) -> int:
+        return len(self._points) // self.replicas
+
+    def add(self, node: int) -> None:
+        for replica in range(self.replicas):
+            point = _hash(f'{node}:{replica}')
+            self._nodes[point] = node
+        self._points = sorted(self._nodes)
+
+    def remove(self, node: int) -> None:
+        for replica in range(self.replicas):
+            self._nodes.pop(_hash(f'{node}:{replica}'), None)
+        self._points = sorted(self._nodes)
+
+    def nodes(self, key: str) -> Iterator[int]:
+        """
+        :return: distinct nodes in the order of preference for the key
+        """
+        if not self._points:
+            return None
+        seen = set()
+        start = bisect(self._points, _hash(key))
+        for index in range(start, start + len(self._points)):
+            node = self._nodes[self._points[index % len(self._points)]]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+
+def shard_key(update: dict) -> str:
+    """
+    :return: key keeping updates of one game together, the inline message of the game if known
+    """
+    if query := update.get('callback_query'):
+        if inline_message_id := query.get('inline_message_id'):
+            return inline_message_id
+        callback = decode(query.get('data'))
+        if getattr(callback, 'game_id', None):
+            return f'game:{callback.game_id}'
+        return f'user:{query["from"]["id"]}'
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return f'user:{value["from"]["id"]}'
+    return str(update.get('update_id'))
+
+
+class Worker:
+    def __init__(
+            self,
+            number: int,
+            host: str,
+            port: int,
+            path: str,
+            metrics_port: int = 0,
+            env: Optional[Dict[str, str]] = None
+    ):
+        """
+        :param env: environment variables of the worker overriding those of the front process
+        """
+        self.number = number
+        self.port = port
+        self.metrics_port = metrics_port
+        self.env = env or {}
+        self.url = f'http://{host}:{port}{path}'
+        self.rebalance_url = f'http://{host}:{port}{REBALANCE_PATH}'
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.failures = 0
+
+    @property
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self) -> None:
+        self.failures = 0
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, MAIN_SCRIPT,
+            env={
+                **os.environ,
+                **self.env,
+                'RUN_MODE': 'worker',
+                'WEBAPP_PORT': str(self.port),
+                'METRICS_PORT': str(self.metrics_port),
+                'WORKERS': '0'
+            }
+        )
+        log.info('Started worker %s on port %s', self.number, self.port)
+
+    async def stop(self, timeout: float) -> None:
+        """
+        Interrupts the worker so it persists its games, killing it after `timeout`
+        """
+        if not self.is_running:
+            return None
+        self.process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+
+class Front:
+    """
+    Routes updates to workers, taking workers that stop answering out of the ring
+    and restarting exited ones
+    """
+
+    def __init__(
+            self,
+            workers: List[Worker],
+            health_check_interval: float,
+            max_failures: int = 3,
+            request_timeout: float = 60,
+            drain_timeout: float = 10
+    ):
+        """
+        :param drain_timeout: seconds a worker gets to persist its games before they move to other workers
+        """
+        self.workers = {worker.number: worker for worker in workers}
+        self.ring = HashRing()
+        # Workers forget their games when it changes, as they may have been played elsewhere meanwhile
+        self.epoch = 0
+        self.health_check_interval = health_check_interval
+        self.max_failures = max_failures
+        self.request_timeout = request_timeout
+        self.drain_timeout = drain_timeout
+        self.session: Optional[ClientSession] = None
+        self._health_task: Optional[asyncio.Task] = None
+        self._drain: Optional[asyncio.Task] = None
+
+    def _ring_changed(self, down: Optional[Worker] = None) -> None:
+        self.epoch += 1
+        HEALTHY_WORKERS.set(len(self.ring))
+        self._drain = asyncio.ensure_future(self._drain_workers(self.epoch, down, self._drain))
+
+    async def _drain_workers(self, epoch: int, down: Optional[Worker], previous: Optional[asyncio.Task]) -> None:
+        """
+        Has the running workers persist their pending moves and forget their games,
+        the worker taken out of the ring too, as it may still be alive.
+        Updates aren't forwarded meanwhile, so the new owners of the moved games load them up to date
+        """
+        if previous is not None:
+            await previous
+        await asyncio.gather(*(
+            self._drain_worker(worker, epoch, worker is down)
+            for worker in self.workers.values()
+            if worker.is_running and (worker.number in self.ring or worker is down)
+        ))
+
+    async def _drain_worker(self, worker: Worker, epoch: int, is_down: bool) -> None:
+        try:
+            async with self.session.post(
+                    worker.rebalance_url,
+                    headers={SHARD_EPOCH_HEADER: str(epoch)},
+                    timeout=ClientTimeout(total=self.drain_timeout)
+            ) as response:
+                response.raise_for_status()
+        except (ClientError, asyncio.TimeoutError):
+            # Workers in the ring still forget their games on the next update with the new epoch
+            if is_down:
+                log.warning('Worker %s out of the ring did not persist its games, stopping it', worker.number)
+                await worker.stop(self.drain_timeout)
+
+    async def _drained(self) -> None:
+        if self._drain is not None and not self._drain.done():
+            await asyncio.shield(self._drain)
+
+    def _mark_down(self, worker: Worker) -> None:
+        if worker.number in self.ring:
+            self.ring.remove(worker.number)
+            self._ring_changed(down=worker)
+            log.warning('Worker %s is out of the ring, its games move to other workers', worker.number)
+
+    def _mark_up(self, worker: Worker) -> None:
+        worker.failures = 0
+        if worker.number not in self.ring:
+            self.ring.add(worker.number)
+            self._ring_changed()
+            log.info('Worker %s is in the ring', worker.number)
+
+    async def _check(self, worker: Worker) -> None:
+        if not worker.is_running:
+            self._mark_down(worker)
+            log.warning('Worker %s exited with %s, restarting', worker.number, worker.process.returncode)
+            await worker.start()
+            return None
+        try:
+            async with self.session.get(worker.url, timeout=ClientTimeout(total=self.health_check_interval)) as response:
+                response.raise_for_status()
+        except (ClientError, asyncio.TimeoutError):
+            worker.failures += 1
+            if worker.failures >= self.max_failures:
+                self._mark_down(worker)
+        else:
+            self._mark_up(worker)
+
+    async def _check_health(self) -> None:
+        while True:
+            await asyncio.gather(*(self._check(worker) for worker in self.workers.values()))
+            await asyncio.sleep(self.health_check_interval)
+
+    async def wait_for_workers(self) -> None:
+        while len(self.ring) < len(self.workers):
+            await asyncio.sleep(0.1)
+
+    async def forward(self, body: bytes, key: str, catch_up: bool = False) -> Optional[Tuple[bytes, int, str]]:
+        """
+        :param catch_up: the update was queued while the bot was down
+
+        :return: reply of the worker owning the key, its status and content type,
+            None if no worker is available
+        """
+        tried = set()
+        while True:
+            # Games of a worker taken out of the ring are routed once it persisted them
+            await self._drained()
+            number = next((node for node in self.ring.nodes(key) if node not in tried), None)
+            if number is None:
+                return None
+            tried.add(number)
+            headers = {'Content-Type': 'application/json', SHARD_EPOCH_HEADER: str(self.epoch)}
+            if catch_up:
+                headers[CATCH_UP_HEADER] = '1'
+            worker = self.workers[number]
+            try:
+                async with self.session.post(worker.url, data=body, headers=headers) as response:
+                    reply = await response.read()
+            except (ClientError, asyncio.TimeoutError):
+                self._mark_down(worker)
+                REROUTED.inc()
+                continue
+            FORWARDED.labels(number).inc()
+            return reply, response.status, response.content_type
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        forwarded = await self.forward(body, shard_key(json.loads(body)))
+        if forwarded is None:
+            return web.Response(status=503)
+        reply, status, content_type = forwarded
+        return web.Response(body=reply, status=status, content_type=content_type)
+
+    async def catch_up_update(self, bot: Bot, update: dict) -> None:
+        """
+        Forwards a backlog update and calls the method of the reply, except answers to callback queries
+        """
+        forwarded = await self.forward(json.dumps(update).encode(), shard_key(update), catch_up=True)
+        if forwarded is None:
+            raise RuntimeError('No workers to catch up')
+        reply, _, content_type = forwarded
+        if content_type != 'application/json' or not reply:
+            return None
+        payload = json.loads(reply)
+        method = payload.pop('method', None)
+        if method and method != 'answerCallbackQuery':
+            await bot.request(method, payload)
+
+    async def health(self, _: web.Request) -> web.Response:
+        return web.Response(text=f'{len(self.ring)}/{len(self.workers)} workers', status=200 if self.ring else 503)
+
+    async def on_startup(self, _: web.Application) -> None:
+        self.session = ClientSession(
+            connector=TCPConnector(limit=0),
+            timeout=ClientTimeout(total=self.request_timeout)
+        )
+        await asyncio.gather(*(worker.start() for worker in self.workers.values()))
+        self._health_task = asyncio.ensure_future(self._check_health())
+
+    async def on_shutdown(self, _: web.Application) -> None:
+        self._health_task.cancel()
+        if self._drain is not None:
+            self._drain.cancel()
+        await asyncio.gather(*(worker.stop(self.request_timeout) for worker in self.workers.values()))
+        await self.session.close()
+
+    def create_web_app(self, path: str) -> web.Application:
+        app = web.Application()
+        app.router.add_route('POST', path, self.handle)
+        app.router.add_route('GET', path, self.health)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
@@ -0,0 +1,146 @@
+"""
+Startup sequence: waits for the database to accept connections, migrates the schema only if it's behind
+the head revision, and opens the connection pool warmed up, timing every phase.
+Run before the bot to migrate the database:
+
+    python startup.py
+"""
+import asyncio
+import logging
+import random
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Optional
+
+import asyncpg
+from alembic import command
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+from asyncpgsa import pg
+
+from DAO import warm_up_connection
+from configs import BotConfig, DataBaseConfig
+from metrics import Gauge
+
+log = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Gauge('startup_phase_seconds', 'Duration of the startup phases', ('phase',))
+
+ALEMBIC_CONFIG = 'alembic.ini'
+# Connections used outside of update handlers: the game writer, the reaper and the leaderboard
+BACKGROUND_CONNECTIONS = 3
+# Connections of one-off scripts reading a cursor
+SCRIPT_CONNECTIONS = 2
+
+
+@contextmanager
+def phase(name: str):
+    started = perf_counter()
+    yield
+    elapsed = perf_counter() - started
+    STARTUP_SECONDS.labels(name).set(elapsed)
+    log.info('Startup phase %s took %.1f ms', name, elapsed * 1000)
+
+
+async def wait_for_database(
+        config: DataBaseConfig,
+        initial_delay: float = 0.05,
+        max_delay: float = 2
+) -> Optional[str]:
+    """
+    Connects until the database answers, waiting longer after every failure, up to `config.connect_timeout`
+
+    :return: revision of the schema, None if it isn't migrated yet
+    """
+    deadline = perf_counter() + config.connect_timeout
+    delay = initial_delay
+    while True:
+        try:
+            connection = await asyncpg.connect(
+                host=config.host,
+                port=config.port,
+                database=config.name,
+                user=config.user,
+                password=config.password.get_secret_value(),
+                timeout=max(deadline - perf_counter(), 0.1)
+            )
+        except (OSError, asyncio.TimeoutError, asyncpg.CannotConnectNowError) as error:
+            if perf_counter() + delay > deadline:
+                raise TimeoutError(f'Database is not ready after {config.connect_timeout} s: {error}') from error
+            log.info('Database is not ready yet: %s', error)
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, max_delay)
+            continue
+        try:
+            return await connection.fetchval('SELECT version_num FROM alembic_version')
+        except asyncpg.UndefinedTableError:
+            return None
+        finally:
+            await connection.close()
+
+
+def head_revision() -> str:
+    return ScriptDirectory.from_config(Config(ALEMBIC_CONFIG)).get_current_head()
+
+
+def pool_size(config: DataBaseConfig, handler_concurrency: int) -> int:
+    """
+    :return: connections enough for every handler running at once and the background tasks
+    """
+    return config.pool_size or handler_concurrency + BACKGROUND_CONNECTIONS
+
+
+async def init_connection(size: Optional[int] = None) -> None:
+    """
+    Opens the pool once the database is ready, with every connection open
+    and the hot path statements prepared before the first update
+
+    :param size: connections opened as needed instead, up to `size`, for scripts not handling updates
+    """
+    db_config = DataBaseConfig()
+    with phase('database'):
+        await wait_for_database(db_config)
+    connection = {
+        'host': db_config.host,
+        'port': db_config.port,
+        'database': db_config.name,
+        'user': db_config.user,
+        'password': db_config.password.get_secret_value(),
+        'statement_cache_size': db_config.statement_cache_size,
+    }
+    if size is not None:
+        await pg.init(**connection, min_size=1, max_size=size)
+        return None
+    size = pool_size(db_config, BotConfig().handler_concurrency)
+    with phase('pool'):
+        await pg.init(
+            **connection,
+            min_size=size,
+            max_size=size,
+            # Idle connections stay open, so they stay warm
+            max_inactive_connection_lifetime=0,
+            init=warm_up_connection
+        )
+    log.info('Opened %s database connections', size)
+
+
+async def migrate() -> None:
+    """
+    Upgrades the schema to the head revision unless it's already there
+    """
+    with phase('database'):
+        revision = await wait_for_database(DataBaseConfig())
+    head = head_revision()
+    if revision == head:
+        log.info('Schema is at the head revision %s', head)
+        return None
+    with phase('migration'):
+        command.upgrade(Config(ALEMBIC_CONFIG), 'head')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    # Migrations set the root logger level from alembic.ini
+    log.setLevel(logging.INFO)
+    with phase('total'):
+        asyncio.get_event_loop().run_until_complete(migrate())
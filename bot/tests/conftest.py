@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+import cache
+import rate_limit
+
+
+class Clock:
+    """
+    Stand-in for `time.monotonic` moved by hand
+    """
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cache, 'monotonic', clock)
+    monkeypatch.setattr(rate_limit, 'monotonic', clock)
+    return clock
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--update-query-plans',
+        action='store_true',
+        help='write the plans of the query plan tests as their new baseline'
+    )
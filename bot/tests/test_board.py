@@ -0,0 +1,80 @@
+from itertools import product
+
+import pytest
+
+from games.board import CLASSIC, VARIANTS, Board, Geometry, check_win, reachable_boards, to_signed, to_unsigned
+
+
+def _lines(geometry: Geometry):
+    """
+    Winning lines found cell by cell, independently of the masks
+    """
+    for row, column in product(range(geometry.height), range(geometry.width)):
+        for row_step, column_step in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            cells = [(row + row_step * index, column + column_step * index) for index in range(geometry.win_length)]
+            if all(0 <= cell_row < geometry.height and 0 <= cell_column < geometry.width
+                   for cell_row, cell_column in cells):
+                yield frozenset(cell_row * geometry.width + cell_column for cell_row, cell_column in cells)
+
+
+def _positions(mask: int):
+    return frozenset(position for position in range(mask.bit_length()) if mask >> position & 1)
+
+
+@pytest.mark.parametrize('geometry', VARIANTS)
+def test_win_masks(geometry):
+    assert {_positions(mask) for mask in geometry.win_masks} == set(_lines(geometry))
+
+
+@pytest.mark.parametrize('geometry', VARIANTS)
+def test_lines_through(geometry):
+    lines = set(_lines(geometry))
+    for position in range(geometry.cells):
+        through = {_positions(mask) for mask in geometry.lines_through[position]}
+        assert through == {line for line in lines if position in line}
+        assert len(through) <= 4 * geometry.win_length
+
+
+@pytest.mark.parametrize('geometry', VARIANTS)
+def test_check_win_every_line(geometry):
+    for line in _lines(geometry):
+        for sign in ('cross', 'circle'):
+            board = Board.from_positions({position: sign for position in line}, geometry)
+            for position in line:
+                assert check_win(board, position) == sign
+
+
+@pytest.mark.parametrize('geometry', VARIANTS)
+def test_check_win_short_line(geometry):
+    line = next(iter(_lines(geometry)))
+    board = Board.from_positions({position: 'cross' for position in sorted(line)[:-1]}, geometry)
+    last = sorted(line)[-1]
+
+    assert check_win(board.place(last, 'circle'), last) is None
+    assert check_win(board.place(last, 'cross'), last) == 'cross'
+
+
+def test_check_win_matches_winner():
+    for board in reachable_boards(CLASSIC):
+        for position in range(CLASSIC.cells):
+            if not board.is_free(position):
+                winner = check_win(board, position)
+                assert winner is None or winner == board.winner()
+
+
+def test_geometry_is_shared():
+    assert Geometry(5, 5, 4) is VARIANTS[1]
+
+
+@pytest.mark.parametrize('width, height, win_length', [(0, 3, 3), (9, 8, 5), (3, 3, 4)])
+def test_unsupported_geometry(width, height, win_length):
+    with pytest.raises(ValueError):
+        Geometry(width, height, win_length)
+
+
+@pytest.mark.parametrize('mask', [0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1])
+def test_signed_round_trip(mask):
+    signed = to_signed(mask)
+
+    assert -(1 << 63) <= signed < 1 << 63
+    assert to_unsigned(signed) == mask
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from callbacks import AICallback, FieldCallback, SignCallback, decode, encode, encode_int
+
+# Telegram rejects buttons with longer callback data
+MAX_CALLBACK_DATA = 64
+
+
+@pytest.mark.parametrize('value', [0, 1, 35, 36, 123456789, 2 ** 63 - 1])
+def test_encode_int(value):
+    assert int(encode_int(value), 36) == value
+
+
+@pytest.mark.parametrize('callback', [
+    FieldCallback(1, 0),
+    FieldCallback(2 ** 31, 63),
+    SignCallback(123456789, 'cross'),
+    SignCallback(123456789, 'circle', 42),
+    SignCallback(123456789, 'circle', 42, 2),
+    AICallback(123456789, 'random'),
+    AICallback(123456789, 'perfect', 42),
+])
+def test_round_trip(callback):
+    data = encode(callback)
+
+    assert decode(data) == callback
+    assert len(data.encode()) <= MAX_CALLBACK_DATA
+
+
+def test_longest_callback_fits():
+    data = encode(SignCallback(2 ** 63 - 1, 'circle', 2 ** 63 - 1, 2))
+
+    assert len(data.encode()) <= MAX_CALLBACK_DATA
+
+
+def test_sign_without_variant():
+    # Keyboards sent before board variants
+    assert decode('1s3f.1.c') == SignCallback(int('3f', 36), 'circle', 12, 0)
+    assert decode('1s3f.0.') == SignCallback(int('3f', 36), 'cross')
+
+
+def test_legacy_field():
+    data = json.dumps({'name': 'xo_field', 'game_id': 17, 'pos': 4}).replace(' ', '')
+
+    assert decode(data) == FieldCallback(17, 4)
+
+
+@pytest.mark.parametrize('sign, expected', [('x', 'cross'), ('o', 'circle')])
+def test_legacy_sign(sign, expected):
+    data = json.dumps({'name': 'xo_sign', 'id': 123, 'sign': sign, 'game': None}).replace(' ', '')
+
+    assert decode(data) == SignCallback(123, expected, None)
+
+
+def test_legacy_sign_with_game():
+    data = json.dumps({'name': 'xo_sign', 'id': 123, 'sign': 'o', 'game': 17}).replace(' ', '')
+
+    assert decode(data) == SignCallback(123, 'circle', 17)
+
+
+@pytest.mark.parametrize('data', [
+    None,
+    '',
+    '1',
+    '1f',
+    '1f1',
+    '1f1.2.3',
+    '1fz!.1',
+    '1s1.9.',
+    '1x1.2',
+    '91.2',
+    '{"name":"xo_other"}',
+    '{"name":"xo_field"}',
+    '{broken',
+])
+def test_unparsable(data):
+    assert decode(data) is None
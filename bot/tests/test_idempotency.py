@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+from aiogram.dispatcher.webhook import AnswerCallbackQuery
+from aiogram.types import CallbackQuery
+
+from idempotency import CallbackDeduplicator
+
+
+def _query(query_id: str, user_id: int = 1, data: str = '1f1.0') -> CallbackQuery:
+    return CallbackQuery.to_object({
+        'id': query_id,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Player'},
+        'inline_message_id': 'message',
+        'chat_instance': 'chat',
+        'data': data,
+    })
+
+
+class Handler:
+    """
+    Callback handler counting its calls, answering once `gate` is set
+    """
+
+    def __init__(self, text: str = None):
+        self.calls = []
+        self.text = text
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    def __call__(self, query: CallbackQuery):
+        async def handle():
+            self.calls.append(query.id)
+            await self.gate.wait()
+            return AnswerCallbackQuery(query.id, text=self.text)
+
+        return handle
+
+
+@pytest.fixture
+def deduplicator(clock) -> CallbackDeduplicator:
+    return CallbackDeduplicator(size=100, ttl=60, repeat_ttl=2)
+
+
+def test_query_delivered_again_waits_for_the_first(loop, deduplicator):
+    handler = Handler()
+    handler.gate.clear()
+    query = _query('a')
+
+    async def run():
+        first = asyncio.ensure_future(deduplicator.run(query, handler(query)))
+        second = asyncio.ensure_future(deduplicator.run(query, handler(query)))
+        await asyncio.sleep(0)
+        handler.gate.set()
+        return await asyncio.gather(first, second)
+
+    first, second = loop.run_until_complete(run())
+    assert handler.calls == ['a']
+    assert first is second
+
+
+def test_repeated_tap_gets_its_own_answer(loop, deduplicator):
+    handler = Handler()
+
+    async def run():
+        await deduplicator.run(_query('a'), handler(_query('a')))
+        return await deduplicator.run(_query('b'), handler(_query('b')))
+
+    answer = loop.run_until_complete(run())
+    assert handler.calls == ['a']
+    assert answer.callback_query_id == 'b'
+
+
+def test_taps_of_other_users_are_handled(loop, deduplicator):
+    handler = Handler()
+
+    async def run():
+        await deduplicator.run(_query('a', user_id=1), handler(_query('a')))
+        await deduplicator.run(_query('b', user_id=2), handler(_query('b')))
+
+    loop.run_until_complete(run())
+    assert handler.calls == ['a', 'b']
+
+
+def test_tap_is_handled_again_after_repeat_ttl(loop, deduplicator, clock):
+    handler = Handler()
+
+    async def run():
+        await deduplicator.run(_query('a'), handler(_query('a')))
+        clock.advance(1)
+        await deduplicator.run(_query('b'), handler(_query('b')))
+        clock.advance(1.5)
+        await deduplicator.run(_query('c'), handler(_query('c')))
+
+    loop.run_until_complete(run())
+    assert handler.calls == ['a', 'c']
+
+
+def test_query_is_handled_again_after_ttl(loop, deduplicator, clock):
+    handler = Handler()
+
+    async def run():
+        await deduplicator.run(_query('a'), handler(_query('a')))
+        clock.advance(59)
+        await deduplicator.run(_query('a'), handler(_query('a')))
+        clock.advance(2)
+        await deduplicator.run(_query('a'), handler(_query('a')))
+
+    loop.run_until_complete(run())
+    assert handler.calls == ['a', 'a']
+
+
+def test_tap_answered_with_a_notification_is_handled_again(loop, deduplicator):
+    handler = Handler(text='Сейчас не ваш ход')
+
+    async def run():
+        await deduplicator.run(_query('a'), handler(_query('a')))
+        await deduplicator.run(_query('b'), handler(_query('b')))
+
+    loop.run_until_complete(run())
+    assert handler.calls == ['a', 'b']
+
+
+def test_duplicate_is_handled_when_the_first_is_cancelled(loop, deduplicator):
+    handler = Handler()
+    handler.gate.clear()
+    query = _query('a')
+
+    async def run():
+        first = asyncio.ensure_future(deduplicator.run(query, handler(query)))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(deduplicator.run(query, handler(query)))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        handler.gate.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    answer = loop.run_until_complete(run())
+    assert handler.calls == ['a', 'a']
+    assert answer.callback_query_id == 'a'
+
+
+def test_cancelled_duplicate_leaves_the_first_running(loop, deduplicator):
+    handler = Handler()
+    handler.gate.clear()
+    query = _query('a')
+
+    async def run():
+        first = asyncio.ensure_future(deduplicator.run(query, handler(query)))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(deduplicator.run(query, handler(query)))
+        await asyncio.sleep(0)
+        second.cancel()
+        await asyncio.sleep(0)
+        handler.gate.set()
+        return await first
+
+    assert loop.run_until_complete(run()).callback_query_id == 'a'
+    assert handler.calls == ['a']
+
+
+def test_failure_is_shared_and_not_cached(loop, deduplicator):
+    calls = []
+
+    def failing(query):
+        async def handle():
+            calls.append(query.id)
+            await asyncio.sleep(0)
+            raise RuntimeError
+
+        return handle
+
+    query = _query('a')
+
+    async def run():
+        results = await asyncio.gather(
+            deduplicator.run(query, failing(query)),
+            deduplicator.run(query, failing(query)),
+            return_exceptions=True
+        )
+        assert all(isinstance(result, RuntimeError) for result in results)
+        return await deduplicator.run(query, Handler()(query))
+
+    assert loop.run_until_complete(run()).callback_query_id == 'a'
+    assert calls == ['a']
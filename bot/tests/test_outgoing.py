@@ -0,0 +1,201 @@
+import asyncio
+import json
+from time import monotonic
+from typing import List, Tuple
+
+import pytest
+from aiogram import Bot
+from aiogram.bot import api
+from aiohttp import web
+
+from benchmarks.fake_telegram import FakeTelegramAPI
+from outgoing import OutgoingScheduler
+
+
+class RecordingAPI(FakeTelegramAPI):
+    """
+    Fake Bot API keeping the time of every edit it accepted
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.edits: List[Tuple[float, str]] = []
+
+    def process(self, method: str, data: dict):
+        if method in ('editMessageText', 'editMessageReplyMarkup'):
+            self.edits.append((monotonic(), data['inline_message_id']))
+        return super().process(method, data)
+
+
+def _markup(version: int) -> str:
+    return json.dumps({'inline_keyboard': [[{'text': str(version), 'callback_data': str(version)}]]})
+
+
+@pytest.fixture
+def serve(loop, monkeypatch):
+    """
+    Serves a fake Bot API on a free local port and points the bot at it
+    """
+    runners = []
+
+    def serve(telegram: FakeTelegramAPI) -> FakeTelegramAPI:
+        runner = web.AppRunner(telegram.create_app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', 0).start())
+        runners.append(runner)
+        port = runner.addresses[0][1]
+        monkeypatch.setattr(api, 'API_URL', f'http://127.0.0.1:{port}/bot{{token}}/{{method}}')
+        return telegram
+
+    yield serve
+    for runner in runners:
+        loop.run_until_complete(runner.cleanup())
+
+
+@pytest.fixture
+def bot(loop):
+    bot = Bot('123456:ABCdef')
+    yield bot
+    loop.run_until_complete(bot.close())
+
+
+def _scheduler(bot: Bot, **limits) -> OutgoingScheduler:
+    return OutgoingScheduler(bot, **{
+        'rate': 1000,
+        'burst': 1000,
+        'message_rate': 1000,
+        'message_burst': 1000,
+        'concurrency': 4,
+        **limits
+    })
+
+
+def test_pending_edits_of_a_message_are_sent_once(loop, serve, bot):
+    telegram = serve(RecordingAPI())
+    outgoing = _scheduler(bot)
+
+    async def run():
+        outgoing.edit_text('message', text='Game', reply_markup=_markup(0))
+        for version in range(1, 5):
+            outgoing.edit_reply_markup('message', reply_markup=_markup(version))
+        outgoing.start()
+        await telegram.wait_for_edit('message', 0, timeout=5)
+        await outgoing.stop()
+
+    loop.run_until_complete(run())
+    # The text of the first edit is kept with the keyboard of the last one
+    assert telegram.calls['editMessageText'] == 1
+    assert telegram.calls['editMessageReplyMarkup'] == 0
+    assert telegram.texts['message'] == 'Game'
+    assert telegram.markups['message'] == json.loads(_markup(4))
+
+
+def test_edits_queued_during_a_send_are_sent_after_it(loop, serve, bot):
+    telegram = serve(RecordingAPI())
+    outgoing = _scheduler(bot)
+
+    async def run():
+        outgoing.start()
+        outgoing.edit_reply_markup('message', reply_markup=_markup(0))
+        await asyncio.sleep(0)
+        for version in range(1, 5):
+            outgoing.edit_reply_markup('message', reply_markup=_markup(version))
+        await outgoing.stop()
+
+    loop.run_until_complete(run())
+    assert telegram.calls['editMessageReplyMarkup'] == 2
+    assert telegram.markups['message'] == json.loads(_markup(4))
+
+
+def test_flood_control_pauses_and_resends(loop, serve, bot):
+    telegram = serve(RecordingAPI(flood_rate=1, retry_after=1))
+    outgoing = _scheduler(bot)
+
+    async def run():
+        outgoing.start()
+        started = monotonic()
+        outgoing.edit_reply_markup('first', reply_markup=_markup(0))
+        outgoing.edit_reply_markup('second', reply_markup=_markup(0))
+        await telegram.wait_for_edit('first', 0, timeout=5)
+        await telegram.wait_for_edit('second', 0, timeout=5)
+        await outgoing.stop()
+        return started
+
+    started = loop.run_until_complete(run())
+    assert telegram.calls['429'] == 1
+    assert telegram.calls['editMessageReplyMarkup'] == 2
+    assert telegram.markups['second'] == json.loads(_markup(0))
+    # The edit refused with 429 waits for retry_after before it's sent again
+    assert telegram.edits[-1][0] - started >= 1
+
+
+def test_message_rate(loop, serve, bot):
+    telegram = serve(RecordingAPI())
+    outgoing = _scheduler(bot, message_rate=10, message_burst=1)
+
+    async def run():
+        outgoing.start()
+        for version in range(5):
+            outgoing.edit_reply_markup('message', reply_markup=_markup(version))
+            await telegram.wait_for_edit('message', version, timeout=5)
+        # Other messages aren't held back by the limit of this one
+        outgoing.edit_reply_markup('other', reply_markup=_markup(0))
+        await telegram.wait_for_edit('other', 0, timeout=5)
+        await outgoing.stop()
+
+    loop.run_until_complete(run())
+    times = [time for time, message in telegram.edits if message == 'message']
+    assert len(times) == 5
+    assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
+    assert telegram.edits[-1][0] - times[-1] < 0.09
+
+
+def test_global_rate(loop, serve, bot):
+    telegram = serve(RecordingAPI())
+    outgoing = _scheduler(bot, rate=20, burst=1)
+    messages = [f'message-{index}' for index in range(10)]
+
+    async def run():
+        for message in messages:
+            outgoing.edit_reply_markup(message, reply_markup=_markup(0))
+        outgoing.start()
+        for message in messages:
+            await telegram.wait_for_edit(message, 0, timeout=5)
+        await outgoing.stop()
+
+    loop.run_until_complete(run())
+    times = sorted(time for time, _ in telegram.edits)
+    assert len(times) == len(messages)
+    # A token every 50ms after the first one
+    assert times[-1] - times[0] >= (len(messages) - 1) / 20 * 0.9
+    assert times[-1] - times[0] < 2
+
+
+def test_stop_without_start_drops_pending_edits(loop, bot):
+    outgoing = _scheduler(bot, stop_timeout=10)
+    outgoing.edit_reply_markup('message', reply_markup=_markup(0))
+
+    started = monotonic()
+    loop.run_until_complete(outgoing.stop())
+
+    assert monotonic() - started < 1
+    assert not outgoing._pending
+
+
+def test_stop_gives_up_during_flood_control(loop, serve, bot):
+    telegram = serve(RecordingAPI(flood_rate=1, retry_after=60))
+    outgoing = _scheduler(bot, stop_timeout=0.5)
+
+    async def run():
+        outgoing.start()
+        outgoing.edit_reply_markup('first', reply_markup=_markup(0))
+        outgoing.edit_reply_markup('second', reply_markup=_markup(0))
+        await telegram.wait_for_edit('first', 0, timeout=5)
+        started = monotonic()
+        await outgoing.stop()
+        return monotonic() - started
+
+    assert loop.run_until_complete(run()) < 2
+    assert telegram.calls['429'] == 1
+    assert 'second' not in telegram.markups
+    assert not outgoing._pending and not outgoing._workers
@@ -0,0 +1,485 @@
+"""
+Query plan regression tests of the statements the handlers and the background tasks send.
+
+Migrates a schema of its own in the configured database and seeds it with realistic volumes,
+records the statements sent while games are created, played, persisted, loaded and counted
+and the reaper runs, then runs EXPLAIN (ANALYZE, BUFFERS) of every one with its recorded arguments
+in a transaction rolled back. The schema is dropped at the end, the tests are skipped without a database.
+Plans are compared with those in query_plans.json, written again after an intended change with:
+
+    pytest tests/test_query_plans.py --update-query-plans
+"""
+import asyncio
+import difflib
+import json
+import os
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from asyncpg import PostgresError
+from asyncpgsa import pg
+from asyncpgsa.connection import SAConnection
+from pydantic import ValidationError
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+import DAO
+from DAO import TicTacToeGameDAO, TicTacToePlayerDAO, UserStatsDAO
+from configs import DataBaseConfig, GameConfig
+from games.store import GameStore, GameWriter
+from models import EnumDifficulty, EnumSign, EnumStatus
+from users import resolve_user_id
+
+pytestmark = pytest.mark.database
+
+BOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plans.json')
+
+RECORDED_METHODS = ('execute', 'executemany', 'fetch', 'fetchrow', 'fetchval')
+# Helpers running the statements of the DAO methods, the method is named instead
+DAO_HELPERS = ('_query', '_transaction')
+
+# Large enough for a batch of the reaper to be a small part of the tables, as in production
+LIVE_GAMES = 100000
+ARCHIVED_GAMES = 200000
+USERS = 10000
+# Tables this large must not be scanned
+LARGE_ROWS = 10000
+# Runs of every statement, the fastest one counts
+REPEAT = 3
+BUDGET_MS = 50
+# Budgets of the statements off the update path, the reaper moves a batch of games at once
+BUDGETS_MS = {
+    'TicTacToeGameDAO.expire': 500,
+    'TicTacToeGameDAO.archive': 500,
+}
+# Games played to record the statements
+GAMES = 3
+# Cells of a game cross wins, by turn
+MOVES = (0, 3, 1, 4, 2)
+# Seeded users get Telegram IDs from here on, the players of the recorded games are small numbers
+SEEDED_TG_ID = 10 ** 9
+
+# Formatted with the volumes and the first seeded Telegram ID. Random values repeat between runs
+SEED_QUERIES = (
+    'SELECT setseed(0.5)',
+    '''
+    INSERT INTO "User" (tg_id, name, created)
+    SELECT {tg_id} + number, 'Seeded ' || number, NOW() - interval '1 year' * random()
+    FROM generate_series(1, {users}) AS number
+    ''',
+    # Archived games first, they take IDs from the sequence of the live games
+    '''
+    INSERT INTO "TicTacToeGameArchive" (
+        id, created, finished, status, width, height, win_length, cross_user_id, circle_user_id, winner, moves
+    )
+    SELECT
+        nextval(pg_get_serial_sequence('"TicTacToeGame"', 'id')),
+        started,
+        started + interval '1 minute',
+        CASE WHEN number % 20 = 0 THEN 'expired' ELSE 'finished' END::"enumstatus",
+        3, 3, 3,
+        (SELECT id FROM "User" WHERE tg_id = {tg_id} + 1 + number % {users}),
+        (SELECT id FROM "User" WHERE tg_id = {tg_id} + 1 + (number * 7 + 1) % {users}),
+        (ARRAY['cross', 'circle', NULL])[number % 3 + 1]::"enumsign",
+        ARRAY(SELECT (number + 2 * move) % 9 FROM generate_series(0, 4 + number % 5) AS move)
+    FROM (
+        SELECT number, NOW() - interval '1 year' * random() AS started
+        FROM generate_series(1, {archived_games}) AS number
+    ) AS games
+    ''',
+    # Live games of the last two hours, most of them ended, those of the first hour waiting for the reaper
+    '''
+    INSERT INTO "TicTacToeGame" (
+        created, updated, status, current_step_user_id, width, height, win_length, inline_message_id
+    )
+    SELECT
+        started,
+        started + interval '30 seconds',
+        CASE WHEN number % 10 = 0 THEN 'in_progress' WHEN number % 50 = 1 THEN 'initial' ELSE 'finished' END
+            ::"enumstatus",
+        NULL, 3, 3, 3,
+        'seeded-' || number
+    FROM (
+        SELECT number, NOW() - interval '2 hours' * random() AS started
+        FROM generate_series(1, {live_games}) AS number
+    ) AS games
+    ''',
+    '''
+    INSERT INTO "TicTacToePlayer" (user_id, game_id, sign, is_winner, created)
+    SELECT
+        (
+            SELECT id
+            FROM "User"
+            WHERE tg_id = {tg_id} + 1 + (game.id * CASE sign WHEN 'cross' THEN 1 ELSE 7 END + 1) % {users}
+        ),
+        game.id,
+        sign::"enumsign",
+        CASE WHEN game.status = 'finished' THEN (game.id % 3 = 0) = (sign = 'cross') AND game.id % 3 < 2 END,
+        game.created
+    FROM "TicTacToeGame" AS game,
+        unnest(ARRAY['cross', 'circle']) AS sign
+    WHERE game.status <> 'initial' OR sign = 'cross'
+    ''',
+    '''
+    INSERT INTO "TicTacToeStep" (position, player_id, created)
+    SELECT
+        (player.game_id + 2 * move) % 9,
+        player.id,
+        player.created + interval '1 second' * move
+    FROM "TicTacToePlayer" AS player
+    JOIN "TicTacToeGame" AS game ON game.id = player.game_id,
+        generate_series(0, 4 + player.game_id % 5) AS move
+    WHERE game.status <> 'initial' AND move % 2 = CASE player.sign WHEN 'cross' THEN 0 ELSE 1 END
+    ''',
+    '''
+    INSERT INTO "UserStats" (user_id, wins, losses, draws, streak, rating, updated)
+    SELECT id, (random() * 100)::int, (random() * 100)::int, (random() * 20)::int, 0, 800 + random() * 600, NOW()
+    FROM "User"
+    ''',
+)
+SEEDED_TABLES = ('User', 'TicTacToeGame', 'TicTacToePlayer', 'TicTacToeStep', 'TicTacToeGameArchive', 'UserStats')
+
+
+def _caller() -> str:
+    """
+    :return: the DAO method, or the function of the DAO module, sending the statement being recorded
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == DAO.__file__ and code.co_name not in DAO_HELPERS:
+            dao = frame.f_locals.get('self')
+            return f'{type(dao).__name__}.{code.co_name}' if dao is not None else code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryRecorder:
+    """
+    Records the statements sent over database connections, each distinct text with its first arguments
+    under the name of the DAO method sending it, numbered if the method sends several.
+    Statements executed without arguments, transaction control and connection resets, are skipped
+    """
+
+    def __init__(self):
+        self.queries: Dict[str, Tuple[str, Tuple]] = {}
+        self._names = Counter()
+        self._originals = {}
+
+    def install(self) -> None:
+        for name in RECORDED_METHODS:
+            original = self._originals[name] = getattr(SAConnection, name)
+            setattr(SAConnection, name, self._wrap(name, original))
+
+    def uninstall(self) -> None:
+        for name, original in self._originals.items():
+            setattr(SAConnection, name, original)
+
+    def _wrap(self, name: str, method):
+        async def recorded(connection, query, *args, **kwargs):
+            if args and isinstance(query, str) and query not in self.queries:
+                caller = _caller()
+                self._names[caller] += 1
+                if self._names[caller] > 1:
+                    caller = f'{caller} #{self._names[caller]}'
+                # executemany gets a list of argument tuples
+                self.queries[query] = (caller, tuple(args[0][0]) if name == 'executemany' else args)
+            return await method(connection, query, *args, **kwargs)
+
+        return recorded
+
+
+async def seed() -> None:
+    """
+    Adds live games of the last two hours with players and steps, archived games of the last year,
+    and players with stats. Seeded games are played by seeded users, a few games each
+    """
+    values = {
+        'live_games': LIVE_GAMES,
+        'users': USERS,
+        'archived_games': ARCHIVED_GAMES,
+        'tg_id': SEEDED_TG_ID,
+    }
+    async with pg.transaction() as connection:
+        for query in SEED_QUERIES:
+            await connection.execute(query.format(**values))
+    for table in SEEDED_TABLES:
+        await pg.execute(f'VACUUM ANALYZE "{table}"')
+
+
+async def play(writer: GameWriter, number: int) -> int:
+    """
+    Creates a game between two players like the handlers do, plays it and persists it
+
+    :return: database ID of the game
+    """
+    cross, circle = 2 * number + 1, 2 * number + 2
+    cross_id = await resolve_user_id(cross, f'Player {cross}')
+    circle_id = await resolve_user_id(circle, f'Player {circle}')
+    game = await TicTacToeGameDAO().create(
+        current_step_user_id=cross_id,
+        width=3,
+        height=3,
+        win_length=3,
+        inline_message_id=f'recorded-{number}'
+    )
+    game_id = game['TicTacToeGame_id']
+    for user_id, sign in ((cross_id, EnumSign.cross), (circle_id, EnumSign.circle)):
+        await TicTacToePlayerDAO().create(user_id=user_id, game_id=game_id, sign=sign)
+    writer.update_game(game_id, current_step_user_id=cross_id, status=EnumStatus.in_progress)
+    for turn, position in enumerate(MOVES):
+        writer.add_move(game_id, circle if turn % 2 else cross, position)
+    writer.finish_game(game_id)
+    await writer.flush()
+    return game_id
+
+
+async def play_against_bot(writer: GameWriter, number: int) -> None:
+    cross = 2 * number + 1
+    cross_id = await resolve_user_id(cross, f'Player {cross}')
+    bot_id = await resolve_user_id(0, 'Bot')
+    game = await TicTacToeGameDAO().create(
+        current_step_user_id=cross_id,
+        status=EnumStatus.in_progress,
+        ai_difficulty=EnumDifficulty.random,
+        inline_message_id=f'recorded-{number}'
+    )
+    game_id = game['TicTacToeGame_id']
+    await TicTacToePlayerDAO().create_many([
+        {'user_id': cross_id, 'game_id': game_id, 'sign': EnumSign.cross},
+        {'user_id': bot_id, 'game_id': game_id, 'sign': EnumSign.circle},
+    ])
+    for turn, position in enumerate(MOVES):
+        writer.add_move(game_id, 0 if turn % 2 else cross, position)
+    await writer.flush()
+
+
+async def record() -> Dict[str, Tuple[str, Tuple]]:
+    """
+    Plays games, loads a seeded game the store doesn't have, reads the stats
+    and runs a batch of the reaper, rolled back
+
+    :return: name and arguments of the statements sent by their text
+    """
+    config = GameConfig()
+    seeded_game_id = await pg.fetchval('SELECT max(id) FROM "TicTacToeGame"')
+    writer = GameWriter(flush_interval=1, batch_size=1000, rating_k_factor=config.rating_k_factor)
+    store = GameStore(writer, size=100, max_idle=60)
+    recorder = QueryRecorder()
+    recorder.install()
+    try:
+        for number in range(GAMES):
+            game_id = await play(writer, number)
+        await play_against_bot(writer, GAMES)
+        await store.get(seeded_game_id)
+        game = await TicTacToeGameDAO().get(id=game_id)
+        await UserStatsDAO().get(user_id=game['TicTacToeGame_current_step_user_id'])
+        await UserStatsDAO().top(config.leaderboard_size)
+        game_dao = TicTacToeGameDAO()
+        async with pg.pool.acquire() as connection:
+            transaction = connection.transaction()
+            await transaction.start()
+            try:
+                await game_dao.expire(
+                    datetime.now() - timedelta(seconds=config.stale_timeout),
+                    config.reaper_batch_size,
+                    connection=connection
+                )
+                await game_dao.archive(
+                    datetime.now() - timedelta(seconds=config.archive_after),
+                    config.reaper_batch_size,
+                    connection=connection
+                )
+            finally:
+                await transaction.rollback()
+    finally:
+        recorder.uninstall()
+    return recorder.queries
+
+
+def _shape(node: Dict[str, Any], depth: int = 0) -> List[str]:
+    """
+    :return: a line per plan node with what it scans and how, without costs, so plans can be diffed
+    """
+    parts = [node['Node Type']]
+    for field, prefix in (('Join Type', ''), ('Relation Name', 'on '), ('Index Name', 'using '), ('Alias', 'as ')):
+        if field in node:
+            parts.append(f'{prefix}{node[field]}')
+    lines = ['  ' * depth + ' '.join(parts)]
+    for child in node.get('Plans', ()):
+        lines.extend(_shape(child, depth + 1))
+    return lines
+
+
+def _seq_scans(node: Dict[str, Any]) -> List[str]:
+    scans = [node['Relation Name']] if node['Node Type'] == 'Seq Scan' else []
+    for child in node.get('Plans', ()):
+        scans.extend(_seq_scans(child))
+    return scans
+
+
+async def explain(query: str, args: Tuple) -> Dict[str, Any]:
+    """
+    Runs the statement `REPEAT` times in transactions rolled back
+
+    :return: the plan of the fastest run, its shape and timings
+    """
+    best = None
+    async with pg.pool.acquire() as connection:
+        for _ in range(REPEAT):
+            transaction = connection.transaction()
+            await transaction.start()
+            try:
+                explained = await connection.fetchval(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}', *args)
+            finally:
+                await transaction.rollback()
+            result = json.loads(explained)[0]
+            if best is None or result['Execution Time'] < best['Execution Time']:
+                best = result
+    plan = best['Plan']
+    return {
+        'query': query,
+        'plan': _shape(plan),
+        'seq_scans': _seq_scans(plan),
+        'execution_ms': best['Execution Time'],
+    }
+
+
+async def _plans(config: DataBaseConfig, schema: str) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, float]]:
+    """
+    :return: plans of the recorded statements by name, and the estimated number of rows by table
+    """
+    await pg.init(
+        host=config.host,
+        port=config.port,
+        database=config.name,
+        user=config.user,
+        password=config.password.get_secret_value(),
+        server_settings={'search_path': schema},
+        min_size=1,
+        max_size=2
+    )
+    try:
+        await seed()
+        queries = await record()
+        plans = {}
+        for query, (name, args) in queries.items():
+            try:
+                plans[name] = await explain(query, args)
+            except PostgresError as error:
+                plans[name] = {'query': query, 'error': f'{type(error).__name__}: {error}'}
+        records = await pg.fetch(
+            "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relnamespace = $1::regnamespace",
+            schema
+        )
+    finally:
+        await pg.pool.close()
+    return plans, {record['relname']: record['reltuples'] for record in records}
+
+
+@pytest.fixture(scope='module')
+def explained(request):
+    """
+    Plans of the statements explained in a schema created, migrated and seeded for the module
+    """
+    try:
+        config = DataBaseConfig()
+    except ValidationError:
+        pytest.skip('Database is not configured')
+    schema = f'query_plans_{os.getpid()}'
+    engine = create_engine(
+        URL(
+            config.driver,
+            username=config.user,
+            password=config.password.get_secret_value(),
+            host=config.host,
+            port=config.port,
+            database=config.name
+        ),
+        connect_args={'options': f'-csearch_path={schema}'},
+        poolclass=NullPool
+    )
+    try:
+        engine.execute(f'CREATE SCHEMA "{schema}"')
+    except OperationalError as error:
+        pytest.skip(f'Database is not available: {error}')
+
+    loop = asyncio.new_event_loop()
+    try:
+        alembic_config = Config(os.path.join(BOT_DIRECTORY, 'alembic.ini'))
+        alembic_config.set_main_option('script_location', os.path.join(BOT_DIRECTORY, 'alembic'))
+        alembic_config.attributes['connection'] = engine
+        command.upgrade(alembic_config, 'head')
+        plans, rows = loop.run_until_complete(_plans(config, schema))
+    finally:
+        loop.close()
+        engine.execute(f'DROP SCHEMA "{schema}" CASCADE')
+        engine.dispose()
+
+    if request.config.getoption('update_query_plans'):
+        with open(BASELINE, 'w') as baseline_file:
+            json.dump(
+                {name: {'query': plan['query'], 'plan': plan.get('plan')} for name, plan in sorted(plans.items())},
+                baseline_file,
+                indent=2,
+                ensure_ascii=False
+            )
+            baseline_file.write('\n')
+    return plans, rows
+
+
+def test_statements_run(explained):
+    plans, _ = explained
+    errors = [f'{name}: {plan["error"]}' for name, plan in plans.items() if 'error' in plan]
+
+    assert not errors, '\n'.join(errors)
+
+
+def test_no_sequential_scans_of_large_tables(explained):
+    plans, rows = explained
+    scans = [
+        f'{name}: sequential scan on {table} of {rows[table]:.0f} rows'
+        for name, plan in plans.items()
+        for table in dict.fromkeys(plan.get('seq_scans', ()))
+        if rows.get(table, 0) >= LARGE_ROWS
+    ]
+
+    assert not scans, '\n'.join(scans)
+
+
+def test_latency_budgets(explained):
+    plans, _ = explained
+    over = []
+    for name, plan in plans.items():
+        budget = BUDGETS_MS.get(name.split(' #')[0], BUDGET_MS)
+        if plan.get('execution_ms', 0) > budget:
+            over.append(f'{name}: {plan["execution_ms"]:.2f} ms over the budget of {budget} ms')
+
+    assert not over, '\n'.join(over)
+
+
+def test_plans_match_baseline(explained):
+    plans, _ = explained
+    with open(BASELINE) as baseline_file:
+        baseline = json.load(baseline_file)
+    changes = []
+    for name in sorted(plans.keys() | baseline.keys()):
+        if name not in baseline:
+            changes.append(f'+ {name}: new statement')
+        elif name not in plans:
+            changes.append(f'- {name}: not sent anymore')
+        elif plans[name].get('plan') != baseline[name]['plan']:
+            changes.extend(difflib.unified_diff(
+                baseline[name]['plan'] or [], plans[name].get('plan') or [],
+                f'{name} baseline', f'{name} now', lineterm=''
+            ))
+
+    assert not changes, '\n'.join(changes + ['Run with --update-query-plans if the change is intended'])
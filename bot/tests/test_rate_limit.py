@@ -0,0 +1,71 @@
+import pytest
+
+from rate_limit import TokenBucket
+
+
+def test_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    assert [bucket.consume() for _ in range(3)] == [0, 0, 0]
+    assert bucket.consume() == pytest.approx(0.5)
+
+
+def test_refill(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.consume()
+
+    clock.advance(0.25)
+    assert bucket.consume() == pytest.approx(0.25)
+    clock.advance(0.25)
+    assert bucket.consume() == 0
+    assert bucket.consume() == pytest.approx(0.5)
+
+
+def test_refill_is_capped(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    bucket.consume()
+
+    clock.advance(60)
+    assert [bucket.consume() for _ in range(3)] == [0, 0, 0]
+    assert bucket.consume() > 0
+
+
+def test_rate_over_time(clock):
+    bucket = TokenBucket(rate=8, capacity=1)
+    taken = 0
+    for _ in range(1000):
+        if not bucket.consume():
+            taken += 1
+        clock.advance(1 / 16)
+
+    # 62.5 seconds at 8 per second and the initial token
+    assert taken == pytest.approx(501, abs=1)
+
+
+def test_pause(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    bucket.pause(5)
+
+    assert bucket.consume() == pytest.approx(5)
+    clock.advance(5)
+    # No tokens accumulate during the pause
+    assert bucket.consume() == pytest.approx(0.5)
+    clock.advance(0.5)
+    assert bucket.consume() == 0
+
+
+def test_acquire_waits(loop, clock, monkeypatch):
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+        clock.advance(delay)
+
+    monkeypatch.setattr('rate_limit.asyncio.sleep', sleep)
+    bucket = TokenBucket(rate=4, capacity=1)
+
+    loop.run_until_complete(bucket.acquire())
+    loop.run_until_complete(bucket.acquire())
+
+    assert slept == [pytest.approx(0.25)]
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from scheduler import KeyedScheduler, Overloaded
+
+
+def _job(log: list, name: str, gate: asyncio.Event = None):
+    async def job():
+        log.append(('start', name))
+        if gate is not None:
+            await gate.wait()
+        await asyncio.sleep(0)
+        log.append(('end', name))
+        return name
+
+    return job
+
+
+def test_key_runs_in_arrival_order(loop):
+    scheduler = KeyedScheduler(concurrency=10, max_queue_per_key=10, max_pending=100)
+    log = []
+
+    async def run():
+        return await asyncio.gather(*(scheduler.run('game', _job(log, index)) for index in range(5)))
+
+    assert loop.run_until_complete(run()) == list(range(5))
+    assert log == [(event, index) for index in range(5) for event in ('start', 'end')]
+    assert scheduler.pending == 0
+    assert not scheduler._keys
+
+
+def test_keys_run_in_parallel_up_to_concurrency(loop):
+    scheduler = KeyedScheduler(concurrency=2, max_queue_per_key=10, max_pending=100)
+    gate = asyncio.Event()
+    log = []
+
+    async def run():
+        tasks = [asyncio.ensure_future(scheduler.run(key, _job(log, key, gate))) for key in 'abc']
+        await asyncio.sleep(0.01)
+        started = [name for event, name in log if event == 'start']
+        gate.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert loop.run_until_complete(run()) == ['a', 'b']
+    assert [name for event, name in log if event == 'start'] == ['a', 'b', 'c']
+
+
+def test_sheds_a_full_key(loop):
+    scheduler = KeyedScheduler(concurrency=10, max_queue_per_key=2, max_pending=100)
+    gate = asyncio.Event()
+    log = []
+
+    async def run():
+        tasks = [asyncio.ensure_future(scheduler.run('game', _job(log, index, gate))) for index in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await scheduler.run('game', _job(log, 'shed'))
+        # Other keys still get through
+        other = asyncio.ensure_future(scheduler.run('other', _job(log, 'other')))
+        gate.set()
+        return await asyncio.gather(*tasks, other)
+
+    assert loop.run_until_complete(run()) == [0, 1, 'other']
+    assert ('start', 'shed') not in log
+
+
+def test_sheds_when_pending_is_full(loop):
+    scheduler = KeyedScheduler(concurrency=10, max_queue_per_key=10, max_pending=2)
+    gate = asyncio.Event()
+    log = []
+
+    async def run():
+        tasks = [asyncio.ensure_future(scheduler.run(key, _job(log, key, gate))) for key in 'ab']
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await scheduler.run('c', _job(log, 'c'))
+        assert 'c' not in scheduler._keys
+        gate.set()
+        await asyncio.gather(*tasks)
+        # Room again once jobs finished
+        return await scheduler.run('c', _job(log, 'c'))
+
+    assert loop.run_until_complete(run()) == 'c'
+
+
+def test_failed_job_releases_its_key(loop):
+    scheduler = KeyedScheduler(concurrency=1, max_queue_per_key=10, max_pending=100)
+
+    async def fail():
+        raise RuntimeError
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await scheduler.run('game', fail)
+        return await scheduler.run('game', _job([], 'next'))
+
+    assert loop.run_until_complete(run()) == 'next'
+    assert scheduler.pending == 0
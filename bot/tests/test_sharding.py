@@ -0,0 +1,77 @@
+from collections import Counter
+
+import pytest
+
+from callbacks import FieldCallback, encode
+from sharding import HashRing, shard_key
+
+KEYS = [f'message-{index}' for index in range(5000)]
+
+
+def _owners(ring: HashRing):
+    return {key: next(ring.nodes(key)) for key in KEYS}
+
+
+@pytest.fixture
+def ring() -> HashRing:
+    ring = HashRing()
+    for node in range(4):
+        ring.add(node)
+    return ring
+
+
+def test_nodes_lists_every_node_once(ring):
+    for key in KEYS[:100]:
+        nodes = list(ring.nodes(key))
+        assert sorted(nodes) == [0, 1, 2, 3]
+
+
+def test_keys_spread(ring):
+    counts = Counter(_owners(ring).values())
+
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > len(KEYS) / 4 / 2
+
+
+def test_removing_a_node_only_moves_its_keys(ring):
+    before = _owners(ring)
+    ring.remove(2)
+    after = _owners(ring)
+
+    assert 2 not in ring
+    assert len(ring) == 3
+    for key in KEYS:
+        if before[key] != 2:
+            assert after[key] == before[key]
+        else:
+            # Keys move to the next node in their order of preference
+            assert after[key] != 2
+
+
+def test_adding_the_node_back_restores_owners(ring):
+    before = _owners(ring)
+    ring.remove(2)
+    ring.add(2)
+
+    assert _owners(ring) == before
+
+
+def test_empty_ring():
+    assert list(HashRing().nodes('key')) == []
+
+
+def _callback_update(data: str, inline_message_id: str = None) -> dict:
+    query = {'id': '1', 'from': {'id': 7}, 'data': data}
+    if inline_message_id:
+        query['inline_message_id'] = inline_message_id
+    return {'update_id': 1, 'callback_query': query}
+
+
+def test_shard_key():
+    data = encode(FieldCallback(42, 3))
+
+    assert shard_key(_callback_update(data, 'message')) == 'message'
+    assert shard_key(_callback_update(data)) == 'game:42'
+    assert shard_key(_callback_update('garbage')) == 'user:7'
+    assert shard_key({'update_id': 1, 'inline_query': {'id': '1', 'from': {'id': 7}}}) == 'user:7'
+    assert shard_key({'update_id': 5}) == '5'
@@ -0,0 +1,36 @@
+from typing import NamedTuple
+
+from DAO import UserDAO
+from cache import TTLCache
+from configs import CacheConfig
+from metrics import Counter
+
+
+class CachedUser(NamedTuple):
+    id: int
+    name: str
+
+
+CACHE_HITS = Counter('user_cache_hits_total', 'Users resolved from the cache')
+CACHE_MISSES = Counter('user_cache_misses_total', 'Users upserted as they were not cached or changed their name')
+
+cache_config = CacheConfig()
+user_cache: TTLCache[CachedUser] = TTLCache(cache_config.user_cache_size, cache_config.user_cache_ttl)
+
+
+async def resolve_user_id(tg_id: int, name: str) -> int:
+    """
+    :param tg_id: Telegram ID of the user
+    :param name: current display name, stored when it differs from the known one
+
+    :return: database ID of the user, created on the first call
+    """
+    user = user_cache.get(tg_id)
+    if user is None or user.name != name:
+        CACHE_MISSES.inc()
+        record = await UserDAO().upsert(tg_id=tg_id, name=name)
+        user = CachedUser(record['User_id'], name)
+        user_cache.set(tg_id, user)
+    else:
+        CACHE_HITS.inc()
+    return user.id
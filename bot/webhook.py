@@ -0,0 +1,91 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Dispatcher
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiohttp import web
+
+from admission import exempt
+from configs import BotConfig
+
+UPDATES_SEMAPHORE_KEY = 'UPDATES_SEMAPHORE'
+SHARD_EPOCH_KEY = 'SHARD_EPOCH'
+ON_REBALANCE_KEY = 'ON_REBALANCE'
+# Sent by the front process, changes whenever games move between workers
+SHARD_EPOCH_HEADER = 'X-Shard-Epoch'
+# Sent by the front process with the updates queued while the bot was down
+CATCH_UP_HEADER = 'X-Catch-Up'
+# Posted to by the front process with the new epoch before games move between workers
+REBALANCE_PATH = '/rebalance'
+
+
+async def _set_epoch(app: web.Application, epoch: Optional[str]) -> None:
+    if epoch is not None and epoch != app[SHARD_EPOCH_KEY]:
+        app[SHARD_EPOCH_KEY] = epoch
+        if on_rebalance := app[ON_REBALANCE_KEY]:
+            await on_rebalance()
+
+
+async def rebalance(request: web.Request) -> web.Response:
+    await _set_epoch(request.app, request.headers.get(SHARD_EPOCH_HEADER))
+    return web.Response()
+
+
+class BoundedWebhookRequestHandler(WebhookRequestHandler):
+    """
+    Webhook request handler processing a bounded number of updates at once.
+
+    Requests over the limit wait for a free slot with the Telegram connection held open,
+    so Telegram stops sending new updates once `max_connections` are busy
+    """
+
+    async def post(self):
+        app = self.request.app
+        await _set_epoch(app, self.request.headers.get(SHARD_EPOCH_HEADER))
+        if self.request.headers.get(CATCH_UP_HEADER):
+            exempt.set(True)
+        async with app[UPDATES_SEMAPHORE_KEY]:
+            return await super().post()
+
+
+def create_web_app(
+        max_concurrent_updates: int,
+        on_rebalance: Optional[Callable[[], Awaitable]] = None
+) -> web.Application:
+    """
+    :param on_rebalance: called when the front process moved games between workers,
+        which also posts to `REBALANCE_PATH` before it routes the moved games
+    """
+    async def create_semaphore(app: web.Application):
+        app[UPDATES_SEMAPHORE_KEY] = asyncio.Semaphore(max_concurrent_updates)
+
+    app = web.Application()
+    app[SHARD_EPOCH_KEY] = None
+    app[ON_REBALANCE_KEY] = on_rebalance
+    app.on_startup.append(create_semaphore)
+    if on_rebalance:
+        app.router.add_route('POST', REBALANCE_PATH, rebalance)
+    return app
+
+
+def run_web_app(app: web.Application, host: str, port: int, loop: asyncio.AbstractEventLoop):
+    """
+    Serve the app on the event loop the bot and the database pool were created on
+    """
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, host, port).start())
+    try:
+        loop.run_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+
+async def set_webhook(dispatcher: Dispatcher):
+    config = BotConfig()
+    await dispatcher.bot.set_webhook(
+        config.webhook_url.get_secret_value(),
+        max_connections=config.webhook_max_connections
+    )